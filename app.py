@@ -1,11 +1,53 @@
-from flask import Flask
+import atexit
+import os
+from flask import Flask, Response, request
 from blueprints.serialization import to_json
 from blueprints.game_sessions_manager import GameSessionsManager
-from blueprints.storage import GameSessionsStorage
+from blueprints.state_query import StateQuery, EVENTS_KEEP_ALIVE_INTERVAL, SESSION_NOT_FOUND, INVALID_WAIT
+from blueprints.storage import IGameSessionStorage, GameSessionsStorage, StorageLimits
+from blueprints.sqlite_storage import SqliteGameSessionsStorage
+from blueprints.redis_storage import RedisGameSessionsStorage
+from blueprints.journal import MoveJournal
+from blueprints.snapshot import MappedSnapshot
+from blueprints.notifications import to_server_sent_event
+from blueprints.game_domain.transposition import position_cache, DEFAULT_MAX_POSITIONS
 
 app = Flask(__name__)
 
-session_manager = GameSessionsManager(GameSessionsStorage())
+# games are kept in memory unless a database file or a Redis server (shared by workers) is set;
+# in memory, they can be recovered from a journal file if it is set,
+# or dumped to a snapshot file on exit and mapped back on start
+# (only on a normal exit: after a crash the previous snapshot is mapped, missing the later changes;
+# and it's for a single process, as each worker would overwrite the file with its own games)
+storage: IGameSessionStorage
+journal: MoveJournal | None = None
+# positions whose views and legal moves are shared by the games of a worker (about 1 KB each)
+position_cache.resize(int(os.environ.get('DARK_CHESS_POSITION_CACHE', DEFAULT_MAX_POSITIONS)))
+if os.environ.get('DARK_CHESS_REDIS'):
+    redis_host, _, redis_port = os.environ['DARK_CHESS_REDIS'].partition(':')
+    storage = RedisGameSessionsStorage(redis_host, int(redis_port or 6379))
+    atexit.register(storage.close)
+elif os.environ.get('DARK_CHESS_DATABASE'):
+    storage = SqliteGameSessionsStorage(os.environ['DARK_CHESS_DATABASE'])
+    atexit.register(storage.close)
+else:
+    snapshot_path = os.environ.get('DARK_CHESS_SNAPSHOT')
+    storage = GameSessionsStorage(StorageLimits(
+        idle_timeout=7 * 24 * 60 * 60,
+        freeze_after=30 * 60,
+        freeze_finished_after=5 * 60,
+        max_hot_sessions=10_000,
+        max_sessions=1_000_000,
+    ), snapshot=MappedSnapshot(snapshot_path) if snapshot_path and os.path.exists(snapshot_path) else None)
+    if os.environ.get('DARK_CHESS_JOURNAL'):
+        journal = MoveJournal(os.environ['DARK_CHESS_JOURNAL'],
+                              os.environ['DARK_CHESS_JOURNAL'] + '.snapshot',
+                              lambda: storage.export_sessions(is_locking=True))
+        storage.import_sessions(journal.recover())
+        atexit.register(journal.close)
+    elif snapshot_path:
+        atexit.register(storage.dump_snapshot, snapshot_path)
+session_manager = GameSessionsManager(storage, journal)
 
 @app.post('/game/new')
 def create_game():
@@ -44,6 +86,17 @@ def is_move_valid(player_secret: str, x_from: int, y_from: int, x_to: int, y_to:
         'valid': session is not None
     }
 
+@app.get('/game/<player_secret>/legal-moves')
+@app.get('/game/<player_secret>/legal-moves/<int:x>/<int:y>')
+def get_legal_moves(player_secret: str, x: int | None = None, y: int | None = None):
+    # all moves of the player's pieces (or of the one at x, y) in one request, instead of asking move-validity about each
+    result = session_manager.get_legal_moves(player_secret, x, y)
+    if result is None:
+        return {
+            'problem': 'session not found by secret'
+        }, 404
+    return to_json(result)
+
 @app.post('/game/<player_secret>/move/<int:x_from>/<int:y_from>/<int:x_to>/<int:y_to>')
 def make_move(player_secret: str, x_from: int, y_from: int, x_to: int, y_to: int):
     result = session_manager.make_move(player_secret, x_from, y_from, x_to, y_to)
@@ -57,13 +110,46 @@ def make_move(player_secret: str, x_from: int, y_from: int, x_to: int, y_to: int
 
 @app.get('/game/<player_secret>/state')
 def get_view_and_stats(player_secret: str):
-    result = session_manager.get_player_view_and_stats(player_secret)
+    # see state_query.py for the parameters
+    try:
+        query = StateQuery.parse(request.args, request.headers.get('If-None-Match', ''))
+    except ValueError:
+        return INVALID_WAIT, 400
+    if query.is_waiting:
+        assert query.known_version is not None
+        version = session_manager.wait_for_version_change(player_secret, query.known_version, query.wait)
+        if version is None:
+            return SESSION_NOT_FOUND, 404
+        if query.is_not_modified(version):
+            return '', 304, { 'ETag': f'"{version}"' }
+
+    result = session_manager.get_player_view_and_stats(player_secret) if query.since_version is None \
+        else session_manager.get_player_view_changes(player_secret, query.since_version)
     if result is None:
+        return SESSION_NOT_FOUND, 404
+    return to_json(query.format(result)), StateQuery.get_headers(result.version)
+
+@app.get('/game/<player_secret>/events')
+def get_events(player_secret: str):
+    # Server-Sent Events with the state (like /state gives) on each change of the game, instead of polling
+    subscription = session_manager.subscribe_to_updates(player_secret)
+    if subscription is None:
         return {
             'problem': 'session not found by secret'
         }, 404
 
-    return to_json(result)
+    def stream():
+        try:
+            while not subscription.is_closed:
+                update = subscription.get(EVENTS_KEEP_ALIVE_INTERVAL)
+                yield to_server_sent_event(update) if update is not None else ': keep-alive\n\n'
+        finally:
+            subscription.close()
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # nginx shouldn't buffer the stream
+        'X-Accel-Buffering': 'no',
+    })
 
 #TODO: def promote(player_secret: str, x_from: int, y_from: int, x_to: int, y_to: int):
 
@@ -0,0 +1,14 @@
+"""
+The game API for asyncio servers, e.g. `uvicorn asgi:app`
+(the same routes and environment variables as app.py, see blueprints/asgi_app.py)
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from app import storage, session_manager
+from blueprints.async_storage import AsyncStorageAdapter
+from blueprints.async_game_sessions_manager import AsyncGameSessionsManager
+from blueprints.asgi_app import create_asgi_app
+
+# for rule evaluation and blocking storages; waiting clients don't take its threads
+executor = ThreadPoolExecutor(thread_name_prefix='dark_chess')
+app = create_asgi_app(AsyncGameSessionsManager(session_manager, AsyncStorageAdapter(storage, executor), executor))
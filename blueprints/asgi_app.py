@@ -0,0 +1,193 @@
+"""
+The game API (the same routes as app.py) as a plain ASGI application,
+for asyncio servers like uvicorn or hypercorn (see asgi.py).
+
+Requests evaluating the rules are run in the executor of
+AsyncGameSessionsManager, so the event loop isn't blocked by them; a waiting
+client (long-polling /state, /events) costs a coroutine and a subscription,
+not a thread, so a process can hold many thousands of them.
+"""
+
+import asyncio
+import re
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+from urllib.parse import parse_qs
+from .async_game_sessions_manager import AsyncGameSessionsManager
+from .state_query import StateQuery, EVENTS_KEEP_ALIVE_INTERVAL, SESSION_NOT_FOUND, INVALID_WAIT
+from .serialization import to_json
+from .notifications import to_server_sent_event
+
+Receive = Callable[[], Awaitable[dict]]
+Send = Callable[[dict], Awaitable[None]]
+
+@dataclass
+class _Request:
+    query: dict[str, str]
+    headers: dict[bytes, bytes]
+    receive: Receive
+
+@dataclass
+class _Response:
+    body: str | bytes
+    status: int = 200
+    headers: dict[str, str] | None = None
+    content_type: str = 'application/json'
+
+def create_asgi_app(manager: AsyncGameSessionsManager) -> Callable[[dict, Receive, Send], Awaitable[None]]:
+    async def json_response(result: Any, status: int = 200, headers: dict[str, str] | None = None) -> _Response:
+        # serializing a view isn't cheap either
+        return _Response(await manager.run(to_json, result), status, headers)
+
+    async def create_game(request: _Request) -> _Response:
+        white_secret, board_view__white = await manager.create_session()
+        return await json_response({
+            'white_secret': white_secret,
+            'board_view__white': board_view__white
+        })
+
+    async def get_join_secret(request: _Request, white_secret: str) -> _Response:
+        return _Response(to_json({ 'join_secret': await manager.get_join_secret(white_secret) }))
+
+    async def join_game(request: _Request, join_secret: str) -> _Response:
+        result = await manager.join_session(join_secret)
+        if result is None:
+            return _Response(to_json({
+                'black_secret': None,
+                'board_view__black': None
+            }), 404)
+
+        black_secret, board_view__black = result
+        return await json_response({
+            'black_secret': black_secret,
+            'board_view__black': board_view__black
+        })
+
+    async def is_move_valid(request: _Request, player_secret: str, x_from: int, y_from: int, x_to: int, y_to: int):
+        session = await manager.validate_move(player_secret, x_from, y_from, x_to, y_to)
+        return _Response(to_json({ 'valid': session is not None }))
+
+    async def get_legal_moves(request: _Request, player_secret: str, x: int | None = None, y: int | None = None):
+        result = await manager.get_legal_moves(player_secret, x, y)
+        if result is None:
+            return _Response(to_json(SESSION_NOT_FOUND), 404)
+        return await json_response(result)
+
+    async def make_move(request: _Request, player_secret: str, x_from: int, y_from: int, x_to: int, y_to: int):
+        result = await manager.make_move(player_secret, x_from, y_from, x_to, y_to)
+        if result is None:
+            return _Response(to_json({ 'problem': 'invalid move or session was not found by secret' }))
+        return await json_response(result)
+
+    async def get_view_and_stats(request: _Request, player_secret: str) -> _Response:
+        # see state_query.py for the parameters
+        try:
+            query = StateQuery.parse(request.query, request.headers.get(b'if-none-match', b'').decode('latin-1'))
+        except ValueError:
+            return _Response(to_json(INVALID_WAIT), 400)
+        if query.is_waiting:
+            assert query.known_version is not None
+            version = await manager.wait_for_version_change(player_secret, query.known_version, query.wait)
+            if version is None:
+                return _Response(to_json(SESSION_NOT_FOUND), 404)
+            if query.is_not_modified(version):
+                return _Response(b'', 304, { 'ETag': f'"{version}"' })
+
+        result = await manager.get_player_view_and_stats(player_secret) if query.since_version is None \
+            else await manager.get_player_view_changes(player_secret, query.since_version)
+        if result is None:
+            return _Response(to_json(SESSION_NOT_FOUND), 404)
+        return await json_response(query.format(result), headers=StateQuery.get_headers(result.version))
+
+    async def get_events(request: _Request, send: Send, player_secret: str) -> _Response | None:
+        subscription = await manager.subscribe_to_updates(player_secret)
+        if subscription is None:
+            return _Response(to_json(SESSION_NOT_FOUND), 404)
+
+        await _send_start(send, 200, 'text/event-stream', {
+            'Cache-Control': 'no-cache',
+            # nginx shouldn't buffer the stream
+            'X-Accel-Buffering': 'no',
+        })
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(request.receive))
+        try:
+            while True:
+                getting = asyncio.ensure_future(subscription.get(EVENTS_KEEP_ALIVE_INTERVAL))
+                await asyncio.wait((getting, disconnected), return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    getting.cancel()
+                    return None
+                update = getting.result()
+                event = await manager.run(to_server_sent_event, update) if update is not None else ': keep-alive\n\n'
+                await send({ 'type': 'http.response.body', 'body': event.encode(), 'more_body': True })
+        finally:
+            subscription.close()
+            disconnected.cancel()
+
+    # (method, path pattern, handler, whether the handler streams the response itself)
+    routes: list[tuple[str, re.Pattern, Callable[..., Awaitable[_Response | None]], bool]] = [
+        ('POST', re.compile(r'/game/new'), create_game, False),
+        ('GET', re.compile(r'/game/(?P<white_secret>[^/]+)/join_secret'), get_join_secret, False),
+        ('POST', re.compile(r'/game/(?P<join_secret>[^/]+)/join'), join_game, False),
+        ('GET', re.compile(r'/game/(?P<player_secret>[^/]+)/move-validity/(?P<x_from>\d+)/(?P<y_from>\d+)/(?P<x_to>\d+)/(?P<y_to>\d+)'),
+         is_move_valid, False),
+        ('GET', re.compile(r'/game/(?P<player_secret>[^/]+)/legal-moves(/(?P<x>\d+)/(?P<y>\d+))?'), get_legal_moves, False),
+        ('POST', re.compile(r'/game/(?P<player_secret>[^/]+)/move/(?P<x_from>\d+)/(?P<y_from>\d+)/(?P<x_to>\d+)/(?P<y_to>\d+)'),
+         make_move, False),
+        ('GET', re.compile(r'/game/(?P<player_secret>[^/]+)/state'), get_view_and_stats, False),
+        ('GET', re.compile(r'/game/(?P<player_secret>[^/]+)/events'), get_events, True),
+    ]
+
+    async def app(scope: dict, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'lifespan':
+            await _serve_lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        response: _Response | None = _Response(b'Not Found', 404, content_type='text/plain')
+        for method, pattern, handler, is_streaming in routes:
+            match = pattern.fullmatch(scope['path'])
+            if match is None:
+                continue
+            if scope['method'] != method and not (method == 'GET' and scope['method'] == 'HEAD'):
+                response = _Response(b'Method Not Allowed', 405, content_type='text/plain')
+                continue
+            request = _Request({ name: values[-1] for name, values in parse_qs(scope.get('query_string', b'').decode()).items() },
+                               dict(scope.get('headers', [])),
+                               receive)
+            # the rest are coordinates
+            arguments = { name: value if name.endswith('secret') else int(value)
+                          for name, value in match.groupdict().items() if value is not None }
+            response = await (handler(request, send, **arguments) if is_streaming else handler(request, **arguments))
+            break
+        if response is None:
+            # streamed until the client disconnected
+            return
+
+        await _send_start(send, response.status, response.content_type, response.headers or {})
+        body = response.body.encode() if isinstance(response.body, str) else response.body
+        await send({ 'type': 'http.response.body', 'body': body if scope['method'] != 'HEAD' else b'' })
+
+    return app
+
+async def _send_start(send: Send, status: int, content_type: str, headers: dict[str, str]) -> None:
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': ([(b'content-type', content_type.encode())] if status != 304 else []) +
+                   [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+    })
+
+async def _wait_for_disconnect(receive: Receive) -> None:
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def _serve_lifespan(receive: Receive, send: Send) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({ 'type': 'lifespan.startup.complete' })
+        elif message['type'] == 'lifespan.shutdown':
+            await send({ 'type': 'lifespan.shutdown.complete' })
+            return
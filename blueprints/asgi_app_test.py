@@ -0,0 +1,212 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .asgi_app import create_asgi_app
+from .async_game_sessions_manager import AsyncGameSessionsManager
+from .async_storage import AsyncStorageAdapter
+from .game_sessions_manager import GameSessionsManager
+from .storage import GameSessionsStorage
+
+def create_app(executor=None):
+    storage = GameSessionsStorage()
+    session_manager = GameSessionsManager(storage)
+    manager = AsyncGameSessionsManager(session_manager, AsyncStorageAdapter(storage, executor), executor)
+    return create_asgi_app(manager), session_manager
+
+async def request(app, method, path, query=b'', headers=(), disconnect=None):
+    """ Returns the status, headers and body chunks; disconnect is awaited before http.disconnect is received """
+    messages = []
+    is_requested = False
+
+    async def receive():
+        nonlocal is_requested
+        if not is_requested:
+            is_requested = True
+            return { 'type': 'http.request', 'body': b'', 'more_body': False }
+        await (disconnect if disconnect is not None else asyncio.Event().wait())
+        return { 'type': 'http.disconnect' }
+
+    async def send(message):
+        messages.append(message)
+
+    await app({ 'type': 'http', 'method': method, 'path': path, 'query_string': query, 'headers': list(headers) },
+              receive, send)
+    start, *bodies = messages
+    return start['status'], dict(start['headers']), [body['body'] for body in bodies]
+
+def call(app, method, path, query=b'', headers=()):
+    status, response_headers, bodies = asyncio.run(request(app, method, path, query, headers))
+    body = b''.join(bodies)
+    is_json = response_headers.get(b'content-type') == b'application/json'
+    return status, response_headers, json.loads(body) if is_json else body or None
+
+def test_routes():
+    app, _ = create_app()
+    status, headers, created = call(app, 'POST', '/game/new')
+    assert status == 200
+    assert headers[b'content-type'] == b'application/json'
+    white_secret = created['white_secret']
+    assert len(created['board_view__white']) == 8
+
+    _, _, join = call(app, 'GET', f'/game/{white_secret}/join_secret')
+    assert call(app, 'POST', '/game/garbage/join')[0] == 404
+    status, _, joined = call(app, 'POST', f'/game/{join["join_secret"]}/join')
+    assert status == 200
+    black_secret = joined['black_secret']
+
+    assert call(app, 'GET', f'/game/{white_secret}/move-validity/1/1/1/3')[2] == { 'valid': True }
+    assert call(app, 'GET', f'/game/{black_secret}/move-validity/1/6/1/4')[2] == { 'valid': False }
+    _, _, legal_moves = call(app, 'GET', f'/game/{white_secret}/legal-moves')
+    assert len(legal_moves['moves']) == 10
+    assert call(app, 'GET', f'/game/{white_secret}/legal-moves/1/0')[2] == \
+        { 'moves': [[1, 0, [[0, 2], [2, 2]]]], 'version': 0 }
+    assert call(app, 'GET', '/game/garbage/legal-moves')[0] == 404
+    assert call(app, 'POST', f'/game/{black_secret}/move/1/6/1/4')[2] == \
+        { 'problem': 'invalid move or session was not found by secret' }
+    status, _, moved = call(app, 'POST', f'/game/{white_secret}/move/1/1/1/3')
+    assert status == 200
+    assert moved['version'] == 1
+
+    assert call(app, 'GET', '/game/new')[0] == 405
+    assert call(app, 'GET', '/unknown')[0] == 404
+
+def test_state_etag_and_since():
+    app, _ = create_app()
+    white_secret = call(app, 'POST', '/game/new')[2]['white_secret']
+
+    status, headers, state = call(app, 'GET', f'/game/{white_secret}/state')
+    assert status == 200
+    assert headers[b'etag'] == b'"0"'
+    assert headers[b'cache-control'] == b'no-cache'
+    assert state['version'] == 0
+
+    status, headers, body = call(app, 'GET', f'/game/{white_secret}/state', headers=[(b'if-none-match', b'"0"')])
+    assert status == 304
+    assert body is None
+    assert b'content-type' not in headers
+
+    call(app, 'POST', f'/game/{white_secret}/move/1/1/1/3')
+    status, _, changes = call(app, 'GET', f'/game/{white_secret}/state', b'since=0')
+    assert status == 200
+    assert changes['version'] == 1
+    assert 'changed_cells' in changes
+
+    _, _, compact = call(app, 'GET', f'/game/{white_secret}/state', b'format=compact')
+    assert isinstance(compact['player_view'], str)
+    _, _, compact_changes = call(app, 'GET', f'/game/{white_secret}/state', b'since=0&format=compact')
+    # the pawn (code 1) moved from 1, 1 to 1, 3
+    assert [1, 1, 0] in compact_changes['changed_cells']
+    assert [1, 3, 1] in compact_changes['changed_cells']
+
+    assert call(app, 'GET', '/game/garbage/state')[0] == 404
+    assert call(app, 'GET', '/game/garbage/state', headers=[(b'if-none-match', b'"0"')])[0] == 404
+
+def test_state_version_is_read_under_the_session_lock():
+    app, session_manager = create_app()
+    white_secret = call(app, 'POST', '/game/new')[2]['white_secret']
+    session = session_manager.storage.get_session_by_secret(white_secret)
+    assert session is not None
+    statuses = []
+
+    # like a move being tried by another request
+    with session_manager.storage.locks.hold(white_secret):
+        session.game_state.version += 1
+        requesting = threading.Thread(target=lambda: statuses.append(
+            call(app, 'GET', f'/game/{white_secret}/state', headers=[(b'if-none-match', b'"0"')])[0]))
+        requesting.start()
+        requesting.join(0.05)
+        session.game_state.version -= 1
+    requesting.join()
+    assert statuses == [304]
+
+def test_state_wait_for_move():
+    app, session_manager = create_app()
+
+    async def scenario():
+        white_secret = json.loads(b''.join((await request(app, 'POST', '/game/new'))[2]))['white_secret']
+        waiting = asyncio.ensure_future(request(app, 'GET', f'/game/{white_secret}/state', b'wait=5',
+                                                [(b'if-none-match', b'"0"')]))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        await request(app, 'POST', f'/game/{white_secret}/move/1/1/1/3')
+        status, headers, _ = await asyncio.wait_for(waiting, 1)
+        assert status == 200
+        assert headers[b'etag'] == b'"1"'
+
+        # not changed in time
+        status, _, _ = await request(app, 'GET', f'/game/{white_secret}/state', b'wait=0.05',
+                                     [(b'if-none-match', b'"1"')])
+        assert status == 304
+
+        # waits out of range are clamped, non-numbers are refused
+        status, _, _ = await request(app, 'GET', f'/game/{white_secret}/state', b'wait=-1',
+                                     [(b'if-none-match', b'"1"')])
+        assert status == 304
+        for wait in (b'nan', b'inf'):
+            status, _, _ = await request(app, 'GET', f'/game/{white_secret}/state', b'wait=' + wait,
+                                         [(b'if-none-match', b'"1"')])
+            assert status == 400
+    asyncio.run(scenario())
+    assert session_manager.notifier.subscribers_count == 0
+
+def test_idle_waiting_clients_dont_take_threads():
+    with ThreadPoolExecutor(2) as executor:
+        app, session_manager = create_app(executor)
+
+        threads_count = threading.active_count()
+
+        async def scenario():
+            white_secret = json.loads(b''.join((await request(app, 'POST', '/game/new'))[2]))['white_secret']
+            waiting = [asyncio.ensure_future(request(app, 'GET', f'/game/{white_secret}/state', b'wait=5',
+                                                     [(b'if-none-match', b'"0"')]))
+                       for _ in range(500)]
+            while session_manager.notifier.subscribers_count < len(waiting):
+                await asyncio.sleep(0.01)
+            # only the executor's ones
+            assert threading.active_count() <= threads_count + 2
+            # the event loop isn't blocked meanwhile
+            _, _, bodies = await request(app, 'POST', '/game/new')
+            assert json.loads(b''.join(bodies))['white_secret']
+
+            session_manager.make_move(white_secret, 1, 1, 1, 3)
+            responses = await asyncio.wait_for(asyncio.gather(*waiting), 5)
+            assert {status for status, _, _ in responses} == {200}
+        asyncio.run(scenario())
+
+def test_events():
+    app, session_manager = create_app()
+
+    async def scenario():
+        disconnect = asyncio.Event()
+        white_secret = json.loads(b''.join((await request(app, 'POST', '/game/new'))[2]))['white_secret']
+        streaming = asyncio.ensure_future(request(app, 'GET', f'/game/{white_secret}/events',
+                                                  disconnect=disconnect.wait()))
+        while session_manager.notifier.subscribers_count == 0:
+            await asyncio.sleep(0.01)
+        await request(app, 'POST', f'/game/{white_secret}/move/1/1/1/3')
+        await asyncio.sleep(0.05)
+        disconnect.set()
+        status, headers, bodies = await asyncio.wait_for(streaming, 1)
+        assert status == 200
+        assert headers[b'content-type'] == b'text/event-stream'
+        # the current state, then the one after the move
+        assert [body[:6] for body in bodies] == [b'id: 0\n', b'id: 1\n']
+
+        assert (await request(app, 'GET', '/game/garbage/events'))[0] == 404
+    asyncio.run(scenario())
+    assert session_manager.notifier.subscribers_count == 0
+
+def test_lifespan():
+    app, _ = create_app()
+    messages = iter([{ 'type': 'lifespan.startup' }, { 'type': 'lifespan.shutdown' }])
+    sent = []
+
+    async def receive():
+        return next(messages)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.run(app({ 'type': 'lifespan' }, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
@@ -0,0 +1,122 @@
+"""
+GameSessionsManager for asyncio code (see asgi_app.py).
+
+Methods evaluating the rules (moves, views) are run in an executor,
+so the event loop stays responsive; waiting for changes of a game
+(long-polling, pushing updates) is done on the event loop, without a thread per client.
+"""
+
+import asyncio
+from concurrent.futures import Executor
+from time import monotonic
+from typing import Any, Callable, TypeVar
+from .game_sessions_manager import GameSessionsManager, PlayerViewAndStats, PlayerViewChanges, LegalMoves
+from .async_storage import IAsyncGameSessionStorage
+from .notifications import Subscription
+from .game_session import GameSession, SecretRole
+from .game_domain.state import Piece, BoardView
+
+Result = TypeVar('Result')
+
+class AsyncSubscription:
+    """ Subscription for asyncio code: get waits on the event loop """
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._has_update = asyncio.Event()
+        self.subscription: Subscription | None = None
+
+    def on_publish(self) -> None:
+        """ Called by Subscription in the thread that published an update """
+        self._loop.call_soon_threadsafe(self._has_update.set)
+
+    async def get(self, timeout: float) -> Any:
+        """ Waits for an update, returns None if there's none in timeout seconds """
+        assert self.subscription is not None
+        deadline = monotonic() + timeout
+        while True:
+            try:
+                await asyncio.wait_for(self._has_update.wait(), max(deadline - monotonic(), 0))
+            except asyncio.TimeoutError:
+                return None
+            self._has_update.clear()
+            # may be taken already if the event was set again meanwhile
+            update = self.subscription.get(0)
+            if update is not None:
+                return update
+
+    def close(self) -> None:
+        if self.subscription is not None:
+            self.subscription.close()
+
+class AsyncGameSessionsManager:
+    """
+    Async methods of the manager (see GameSessionsManager for their description);
+    lookups that don't evaluate the rules use the async storage directly
+    """
+    def __init__(self, manager: GameSessionsManager, storage: IAsyncGameSessionStorage, executor: Executor | None = None):
+        self.manager = manager
+        self.storage = storage
+        # None means the event loop's default one
+        self.executor = executor
+
+    async def run(self, function: Callable[..., Result], *args) -> Result:
+        """ Runs the function in the executor """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def create_session(self) -> tuple[str, BoardView]:
+        return await self.run(self.manager.create_session)
+
+    async def get_join_secret(self, white_secret: str) -> str | None:
+        found = await self.storage.get_session_and_role_by_secret(white_secret)
+        if found is None or found[1] != SecretRole.white:
+            return None
+        return found[0].join_secret
+
+    async def join_session(self, join_secret: str) -> tuple[str, BoardView] | None:
+        return await self.run(self.manager.join_session, join_secret)
+
+    async def validate_move(self, secret: str, x_from: int, y_from: int, x_to: int, y_to: int) -> GameSession | None:
+        return await self.run(self.manager.validate_move, secret, x_from, y_from, x_to, y_to)
+
+    async def get_legal_moves(self, secret: str, x: int | None = None, y: int | None = None) -> LegalMoves | None:
+        return await self.run(self.manager.get_legal_moves, secret, x, y)
+
+    async def make_move(self, secret: str, x_from: int, y_from: int, x_to: int, y_to: int) -> PlayerViewAndStats | None:
+        return await self.run(self.manager.make_move, secret, x_from, y_from, x_to, y_to)
+
+    async def promote(self, secret: str, x: int, y: int, piece: Piece) -> PlayerViewAndStats | None:
+        return await self.run(self.manager.promote, secret, x, y, piece)
+
+    async def get_player_view_and_stats(self, secret: str) -> PlayerViewAndStats | None:
+        return await self.run(self.manager.get_player_view_and_stats, secret)
+
+    async def get_player_view_changes(self,
+                                      secret: str,
+                                      since_version: int) -> PlayerViewChanges | PlayerViewAndStats | None:
+        return await self.run(self.manager.get_player_view_changes, secret, since_version)
+
+    async def get_state_version(self, secret: str) -> int | None:
+        # under the session's lock: trying moves (push_move, pop_move) changes the version meanwhile
+        return await self.run(self.manager.get_state_version, secret)
+
+    async def wait_for_version_change(self, secret: str, version: int, timeout: float = 0) -> int | None:
+        current_version = await self.get_state_version(secret)
+        if current_version != version or timeout <= 0:
+            return current_version
+
+        subscription = AsyncSubscription(asyncio.get_running_loop())
+        found = await self.run(self.manager.subscribe_to_version_change, secret, version, subscription.on_publish)
+        if not isinstance(found, Subscription):
+            return found
+        subscription.subscription = found
+        try:
+            update = await subscription.get(timeout)
+        finally:
+            subscription.close()
+        # changes made by other processes don't end the wait (see GameSessionsManager.wait_for_version_change)
+        return update.version if update is not None else await self.get_state_version(secret)
+
+    async def subscribe_to_updates(self, secret: str) -> AsyncSubscription | None:
+        subscription = AsyncSubscription(asyncio.get_running_loop())
+        subscription.subscription = await self.run(self.manager.subscribe_to_updates, secret, subscription.on_publish)
+        return subscription if subscription.subscription is not None else None
@@ -0,0 +1,75 @@
+"""
+Storage of sessions for asyncio code (see asgi_app.py): same as
+IGameSessionStorage, but the methods are coroutines, so that a storage
+doing I/O can be awaited without blocking the event loop.
+"""
+
+import asyncio
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from typing import Callable, TypeVar
+from .storage import IGameSessionStorage
+from .game_session import GameSession, SecretRole
+from .locking import StripedLock
+
+Result = TypeVar('Result')
+
+class IAsyncGameSessionStorage(ABC):
+    """ An async counterpart of IGameSessionStorage (see it for the methods' description) """
+    locks: StripedLock
+
+    @abstractmethod
+    async def create_session(self) -> GameSession:
+        """ Create a new session, store and return it """
+
+    @abstractmethod
+    async def get_session_by_secret(self, secret: str) -> GameSession | None:
+        """ Find session by any secret (join, white, black) """
+
+    @abstractmethod
+    async def get_session_and_role_by_secret(self, secret: str) -> tuple[GameSession, SecretRole] | None:
+        """ Find session by any secret, tell which of its secrets it is """
+
+    @abstractmethod
+    async def get_white_secret(self, secret: str) -> str | None:
+        """ Find the session's white_secret by any secret, a cheap lookup """
+
+    @abstractmethod
+    async def clear_join_secret(self, session: GameSession) -> None:
+        """ Remove the join secret of the session, so that it can't be used anymore """
+
+    @abstractmethod
+    async def save_session(self, session: GameSession) -> None:
+        """ Store the changes of the session made after it was got """
+
+class AsyncStorageAdapter(IAsyncGameSessionStorage):
+    """
+    Makes an IGameSessionStorage async: its methods are run in the executor
+    (None means the event loop's default one). Even in-memory lookups are:
+    they wait for the storage's lock and may freeze or rehydrate sessions.
+    """
+    def __init__(self, storage: IGameSessionStorage, executor: Executor | None = None):
+        self.storage = storage
+        self.locks = storage.locks
+        self.executor = executor
+
+    async def _run(self, method: Callable[..., Result], *args) -> Result:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+
+    async def create_session(self):
+        return await self._run(self.storage.create_session)
+
+    async def get_session_by_secret(self, secret: str):
+        return await self._run(self.storage.get_session_by_secret, secret)
+
+    async def get_session_and_role_by_secret(self, secret: str):
+        return await self._run(self.storage.get_session_and_role_by_secret, secret)
+
+    async def get_white_secret(self, secret: str):
+        return await self._run(self.storage.get_white_secret, secret)
+
+    async def clear_join_secret(self, session: GameSession):
+        return await self._run(self.storage.clear_join_secret, session)
+
+    async def save_session(self, session: GameSession):
+        return await self._run(self.storage.save_session, session)
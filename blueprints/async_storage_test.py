@@ -0,0 +1,29 @@
+import asyncio
+import threading
+from .async_storage import AsyncStorageAdapter
+from .storage import GameSessionsStorage
+from .game_session import SecretRole
+
+class ThreadRecordingStorage(GameSessionsStorage):
+    def __init__(self):
+        super().__init__()
+        self.threads = set()
+
+    def get_session_and_role_by_secret(self, secret):
+        self.threads.add(threading.current_thread())
+        return super().get_session_and_role_by_secret(secret)
+
+def test_adapter():
+    storage = ThreadRecordingStorage()
+    async_storage = AsyncStorageAdapter(storage)
+    assert async_storage.locks is storage.locks
+
+    async def scenario():
+        session = await async_storage.create_session()
+        assert await async_storage.get_session_and_role_by_secret(session.join_secret) == (session, SecretRole.join)
+        assert await async_storage.get_white_secret(session.white_secret) == session.white_secret
+        await async_storage.clear_join_secret(session)
+        assert await async_storage.get_session_by_secret(session.white_secret) is session
+    asyncio.run(scenario())
+    # calls are run in the executor, not in the event loop's thread
+    assert threading.main_thread() not in storage.threads
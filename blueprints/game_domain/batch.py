@@ -0,0 +1,112 @@
+"""
+Batch engine: calculates visibility masks and check flags for many boards
+at once with vectorized NumPy operations (same rules as visibility.py
+and GameState.is_king_under_attack), so that the interpreter overhead
+is paid per operation and not per board.
+
+Boards are encoded as a dense uint8 array of shape (N, 8, 8), indexed
+[board, x, y] like Board.cells: 0 is an empty cell, Piece.value for
+white pieces and Piece.value + 6 for black ones.
+"""
+from dataclasses import dataclass
+from typing import Sequence
+import numpy as np
+from .state import GameState, Player, Piece, BoardView
+from .codec import BLACK_CODES_OFFSET
+
+KNIGHT_OFFSETS = ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))
+KING_OFFSETS = ((0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1))
+STRAIGHT_OFFSETS = ((0, 1), (1, 0), (0, -1), (-1, 0))
+DIAGONAL_OFFSETS = ((1, 1), (1, -1), (-1, -1), (-1, 1))
+
+@dataclass
+class BatchEvaluation:
+    """ Per player: visible cells (N, 8, 8) and whether their king is under attack (N,) """
+    visible: dict[Player, np.ndarray]
+    is_king_under_attack: dict[Player, np.ndarray]
+
+def encode_boards(game_states: Sequence[GameState]) -> tuple[np.ndarray, np.ndarray]:
+    """ Returns the boards (N, 8, 8) and is_waiting_for_promotion flags (N,) """
+    # unpack the bitboards of each (player, piece) pair into (N, 12, 8, 8) bits indexed [.., y, x]
+    bitboards = np.array([
+        [game_state.get_board().bitboards[player][piece] for player in Player for piece in Piece]
+        for game_state in game_states
+    ], dtype=np.uint64).reshape(len(game_states), 12)
+    # bytes of the bitboards from the lowest, whatever the byte order of the machine
+    bits = np.unpackbits(bitboards.astype('<u8', copy=False).view(np.uint8), bitorder='little') \
+        .reshape(len(game_states), 12, 8, 8) \
+        .transpose(0, 1, 3, 2)
+    piece_codes = np.array([piece.value for piece in Piece] +
+                           [piece.value + BLACK_CODES_OFFSET for piece in Piece], dtype=np.uint8)
+    codes = np.einsum('npxy,p->nxy', bits, piece_codes).astype(np.uint8)
+
+    is_waiting_for_promotion = np.array(
+        [game_state.is_waiting_for_promotion for game_state in game_states], dtype=bool)
+    return codes, is_waiting_for_promotion
+
+def _shift(planes: np.ndarray, dx: int, dy: int) -> np.ndarray:
+    """ Moves the contents of (N, 8, 8) planes by (dx, dy), what gets off the board is dropped """
+    shifted = np.zeros_like(planes)
+    shifted[:, max(dx, 0):8 + min(dx, 0), max(dy, 0):8 + min(dy, 0)] = \
+        planes[:, max(-dx, 0):8 + min(-dx, 0), max(-dy, 0):8 + min(-dy, 0)]
+    return shifted
+
+def _sliding_attacks(sliders: np.ndarray, empty: np.ndarray, offsets) -> np.ndarray:
+    attacks = np.zeros_like(sliders)
+    for dx, dy in offsets:
+        ray = _shift(sliders, dx, dy)
+        while ray.any():
+            attacks |= ray
+            ray = _shift(ray & empty, dx, dy)
+    return attacks
+
+def _attacks(pieces: dict[Piece, np.ndarray], empty: np.ndarray, forward: int) -> np.ndarray:
+    attacks = _shift(pieces[Piece.pawn], 1, forward) | _shift(pieces[Piece.pawn], -1, forward)
+    for dx, dy in KNIGHT_OFFSETS:
+        attacks |= _shift(pieces[Piece.knight], dx, dy)
+    for dx, dy in KING_OFFSETS:
+        attacks |= _shift(pieces[Piece.king], dx, dy)
+    attacks |= _sliding_attacks(pieces[Piece.rook] | pieces[Piece.queen], empty, STRAIGHT_OFFSETS)
+    attacks |= _sliding_attacks(pieces[Piece.bishop] | pieces[Piece.queen], empty, DIAGONAL_OFFSETS)
+    return attacks
+
+def evaluate_boards(codes: np.ndarray, is_waiting_for_promotion: np.ndarray) -> BatchEvaluation:
+    """ Calculates visibility and check flags for both players on all the given boards """
+    empty = codes == 0
+    pieces: dict[Player, dict[Piece, np.ndarray]] = {
+        Player.white: { piece: codes == piece.value for piece in Piece },
+        Player.black: { piece: codes == piece.value + BLACK_CODES_OFFSET for piece in Piece },
+    }
+    attacked = {
+        player: _attacks(pieces[player], empty, 1 if player == Player.white else -1)
+        for player in Player
+    }
+
+    visible: dict[Player, np.ndarray] = {}
+    is_king_under_attack: dict[Player, np.ndarray] = {}
+    can_move = ~is_waiting_for_promotion[:, None, None]
+    for player in Player:
+        opponent = Player.black if player == Player.white else Player.white
+        forward = 1 if player == Player.white else -1
+        own = (codes > 0) & ((codes > BLACK_CODES_OFFSET) == (player == Player.black))
+        pawns = pieces[player][Piece.pawn]
+
+        sideways = _shift(pawns, 1, 0) | _shift(pawns, -1, 0)
+        pawns_sight = sideways | _shift(pawns | sideways, 0, forward)
+        # the double step from the start row, unless the cell in between is occupied
+        start_row_pawns = np.zeros_like(pawns)
+        start_row = 1 if player == Player.white else 6
+        start_row_pawns[:, :, start_row] = pawns[:, :, start_row]
+        double_steps = _shift(_shift(start_row_pawns, 0, forward) & empty, 0, forward) & empty
+
+        visible[player] = own | pawns_sight | can_move & (attacked[player] | double_steps)
+        is_king_under_attack[player] = (pieces[player][Piece.king] & attacked[opponent]).any(axis=(1, 2))
+
+    return BatchEvaluation(visible, is_king_under_attack)
+
+def to_board_views(game_states: Sequence[GameState], visible: np.ndarray) -> list[BoardView]:
+    """ Builds BoardView-s of the given states from the visibility masks of a player """
+    views: list[BoardView] = [game_state.get_board().cells for game_state in game_states]
+    for index, x, y in zip(*(coordinates.tolist() for coordinates in np.nonzero(~visible))):
+        views[index][x][y] = 'is_dark'
+    return views
@@ -0,0 +1,47 @@
+import random
+from copy import deepcopy
+import pytest
+from .state import GameState, Player, Piece
+
+np = pytest.importorskip('numpy')
+from .batch import encode_boards, evaluate_boards, to_board_views
+
+def play_random_games(games_number: int, moves_number: int) -> list[GameState]:
+    """ Collects states along random games, including pending promotions """
+    randomizer = random.Random(0)
+    game_states: list[GameState] = []
+    for _ in range(games_number):
+        game_state = GameState()
+        for _ in range(moves_number):
+            moves = game_state.generate_legal_moves(game_state.get_whos_turn())
+            if not moves:
+                break
+            game_state.make_move(*randomizer.choice(moves))
+            snapshot = GameState(game_state.get_whos_turn(), deepcopy(game_state.get_board()))
+            snapshot.is_waiting_for_promotion = game_state.is_waiting_for_promotion
+            game_states.append(snapshot)
+            if game_state.is_waiting_for_promotion:
+                x, y = next((x, y) for x in range(8) for y in (0, 7)
+                            if (cell := game_state.get_board().get(x, y)) is not None
+                            and cell.piece == Piece.pawn)
+                game_state.promote(game_state.get_whos_turn(), x, y, Piece.queen)
+    return game_states
+
+def test_evaluate_boards_same_as_game_state():
+    game_states = play_random_games(6, 80)
+    evaluation = evaluate_boards(*encode_boards(game_states))
+
+    for player in Player:
+        views = to_board_views(game_states, evaluation.visible[player])
+        for index, game_state in enumerate(game_states):
+            assert views[index] == game_state.get_board_view(player)
+            assert bool(evaluation.is_king_under_attack[player][index]) is \
+                game_state.is_king_under_attack(player)
+
+def test_encode_boards():
+    codes, is_waiting_for_promotion = encode_boards([GameState()])
+    assert codes.shape == (1, 8, 8)
+    assert codes[0, 3, 0] == Piece.king.value
+    assert codes[0, 3, 7] == Piece.king.value + 6
+    assert codes[0, 3, 3] == 0
+    assert not is_waiting_for_promotion[0]
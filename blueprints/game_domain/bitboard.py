@@ -0,0 +1,101 @@
+"""
+Bitboard primitives: a set of cells is stored as a 64-bit int,
+where bit number (y * 8 + x) stands for the cell (x, y).
+
+So shifting by 8 moves a set one row up (towards blacks),
+shifting by 1 moves it one column right; file masks prevent
+wrapping around the board edges.
+"""
+from typing import Iterator
+
+FULL = (1 << 64) - 1
+FILE_A = 0x0101010101010101  # x == 0
+FILE_H = FILE_A << 7         # x == 7
+NOT_FILE_A = FULL ^ FILE_A
+NOT_FILE_H = FULL ^ FILE_H
+NOT_FILE_AB = NOT_FILE_A & (FULL ^ (FILE_A << 1))
+NOT_FILE_GH = NOT_FILE_H & (FULL ^ (FILE_H >> 1))
+
+def square(x: int, y: int) -> int:
+    """ Index of the cell's bit """
+    return y * 8 + x
+
+def bit(x: int, y: int) -> int:
+    """ Bitboard with just the given cell """
+    return 1 << (y * 8 + x)
+
+def coordinates(square_index: int) -> tuple[int, int]:
+    """ (x, y) of the cell by its bit index """
+    return square_index & 7, square_index >> 3
+
+def iterate_squares(bitboard: int) -> Iterator[int]:
+    """ Yields indices of the set bits, from the lowest one """
+    while bitboard:
+        lowest = bitboard & -bitboard
+        yield lowest.bit_length() - 1
+        bitboard ^= lowest
+
+def north(bitboard: int) -> int:
+    """ Shift by (0, +1) """
+    return (bitboard << 8) & FULL
+def south(bitboard: int) -> int:
+    """ Shift by (0, -1) """
+    return bitboard >> 8
+def east(bitboard: int) -> int:
+    """ Shift by (+1, 0) """
+    return (bitboard << 1) & NOT_FILE_A & FULL
+def west(bitboard: int) -> int:
+    """ Shift by (-1, 0) """
+    return (bitboard >> 1) & NOT_FILE_H
+def north_east(bitboard: int) -> int:
+    """ Shift by (+1, +1) """
+    return (bitboard << 9) & NOT_FILE_A & FULL
+def north_west(bitboard: int) -> int:
+    """ Shift by (-1, +1) """
+    return (bitboard << 7) & NOT_FILE_H & FULL
+def south_east(bitboard: int) -> int:
+    """ Shift by (+1, -1) """
+    return (bitboard >> 7) & NOT_FILE_A
+def south_west(bitboard: int) -> int:
+    """ Shift by (-1, -1) """
+    return (bitboard >> 9) & NOT_FILE_H
+
+STRAIGHT_SHIFTS = (north, south, east, west)
+DIAGONAL_SHIFTS = (north_east, north_west, south_east, south_west)
+
+def knight_attacks(bitboard: int) -> int:
+    """ Cells attacked by knights standing on the given cells """
+    return (
+        (bitboard << 17) & NOT_FILE_A |
+        (bitboard << 15) & NOT_FILE_H |
+        (bitboard << 10) & NOT_FILE_AB |
+        (bitboard << 6) & NOT_FILE_GH |
+        (bitboard >> 17) & NOT_FILE_H |
+        (bitboard >> 15) & NOT_FILE_A |
+        (bitboard >> 10) & NOT_FILE_GH |
+        (bitboard >> 6) & NOT_FILE_AB
+    ) & FULL
+
+def king_attacks(bitboard: int) -> int:
+    """ Cells attacked by kings standing on the given cells """
+    sideways = bitboard | east(bitboard) | west(bitboard)
+    return (sideways | north(sideways) | south(sideways)) ^ bitboard
+
+def pawn_attacks(bitboard: int, is_white: bool) -> int:
+    """ Cells attacked (diagonally forward) by pawns standing on the given cells """
+    if is_white:
+        return north_east(bitboard) | north_west(bitboard)
+    return south_east(bitboard) | south_west(bitboard)
+
+def sliding_attacks(bitboard: int, occupied: int, shifts) -> int:
+    """
+    Cells attacked by sliding pieces standing on the given cells along the given directions:
+    each ray goes until it hits an occupied cell (that cell is included)
+    """
+    attacks = 0
+    for shift in shifts:
+        ray = shift(bitboard)
+        while ray:
+            attacks |= ray
+            ray = shift(ray & ~occupied)
+    return attacks
@@ -0,0 +1,37 @@
+from .bitboard import (
+    bit,
+    iterate_squares,
+    square,
+    knight_attacks,
+    king_attacks,
+    pawn_attacks,
+    sliding_attacks,
+    STRAIGHT_SHIFTS,
+    DIAGONAL_SHIFTS,
+)
+
+def cells_of(bitboard: int) -> set[tuple[int, int]]:
+    return { (index & 7, index >> 3) for index in iterate_squares(bitboard) }
+
+def test_iterate_squares():
+    assert list(iterate_squares(bit(0, 0) | bit(7, 7) | bit(3, 2))) == \
+        [0, square(3, 2), 63]
+    assert list(iterate_squares(0)) == []
+
+def test_attacks_dont_wrap_around_edges():
+    assert cells_of(knight_attacks(bit(0, 0))) == { (1, 2), (2, 1) }
+    assert cells_of(knight_attacks(bit(7, 4))) == { (6, 6), (5, 5), (5, 3), (6, 2) }
+    assert cells_of(king_attacks(bit(7, 7))) == { (6, 7), (6, 6), (7, 6) }
+    assert cells_of(pawn_attacks(bit(0, 1), True)) == { (1, 2) }
+    assert cells_of(pawn_attacks(bit(7, 6), False)) == { (6, 5) }
+
+def test_sliding_attacks_stop_at_occupied_cells():
+    # rook on (0, 0), blockers on (0, 3) and (2, 0)
+    occupied = bit(0, 0) | bit(0, 3) | bit(2, 0)
+    assert cells_of(sliding_attacks(bit(0, 0), occupied, STRAIGHT_SHIFTS)) == \
+        { (0, 1), (0, 2), (0, 3), (1, 0), (2, 0) }
+
+    # bishop on (2, 0), blocker on (4, 2)
+    occupied = bit(2, 0) | bit(4, 2)
+    assert cells_of(sliding_attacks(bit(2, 0), occupied, DIAGONAL_SHIFTS)) == \
+        { (1, 1), (0, 2), (3, 1), (4, 2) }
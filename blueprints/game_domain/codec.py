@@ -0,0 +1,150 @@
+"""
+Compact binary encoding of a GameState, for storage and transfer
+(about 34 bytes instead of a few kilobytes of JSON):
+
+- 32 bytes: 4 bits per cell, in the order of bit indices (see bitboard.square),
+  the lower half of a byte goes first; 0 is an empty cell, Piece.value for
+  white pieces and Piece.value + 6 for black ones (like in batch.py);
+- 1 byte of flags: whether it's black's turn and whether a promotion is pending;
+- the state's version as a varint (7 bits per byte, lower ones first).
+
+Board views are encoded the same way (32 bytes), with DARK_CODE for dark cells.
+"""
+from .bitboard import square, coordinates, iterate_squares
+from .state import GameState, Board, Player, Piece, PlayerPiece, BoardView, BoardViewCell
+
+BLACK_CODES_OFFSET = 6
+DARK_CODE = 15
+BOARD_SIZE = 32
+
+BLACKS_TURN_FLAG = 1
+WAITING_FOR_PROMOTION_FLAG = 2
+
+_PLAYER_PIECES_BY_CODE: dict[int, PlayerPiece] = {
+    piece.value + (BLACK_CODES_OFFSET if player == Player.black else 0): PlayerPiece(player, piece)
+    for player in Player
+    for piece in Piece
+}
+_CODES_BY_PLAYER_PIECE = { player_piece: code for code, player_piece in _PLAYER_PIECES_BY_CODE.items() }
+
+def _encode_varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def _decode_varint(data: bytes, offset: int) -> int:
+    value = 0
+    shift = 0
+    for byte in data[offset:]:
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value
+        shift += 7
+    raise ValueError('truncated varint')
+
+def encode_board(board: Board) -> bytes:
+    """ 32 bytes, 4 bits per cell """
+    encoded = bytearray(BOARD_SIZE)
+    for player in Player:
+        for piece, bitboard in board.bitboards[player].items():
+            code = piece.value + (BLACK_CODES_OFFSET if player == Player.black else 0)
+            for square_index in iterate_squares(bitboard):
+                encoded[square_index >> 1] |= code << ((square_index & 1) << 2)
+    return bytes(encoded)
+
+def decode_board(data: bytes) -> Board:
+    """ Inverse of encode_board """
+    if len(data) != BOARD_SIZE:
+        raise ValueError(f'a board is encoded in {BOARD_SIZE} bytes, got {len(data)}')
+    positions: list[tuple[Player, Piece, int, int]] = []
+    for index, byte in enumerate(data):
+        for square_index, code in ((index << 1, byte & 0x0F), (index << 1 | 1, byte >> 4)):
+            if not code:
+                continue
+            player_piece = _PLAYER_PIECES_BY_CODE.get(code)
+            if player_piece is None:
+                raise ValueError(f'unknown cell code {code}')
+            positions.append((player_piece.player, player_piece.piece, *coordinates(square_index)))
+
+    # Board uses the start position when there are no pieces
+    return Board(positions=positions) if positions else Board.empty()
+
+def encode_state(game_state: GameState) -> bytes:
+    """ Encodes the board, whose turn it is, whether a promotion is pending and the version """
+    flags = (BLACKS_TURN_FLAG if game_state.get_whos_turn() == Player.black else 0) | \
+            (WAITING_FOR_PROMOTION_FLAG if game_state.is_waiting_for_promotion else 0)
+    return encode_board(game_state.get_board()) + bytes((flags,)) + _encode_varint(game_state.version)
+
+def decode_state(data: bytes) -> GameState:
+    """ Inverse of encode_state """
+    if len(data) < BOARD_SIZE + 2:
+        raise ValueError(f'an encoded state has at least {BOARD_SIZE + 2} bytes, got {len(data)}')
+    flags = data[BOARD_SIZE]
+    game_state = GameState(Player.black if flags & BLACKS_TURN_FLAG else Player.white,
+                           decode_board(data[:BOARD_SIZE]))
+    game_state.is_waiting_for_promotion = bool(flags & WAITING_FOR_PROMOTION_FLAG)
+    game_state.version = _decode_varint(data, BOARD_SIZE + 1)
+    return game_state
+
+def unpack_state(data: bytes) -> tuple[list[int], bool, bool, int]:
+    """
+    Codes of the 64 cells (by bit index), whether it's black's turn,
+    whether a promotion is pending and the version, without building a GameState
+    (e.g. to apply moves to a stored state quickly)
+    """
+    cells: list[int] = []
+    for byte in data[:BOARD_SIZE]:
+        cells.append(byte & 0x0F)
+        cells.append(byte >> 4)
+    flags = data[BOARD_SIZE]
+    return (cells,
+            bool(flags & BLACKS_TURN_FLAG),
+            bool(flags & WAITING_FOR_PROMOTION_FLAG),
+            _decode_varint(data, BOARD_SIZE + 1))
+
+def pack_state(cells: list[int], is_blacks_turn: bool, is_waiting_for_promotion: bool, version: int) -> bytes:
+    """ Inverse of unpack_state """
+    flags = (BLACKS_TURN_FLAG if is_blacks_turn else 0) | \
+            (WAITING_FOR_PROMOTION_FLAG if is_waiting_for_promotion else 0)
+    return bytes(cells[index] | cells[index + 1] << 4 for index in range(0, 64, 2)) + \
+        bytes((flags,)) + _encode_varint(version)
+
+def encode_board_view_cell(cell: BoardViewCell) -> int:
+    """ The 4 bit code of a cell of a board view """
+    if cell is None:
+        return 0
+    return DARK_CODE if cell == 'is_dark' else _CODES_BY_PLAYER_PIECE[cell]
+
+def encode_board_view(view: BoardView) -> bytes:
+    """ 32 bytes, 4 bits per cell (DARK_CODE for dark ones) """
+    encoded = bytearray(BOARD_SIZE)
+    for x, column in enumerate(view):
+        for y, cell in enumerate(column):
+            if cell is None:
+                continue
+            code = encode_board_view_cell(cell)
+            square_index = square(x, y)
+            encoded[square_index >> 1] |= code << ((square_index & 1) << 2)
+    return bytes(encoded)
+
+def decode_board_view(data: bytes) -> BoardView:
+    """ Inverse of encode_board_view """
+    if len(data) != BOARD_SIZE:
+        raise ValueError(f'a board view is encoded in {BOARD_SIZE} bytes, got {len(data)}')
+    view: BoardView = [[None] * 8 for _ in range(8)]
+    for square_index in range(64):
+        code = data[square_index >> 1] >> ((square_index & 1) << 2) & 0x0F
+        if not code:
+            continue
+        x, y = coordinates(square_index)
+        if code == DARK_CODE:
+            view[x][y] = 'is_dark'
+            continue
+        player_piece = _PLAYER_PIECES_BY_CODE.get(code)
+        if player_piece is None:
+            raise ValueError(f'unknown cell code {code}')
+        view[x][y] = player_piece
+    return view
@@ -0,0 +1,79 @@
+from random import Random
+import pytest
+from .codec import (
+    encode_state,
+    decode_state,
+    encode_board,
+    decode_board,
+    encode_board_view,
+    decode_board_view,
+)
+from .state import GameState, Board, Player, Piece, PlayerPiece
+from ..serialization import to_json
+
+def test_encode_state():
+    game_state = GameState()
+    encoded = encode_state(game_state)
+    assert len(encoded) == 34
+
+    decoded = decode_state(encoded)
+    assert to_json(decoded) == to_json(game_state)
+    assert decoded.get_position_hash() == game_state.get_position_hash()
+
+def _assert_decoded_equal(game_state: GameState):
+    decoded = decode_state(encode_state(game_state))
+    assert to_json(decoded) == to_json(game_state)
+    assert decoded.get_position_hash() == game_state.get_position_hash()
+    for player in Player:
+        assert decoded.get_board().get_attacked_cells(player) == \
+            game_state.get_board().get_attacked_cells(player)
+
+def test_encode_state_of_random_games():
+    random = Random(13)
+    for _ in range(5):
+        game_state = GameState()
+        for _ in range(120):
+            moves = game_state.generate_legal_moves(game_state.get_whos_turn())
+            if not moves:
+                break
+            x_from, y_from, x_to, y_to = random.choice(moves)
+            game_state.make_move(x_from, y_from, x_to, y_to)
+            _assert_decoded_equal(game_state)
+            if game_state.is_waiting_for_promotion:
+                game_state.promote(game_state.get_whos_turn(), x_to, y_to, Piece.queen)
+                _assert_decoded_equal(game_state)
+
+def test_encode_version():
+    game_state = GameState()
+    game_state.version = 300
+    encoded = encode_state(game_state)
+    assert len(encoded) == 35
+    assert decode_state(encoded).version == 300
+
+def test_encode_empty_board():
+    board = Board.empty()
+    assert board.cells == [[None] * 8 for _ in range(8)]
+    assert board.zobrist_hash == 0
+    assert encode_board(board) == bytes(32)
+    assert decode_board(bytes(32)).get_occupied() == 0
+    board.put(0, 0, PlayerPiece(Player.white, Piece.king))
+    assert decode_board(encode_board(board)).cells == board.cells
+
+def test_decode_invalid_data():
+    with pytest.raises(ValueError):
+        decode_state(bytes(10))
+    with pytest.raises(ValueError):
+        decode_board(bytes([0xDD] * 32))
+    with pytest.raises(ValueError):
+        decode_state(bytes(32) + bytes([0, 0x80]))
+
+def test_encode_board_view():
+    game_state = GameState(board_position=Board(positions=[
+        (Player.white, Piece.king, 4, 0),
+        (Player.white, Piece.pawn, 1, 6),
+        (Player.black, Piece.king, 4, 7),
+        (Player.black, Piece.rook, 0, 7),
+    ]))
+    for player in Player:
+        view = game_state.get_board_view(player)
+        assert to_json(decode_board_view(encode_board_view(view))) == to_json(view)
@@ -0,0 +1,329 @@
+"""
+Perft: counts the leaves of the tree of legal moves to a given depth,
+a standard way to check a move generator and to measure its speed.
+
+Under this game's rules there's no castling and no en passant, and a pawn
+that reaches the last row makes the game wait for a promotion: each move
+to the last row counts as 4 nodes, one per piece it can promote into
+(like promotions in the standard perft).
+
+The same tree walk is used for differential checks: at each node an engine
+(anything that summarizes a GameState into a PositionSummary) is compared
+with the reference one: brute force over a copy of the original coordinate
+arithmetic rules, sharing no code with the engine.
+
+Run `python -m blueprints.game_domain.perft [depth]` for a benchmark.
+"""
+import sys
+from copy import deepcopy
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Callable
+from .state import GameState, Board, Player, Piece, PlayerPiece, BoardView
+
+Move = tuple[int, int, int, int]
+
+PROMOTION_PIECES = (Piece.queen, Piece.rook, Piece.bishop, Piece.knight)
+
+def _position(whos_turn: Player, positions: list[tuple[Player, Piece, int, int]]) -> Callable[[], GameState]:
+    return lambda: GameState(whos_turn, Board(positions=positions))
+
+REFERENCE_POSITIONS: dict[str, Callable[[], GameState]] = {
+    'initial': GameState,
+    'middlegame': _position(Player.white, [
+        (Player.white, Piece.king, 6, 0),
+        (Player.white, Piece.queen, 3, 2),
+        (Player.white, Piece.rook, 0, 0),
+        (Player.white, Piece.rook, 5, 0),
+        (Player.white, Piece.bishop, 2, 3),
+        (Player.white, Piece.knight, 5, 2),
+        (Player.white, Piece.pawn, 0, 1),
+        (Player.white, Piece.pawn, 1, 1),
+        (Player.white, Piece.pawn, 4, 3),
+        (Player.white, Piece.pawn, 6, 1),
+        (Player.white, Piece.pawn, 7, 1),
+        (Player.black, Piece.king, 6, 7),
+        (Player.black, Piece.queen, 3, 7),
+        (Player.black, Piece.rook, 0, 7),
+        (Player.black, Piece.rook, 5, 7),
+        (Player.black, Piece.bishop, 1, 4),
+        (Player.black, Piece.knight, 2, 5),
+        (Player.black, Piece.pawn, 0, 6),
+        (Player.black, Piece.pawn, 1, 6),
+        (Player.black, Piece.pawn, 3, 5),
+        (Player.black, Piece.pawn, 4, 5),
+        (Player.black, Piece.pawn, 6, 6),
+        (Player.black, Piece.pawn, 7, 6),
+    ]),
+    'promotions': _position(Player.white, [
+        (Player.white, Piece.king, 4, 0),
+        (Player.white, Piece.pawn, 1, 6),
+        (Player.white, Piece.pawn, 6, 6),
+        (Player.white, Piece.rook, 7, 0),
+        (Player.black, Piece.king, 4, 7),
+        (Player.black, Piece.pawn, 2, 1),
+        (Player.black, Piece.knight, 0, 7),
+        (Player.black, Piece.rook, 7, 7),
+    ]),
+    'check': _position(Player.black, [
+        (Player.white, Piece.king, 0, 0),
+        (Player.white, Piece.queen, 4, 3),
+        (Player.white, Piece.bishop, 1, 4),
+        (Player.black, Piece.king, 4, 7),
+        (Player.black, Piece.pawn, 3, 6),
+        (Player.black, Piece.knight, 6, 7),
+        (Player.black, Piece.bishop, 5, 7),
+    ]),
+}
+
+def _is_promoting(game_state: GameState, move: Move) -> bool:
+    x_from, y_from, _, y_to = move
+    player_piece = game_state.get_board().get(x_from, y_from)
+    return player_piece is not None and player_piece.piece == Piece.pawn and y_to in (0, 7)
+
+def _promoted_states(game_state: GameState, x: int, y: int) -> list[GameState]:
+    """ States after each possible promotion (promotions can't be taken back, so copies are made) """
+    promoted_states = []
+    for piece in PROMOTION_PIECES:
+        promoted_state = deepcopy(game_state)
+        promoted_state.promote(promoted_state.get_whos_turn(), x, y, piece)
+        promoted_states.append(promoted_state)
+    return promoted_states
+
+def perft(game_state: GameState, depth: int) -> int:
+    """ Number of leaf nodes of the tree of legal moves (and promotions) of the given depth """
+    if depth == 0:
+        return 1
+    moves = game_state.generate_legal_moves(game_state.get_whos_turn())
+    if depth == 1:
+        return sum(len(PROMOTION_PIECES) if _is_promoting(game_state, move) else 1 for move in moves)
+
+    nodes = 0
+    for move in moves:
+        game_state.push_move(*move)
+        if game_state.is_waiting_for_promotion:
+            nodes += sum(perft(promoted_state, depth - 1)
+                         for promoted_state in _promoted_states(game_state, move[2], move[3]))
+        else:
+            nodes += perft(game_state, depth - 1)
+        game_state.pop_move()
+    return nodes
+
+def divide(game_state: GameState, depth: int) -> dict[Move, int]:
+    """ perft split by the first move, to find where two move generators disagree """
+    result: dict[Move, int] = {}
+    for move in game_state.generate_legal_moves(game_state.get_whos_turn()):
+        game_state.push_move(*move)
+        if game_state.is_waiting_for_promotion:
+            result[move] = sum(perft(promoted_state, depth - 1)
+                               for promoted_state in _promoted_states(game_state, move[2], move[3]))
+        else:
+            result[move] = perft(game_state, depth - 1)
+        game_state.pop_move()
+    return result
+
+@dataclass
+class PositionSummary:
+    """ Everything an engine derives from a position, to compare engines """
+    legal_moves: set[Move]
+    board_views: dict[Player, BoardView]
+    is_king_under_attack: dict[Player, bool]
+    is_checkmated: bool
+    is_stalemated: bool
+
+Engine = Callable[[GameState], PositionSummary]
+
+def summarize(game_state: GameState) -> PositionSummary:
+    """ Summary by GameState itself (move generation, attack maps, caches) """
+    whos_turn = game_state.get_whos_turn()
+    return PositionSummary(
+        set(game_state.generate_legal_moves(whos_turn)),
+        { player: game_state.get_board_view(player) for player in Player },
+        { player: game_state.is_king_under_attack(player) for player in Player },
+        game_state.is_checkmated(whos_turn),
+        game_state.is_stalemated(whos_turn))
+
+# The reference rules: the original coordinate arithmetic over a plain 8x8 list of cells
+# (copied here, so they share no code with GameState: tables, attack maps, push_move)
+
+Cells = list[list[PlayerPiece | None]]
+
+def _is_empty_path(cells: Cells, x_from: int, y_from: int, x_to: int, y_to: int) -> bool:
+    """ Cells strictly between two cells on a line or a diagonal are empty """
+    step_x = (x_to > x_from) - (x_to < x_from)
+    step_y = (y_to > y_from) - (y_to < y_from)
+    x, y = x_from + step_x, y_from + step_y
+    while (x, y) != (x_to, y_to):
+        if cells[x][y] is not None:
+            return False
+        x, y = x + step_x, y + step_y
+    return True
+
+def _can_reach(cells: Cells, x_from: int, y_from: int, x_to: int, y_to: int) -> bool:
+    """ Whether the piece can go to the cell by its geometry (the king's safety isn't checked) """
+    cell_from, cell_to = cells[x_from][y_from], cells[x_to][y_to]
+    if cell_from is None or (x_from, y_from) == (x_to, y_to) or \
+       cell_to is not None and cell_to.player == cell_from.player:
+        return False
+    dx, dy = x_to - x_from, y_to - y_from
+    piece = cell_from.piece
+    if piece == Piece.knight:
+        return {abs(dx), abs(dy)} == {1, 2}
+    if piece == Piece.king:
+        return abs(dx) <= 1 and abs(dy) <= 1
+    if piece == Piece.pawn:
+        forward = 1 if cell_from.player == Player.white else -1
+        start_row = 1 if cell_from.player == Player.white else 6
+        if dx == 0:
+            return cell_to is None and (dy == forward or
+                                        dy == 2 * forward and y_from == start_row and
+                                        cells[x_from][y_from + forward] is None)
+        return abs(dx) == 1 and dy == forward and cell_to is not None
+    is_straight = dx == 0 or dy == 0
+    is_diagonal = abs(dx) == abs(dy)
+    if piece == Piece.rook and not is_straight or \
+       piece == Piece.bishop and not is_diagonal or \
+       piece == Piece.queen and not (is_straight or is_diagonal):
+        return False
+    return _is_empty_path(cells, x_from, y_from, x_to, y_to)
+
+def _is_attacked(cells: Cells, x: int, y: int, attacker: Player) -> bool:
+    """ Whether any of the attacker's pieces could capture in the cell (pawns only diagonally) """
+    target = cells[x][y]
+    for x_from in range(8):
+        for y_from in range(8):
+            player_piece = cells[x_from][y_from]
+            if player_piece is None or player_piece.player != attacker:
+                continue
+            if player_piece.piece == Piece.pawn:
+                forward = 1 if attacker == Player.white else -1
+                if abs(x - x_from) == 1 and y - y_from == forward and \
+                   (target is None or target.player != attacker):
+                    return True
+            elif _can_reach(cells, x_from, y_from, x, y):
+                return True
+    return False
+
+def _is_king_attacked(cells: Cells, king_owner: Player) -> bool:
+    opponent = Player.black if king_owner == Player.white else Player.white
+    return any(player_piece is not None and player_piece.player == king_owner and player_piece.piece == Piece.king and
+               _is_attacked(cells, x, y, opponent)
+               for x, column in enumerate(cells)
+               for y, player_piece in enumerate(column))
+
+def _reference_legal_moves(cells: Cells, whos_turn: Player) -> set[Move]:
+    moves = set()
+    for x_from in range(8):
+        for y_from in range(8):
+            player_piece = cells[x_from][y_from]
+            if player_piece is None or player_piece.player != whos_turn:
+                continue
+            for x_to in range(8):
+                for y_to in range(8):
+                    if not _can_reach(cells, x_from, y_from, x_to, y_to):
+                        continue
+                    after_move = [column[:] for column in cells]
+                    after_move[x_to][y_to], after_move[x_from][y_from] = player_piece, None
+                    if not _is_king_attacked(after_move, whos_turn):
+                        moves.add((x_from, y_from, x_to, y_to))
+    return moves
+
+def _reference_board_view(cells: Cells, player: Player, can_move: bool) -> BoardView:
+    """ The board view by definition: checks each cell against each piece of the player """
+    view: BoardView = [column[:] for column in cells]
+    forward = 1 if player == Player.white else -1
+    pieces = [(x, y, player_piece)
+              for x, column in enumerate(cells)
+              for y, player_piece in enumerate(column)
+              if player_piece is not None and player_piece.player == player]
+    for x in range(8):
+        for y in range(8):
+            is_visible = any(
+                x_from == x and y_from == y or
+                player_piece.piece == Piece.pawn and abs(x_from - x) <= 1 and y - y_from in (0, forward) or
+                can_move and _can_reach(cells, x_from, y_from, x, y)
+                for x_from, y_from, player_piece in pieces)
+            if not is_visible:
+                view[x][y] = 'is_dark'
+    return view
+
+def summarize_by_reference(game_state: GameState) -> PositionSummary:
+    """ Summary by brute force over all the moves with the reference rules (only the cells are taken from the state) """
+    cells = game_state.get_board().cells
+    whos_turn = game_state.get_whos_turn()
+    can_move = not game_state.is_waiting_for_promotion
+    legal_moves = _reference_legal_moves(cells, whos_turn) if can_move else set()
+    is_king_under_attack = { player: _is_king_attacked(cells, player) for player in Player }
+    can_finish = can_move and not legal_moves
+    return PositionSummary(
+        legal_moves,
+        { player: _reference_board_view(cells, player, can_move) for player in Player },
+        is_king_under_attack,
+        can_finish and is_king_under_attack[whos_turn],
+        can_finish and not is_king_under_attack[whos_turn])
+
+@dataclass
+class Difference:
+    """ Where (after which moves from the root) and in what the engine differs from the reference """
+    moves: list[Move]
+    field: str
+    expected: object
+    actual: object
+
+def find_differences(game_state: GameState,
+                     depth: int,
+                     engine: Engine = summarize,
+                     reference: Engine = summarize_by_reference) -> list[Difference]:
+    """ Compares the engine with the reference at each node of the perft tree of the given depth """
+    differences: list[Difference] = []
+
+    def visit(game_state: GameState, depth: int, moves: list[Move]) -> None:
+        expected = reference(game_state)
+        actual = engine(game_state)
+        for field in PositionSummary.__dataclass_fields__:
+            if getattr(expected, field) != getattr(actual, field):
+                differences.append(Difference(moves, field, getattr(expected, field), getattr(actual, field)))
+        if depth == 0:
+            return
+
+        # walking the tree of the reference
+        for move in sorted(expected.legal_moves):
+            game_state.push_move(*move)
+            if game_state.is_waiting_for_promotion:
+                for promoted_state in _promoted_states(game_state, move[2], move[3]):
+                    visit(promoted_state, depth - 1, moves + [move])
+                # a pending promotion is a node, too
+                visit(game_state, 0, moves + [move])
+            else:
+                visit(game_state, depth - 1, moves + [move])
+            game_state.pop_move()
+
+    visit(game_state, depth, [])
+    return differences
+
+@dataclass
+class PerftResult:
+    position: str
+    depth: int
+    nodes: int
+    seconds: float
+
+    @property
+    def nodes_per_second(self) -> float:
+        return self.nodes / self.seconds if self.seconds else float('inf')
+
+def run_benchmark(depth: int,
+                  positions: dict[str, Callable[[], GameState]] = REFERENCE_POSITIONS) -> list[PerftResult]:
+    """ Runs perft of the given depth for each position, measuring the time """
+    results = []
+    for name, create_position in positions.items():
+        game_state = create_position()
+        started_at = perf_counter()
+        nodes = perft(game_state, depth)
+        results.append(PerftResult(name, depth, nodes, perf_counter() - started_at))
+    return results
+
+if __name__ == '__main__':
+    for result in run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 3):
+        print(f'{result.position:>12}  depth {result.depth}  {result.nodes:>10} nodes  '
+              f'{result.seconds:8.3f} s  {result.nodes_per_second:>10,.0f} nodes/s')
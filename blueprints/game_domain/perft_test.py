@@ -0,0 +1,53 @@
+import pytest
+from .perft import (
+    REFERENCE_POSITIONS,
+    perft,
+    divide,
+    find_differences,
+    summarize,
+    run_benchmark,
+)
+from .state import GameState, Player
+
+def test_perft():
+    # same as the standard perft (there's no castling, en passant or promotion that early)
+    assert [perft(GameState(), depth) for depth in range(4)] == [1, 20, 400, 8902]
+    assert [perft(REFERENCE_POSITIONS['promotions'](), depth) for depth in range(3)] == [1, 29, 362]
+    assert [perft(REFERENCE_POSITIONS['check'](), depth) for depth in range(3)] == [1, 4, 150]
+
+def test_perft_leaves_state_unchanged():
+    game_state = REFERENCE_POSITIONS['middlegame']()
+    cells_before = game_state.get_board().cells
+    hash_before = game_state.get_position_hash()
+    perft(game_state, 2)
+    assert game_state.get_board().cells == cells_before
+    assert game_state.get_position_hash() == hash_before
+    assert game_state.version == 0
+
+def test_divide():
+    result = divide(REFERENCE_POSITIONS['middlegame'](), 2)
+    assert sum(result.values()) == perft(REFERENCE_POSITIONS['middlegame'](), 2)
+
+@pytest.mark.parametrize('position', REFERENCE_POSITIONS)
+def test_no_differences_with_reference(position: str):
+    # the reference is slow, the few moves of 'check' allow one more ply
+    depth = 3 if position == 'check' else 2
+    assert find_differences(REFERENCE_POSITIONS[position](), depth) == []
+
+def test_find_differences():
+    def broken_engine(game_state: GameState):
+        summary = summarize(game_state)
+        summary.is_king_under_attack[Player.white] = True
+        return summary
+
+    differences = find_differences(GameState(), 1, broken_engine)
+    # the root and each of its 20 children
+    assert len(differences) == 21
+    assert differences[0].moves == []
+    assert differences[0].field == 'is_king_under_attack'
+
+def test_run_benchmark():
+    results = run_benchmark(1)
+    assert [result.position for result in results] == list(REFERENCE_POSITIONS)
+    assert results[0].nodes == 20
+    assert all(result.nodes_per_second > 0 for result in results)
@@ -31,28 +31,90 @@ Note: whites are on the bottom of the Board (y = 0, 1),
 board view is not rotated for blacks (should be done on UI level).
 """
 from enum import Enum
-from typing import TypedDict, Literal
+from typing import Any, Callable, Hashable, Literal, NamedTuple
 from dataclasses import dataclass
 from copy import deepcopy
+from itertools import product
+from .bitboard import FULL, square, bit, coordinates, iterate_squares
+from .visibility import calc_visible_cells
+from .transposition import position_cache
+from .zobrist import PIECE_KEYS, BLACKS_TURN_KEY, WAITING_FOR_PROMOTION_KEY
+from .tables import (
+    KNIGHT_TARGETS,
+    KING_TARGETS,
+    ROOK_TARGETS,
+    BISHOP_TARGETS,
+    BETWEEN,
+    WHITE_PAWN_PUSHES,
+    BLACK_PAWN_PUSHES,
+    WHITE_PAWN_CAPTURES,
+    BLACK_PAWN_CAPTURES,
+    STRAIGHT_DIRECTIONS,
+    DIAGONAL_DIRECTIONS,
+    ALL_DIRECTIONS,
+    ray_attacks,
+)
 
 Player = Enum('Player', 'white black')
 Piece = Enum('Piece', 'pawn rook bishop knight queen king')
 
 # unlike TypedDict, dataclass makes Enum props json-serializable
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class PlayerPiece:
-    """ Black bishop, etc. """
+    """
+    Black bishop, etc.
+
+    There are only 12 different ones, so they are flyweights:
+    PlayerPiece(player, piece) returns the same immutable instance each time
+    (copying returns it, too), hence they are compared by identity
+    """
     player: Player
     piece: Piece
 
-@dataclass
+    # see serialization.to_json
+    is_json_remembered = True
+
+    def __new__(cls, player: Player, piece: Piece):
+        instance = _player_pieces.get((player, piece))
+        if instance is None:
+            instance = _player_pieces[(player, piece)] = object.__new__(cls)
+        return instance
+    def __copy__(self):
+        return self
+    def __deepcopy__(self, memo):
+        return self
+    def __reduce__(self):
+        return PlayerPiece, (self.player, self.piece)
+    def to_json(self):
+        """ Same as dataclass serialization would give, but prepared once """
+        return _player_pieces_json[self]
+
+_player_pieces: dict[tuple[Player, Piece], PlayerPiece] = {}
+_player_pieces_json = {
+    PlayerPiece(player, piece): { 'player': player.name, 'piece': piece.name }
+    for player in Player
+    for piece in Piece
+}
+
+_ZOBRIST_KEYS = {
+    PlayerPiece(player, piece): PIECE_KEYS[index]
+    for index, (player, piece) in enumerate(product(Player, Piece))
+}
+
 class Board:
     """
-    Holds a 2D array of PlayerPiece-s, x, y,
-    can be initialized with a list of (player, piece, x, y).
+    Holds a bitboard (an int, see bitboard.py) per each (player, piece) pair
+    and occupancy bitboards per player, plus a flat list of 64 cells
+    to get a PlayerPiece by coordinates quickly.
+    Can be initialized with a list of (player, piece, x, y).
     If the positions list is omitted, the start game position is used.
+
+    The 2D array of PlayerPiece-s, x, y (.cells) is derived on access.
+
+    Attack maps (cells attacked by each piece and by each player) are
+    kept up to date by put, remove and move, so that check detection
+    is a lookup; so is the Zobrist hash of the pieces (.zobrist_hash).
     """
-    cells: list[list[PlayerPiece | None]]
     def __init__(self, positions: list[tuple[Player, Piece, int, int]] | None = None):
         if not positions:
             positions = [
@@ -90,32 +152,219 @@ class Board:
                 (Player.black, Piece.rook, 7, 7),
             ]
 
+        self._set_up(positions)
+
+    @classmethod
+    def empty(cls) -> 'Board':
+        """ A board without pieces (Board() with no positions is the start position) """
+        board = cls.__new__(cls)
+        board._set_up([])
+        return board
+
+    def _set_up(self, positions: list[tuple[Player, Piece, int, int]]) -> None:
         if len(positions) > 32:
             raise Exception('no more than 32 pieces are expected')
         # validate more, if needed (number of pieces, etc)
 
-        self.cells = [[None for _ in range(8)] for _ in range(8)]
+        self.bitboards: dict[Player, dict[Piece, int]] = {
+            player: { piece: 0 for piece in Piece } for player in Player
+        }
+        self.occupancy: dict[Player, int] = { player: 0 for player in Player }
+        self._squares: list[PlayerPiece | None] = [None] * 64
+        # attack maps: cells attacked by the piece in each cell and by each player
+        self._cell_attacks: list[int] = [0] * 64
+        self._attacked: dict[Player, int] = { player: 0 for player in Player }
+        self.zobrist_hash = 0
         for position in positions:
             player, piece, x, y = position
-            self.cells[x][y] = PlayerPiece(player, piece)
+            self._clear(square(x, y))
+            self._place(square(x, y), PlayerPiece(player, piece))
+        for square_index in iterate_squares(self.get_occupied()):
+            self._cell_attacks[square_index] = self._calc_cell_attacks(square_index)
+        self._update_attacked()
+
+    @property
+    def cells(self) -> list[list[PlayerPiece | None]]:
+        """ 2D array of PlayerPiece-s, cells[x][y] (a derived copy, changing it doesn't affect the board) """
+        return [self._squares[x::8] for x in range(8)]
+    def to_dict(self):
+        """ For JSON serialization """
+        return { 'cells': self.cells }
+
+    def get_occupied(self) -> int:
+        """ Bitboard of all occupied cells """
+        return self.occupancy[Player.white] | self.occupancy[Player.black]
+    def get(self, x: int, y: int) -> PlayerPiece | None:
+        """ Get what's in the cell """
+        return self._squares[square(x, y)]
+    def put(self, x: int, y: int, player_piece: PlayerPiece) -> PlayerPiece | None:
+        """ Put a piece into the cell, return what was there before """
+        square_index = square(x, y)
+        previous = self._clear(square_index)
+        self._place(square_index, player_piece)
+        self._update_attacks(1 << square_index, square_index)
+        return previous
+    def remove(self, x: int, y: int) -> PlayerPiece | None:
+        """ Empty the cell, return what was there """
+        square_index = square(x, y)
+        previous = self._clear(square_index)
+        if previous is not None:
+            self._update_attacks(1 << square_index)
+        return previous
+    def move(self, x_from: int, y_from: int, x_to: int, y_to: int) -> PlayerPiece | None:
+        """ Move a piece (without any validation), return the captured one """
+        square_from, square_to = square(x_from, y_from), square(x_to, y_to)
+        moving_piece = self._clear(square_from)
+        if moving_piece is None:
+            return None
+        captured = self._clear(square_to)
+        self._place(square_to, moving_piece)
+        self._update_attacks(1 << square_from | 1 << square_to, square_to)
+        return captured
+
+    def _place(self, square_index: int, player_piece: PlayerPiece) -> None:
+        cell_bit = 1 << square_index
+        self.bitboards[player_piece.player][player_piece.piece] |= cell_bit
+        self.occupancy[player_piece.player] |= cell_bit
+        self._squares[square_index] = player_piece
+        self.zobrist_hash ^= _ZOBRIST_KEYS[player_piece][square_index]
+    def _clear(self, square_index: int) -> PlayerPiece | None:
+        previous = self._squares[square_index]
+        if previous is not None:
+            cell_bit = 1 << square_index
+            self.bitboards[previous.player][previous.piece] ^= cell_bit
+            self.occupancy[previous.player] ^= cell_bit
+            self._squares[square_index] = None
+            self._cell_attacks[square_index] = 0
+            self.zobrist_hash ^= _ZOBRIST_KEYS[previous][square_index]
+        return previous
+
+    def _calc_cell_attacks(self, square_index: int) -> int:
+        player_piece = self._squares[square_index]
+        if player_piece is None:
+            return 0
+        piece = player_piece.piece
+        if piece == Piece.pawn:
+            return WHITE_PAWN_CAPTURES[square_index] if player_piece.player == Player.white \
+                else BLACK_PAWN_CAPTURES[square_index]
+        if piece == Piece.knight:
+            return KNIGHT_TARGETS[square_index]
+        if piece == Piece.king:
+            return KING_TARGETS[square_index]
+        directions = STRAIGHT_DIRECTIONS if piece == Piece.rook else \
+                     DIAGONAL_DIRECTIONS if piece == Piece.bishop else \
+                     ALL_DIRECTIONS
+        return ray_attacks(square_index, self.get_occupied(), directions)
+    def _update_attacks(self, changed_cells: int, placed_at: int | None = None) -> None:
+        """
+        Update attack maps after the occupancy of changed_cells has changed:
+        only the placed piece and the sliding pieces whose lines go through
+        the changed cells are recalculated
+        """
+        if placed_at is not None:
+            self._cell_attacks[placed_at] = self._calc_cell_attacks(placed_at)
+        sliders = 0
+        for player in Player:
+            pieces = self.bitboards[player]
+            sliders |= pieces[Piece.rook] | pieces[Piece.bishop] | pieces[Piece.queen]
+        for square_index in iterate_squares(sliders):
+            if self._cell_attacks[square_index] & changed_cells:
+                self._cell_attacks[square_index] = self._calc_cell_attacks(square_index)
+        self._update_attacked()
+    def _update_attacked(self) -> None:
+        for player in Player:
+            attacked = 0
+            for square_index in iterate_squares(self.occupancy[player]):
+                attacked |= self._cell_attacks[square_index]
+            self._attacked[player] = attacked
+
+    def get_cell_attacks(self, x: int, y: int) -> int:
+        """ Bitboard of cells attacked by the piece in the given cell """
+        return self._cell_attacks[square(x, y)]
+    def get_attacked_cells(self, player: Player) -> int:
+        """ Bitboard of cells attacked by the player's pieces (regardless of pins) """
+        return self._attacked[player]
+
+class MoveRecord(NamedTuple):
+    """ What's needed to take back a move made by GameState.push_move """
+    x_from: int
+    y_from: int
+    x_to: int
+    y_to: int
+    moved: PlayerPiece | None
+    captured: PlayerPiece | None
+    was_waiting_for_promotion: bool
+    whos_turn: Player
+    version: int
 
 BoardViewCell = PlayerPiece | Literal['is_dark'] | None
 BoardView = list[list[BoardViewCell]]
 
+def _encode_moves_by_piece(moves_by_piece: dict[tuple[int, int], tuple[tuple[int, int], ...]]) -> bytes:
+    """ For the shared cache: per piece, its cell's index, the number of its moves and their cells' indices """
+    encoded = bytearray()
+    for (x, y), moves in moves_by_piece.items():
+        encoded += bytes((square(x, y), len(moves), *(square(x_to, y_to) for x_to, y_to in moves)))
+    return bytes(encoded)
+
+def _decode_moves_by_piece(encoded: bytes) -> dict[tuple[int, int], tuple[tuple[int, int], ...]]:
+    moves_by_piece = {}
+    offset = 0
+    while offset < len(encoded):
+        count = encoded[offset + 1]
+        moves_by_piece[coordinates(encoded[offset])] = \
+            tuple(coordinates(target) for target in encoded[offset + 2:offset + 2 + count])
+        offset += 2 + count
+    return moves_by_piece
+
 class GameState:
-    """ Init with a standard game position by default """
+    """
+    Init with a standard game position by default.
+
+    .version grows with each move and promotion, so that
+    one can tell whether the state has changed since some point.
+
+    Results derived from the position (views, winner, draw) are calculated
+    once per position: they are kept until the position changes.
+    """
     def __init__(self, whos_turn: Player = Player.white, board_position: Board | None = None):
         self._whos_turn = whos_turn
         self.is_waiting_for_promotion = False
+        self.version = 0
         self._board = board_position if board_position else Board()
+        self._undo_stack: list[MoveRecord] = []
+        self._derived_position_key: tuple[int, Player] | None = None
+        self._derived: dict[Hashable, Any] = {}
     def to_dict(self):
         """ For JSON serialization """
         return {
             'is_waiting_for_promotion': self.is_waiting_for_promotion,
             'whos_turn': self._whos_turn.name,
+            'version': self.version,
             'board': self._board
         }
 
+    def get_position_hash(self) -> int:
+        """ Zobrist hash of the position (see zobrist.py), equal for equal positions """
+        position_hash = self._board.zobrist_hash
+        if self._whos_turn == Player.black:
+            position_hash ^= BLACKS_TURN_KEY
+        if self.is_waiting_for_promotion:
+            position_hash ^= WAITING_FOR_PROMOTION_KEY
+        return position_hash
+    def _get_position_key(self) -> tuple[int, Player]:
+        return self.get_position_hash(), self._whos_turn
+    def _get_derived(self, name: Hashable, calc: Callable[[], Any]) -> Any:
+        """ Gets the result derived from the current position, calculates it only once per position """
+        # any change of the position (even directly on the board) changes the key
+        position_key = self._get_position_key()
+        if position_key != self._derived_position_key:
+            self._derived_position_key = position_key
+            self._derived = {}
+        if name not in self._derived:
+            self._derived[name] = calc()
+        return self._derived[name]
+
     def get_whos_turn(self) -> Player:
         """ Get who's turn it is (only maks sense if there's no winner or draw) """
         return self._whos_turn
@@ -124,61 +373,19 @@ class GameState:
         return self._board
     def get_player_pieces_coordinates(self, player: Player) -> list[tuple[int, int]]:
         """ Get the coordinates of all player's pieces """
-        return [
-            (x, y)
-            for x in range(8)
-            for y in range(8)
-            if (in_cell := self._board.cells[x][y]) is not None
-            and in_cell.player == player
-        ]
-
-    def _is_empty_path(self, x_from: int, y_from: int, x_to: int, y_to: int) -> bool:
-        if x_from == x_to:
-            for y in range(min(y_from, y_to) + 1, max(y_from, y_to)):
-                if self._board.cells[x_from][y] is not None:
-                    return False
-            return True
-
-        if y_from == y_to:
-            for x in range(min(x_from, x_to) + 1, max(x_from, x_to)):
-                if self._board.cells[x][y_from] is not None:
-                    return False
-            return True
-
-        # incorrect input
-        return False
-    def _is_empty_diagonal_path(self, x_from: int, y_from: int, x_to: int, y_to: int) -> bool:
-        # incorrect input
-        if abs(x_to - x_from) != abs(y_to - y_from):
-            return False
-
-        for x in range(min(x_from, x_to) + 1, max(x_from, x_to)):
-            y = y_from + (x - x_from) * (y_to - y_from) / (x_to - x_from)
-            if self._board.cells[x][int(y)] is not None:
-                return False
-        return True
+        return [coordinates(square_index)
+                for square_index in iterate_squares(self._board.occupancy[player])]
+
+    def _is_empty_between(self, square_from: int, square_to: int) -> bool:
+        return not BETWEEN[square_from][square_to] & self._board.get_occupied()
+    def is_cell_attacked(self, x: int, y: int, attacker: Player) -> bool:
+        """ Check if any of the attacker's pieces attacks the cell (pins are not taken into account) """
+        return bool(self._board.get_attacked_cells(attacker) & bit(x, y))
     def is_king_under_attack(self, king_owner: Player):
         """ Check if the king is under attack """
         opponent = Player.black if king_owner == Player.white else Player.white
-        opponent_pieces_coordinates: list[tuple[int, int]] = []
-        king_coordinates = None
-        for x in range(8):
-            for y in range(8):
-                in_cell = self._board.cells[x][y]
-                if in_cell is None: continue
-                if in_cell.player == opponent:
-                    opponent_pieces_coordinates.append((x, y))
-                if in_cell.player == king_owner and in_cell.piece == Piece.king:
-                    king_coordinates = (x, y)
-        if king_coordinates is None:
-            return False
-
-        for cell_coordinates in opponent_pieces_coordinates:
-            if self.is_move_valid(opponent,
-                                  cell_coordinates[0], cell_coordinates[1],
-                                  king_coordinates[0], king_coordinates[1]):
-                return True
-        return False
+        king_bitboard = self._board.bitboards[king_owner][Piece.king]
+        return bool(king_bitboard & self._board.get_attacked_cells(opponent))
     def is_move_valid(self,
                       whos_turn: Player,
                       x_from: int,
@@ -187,75 +394,49 @@ class GameState:
                       y_to: int,
                       is_virtual: int = False) -> bool:
         """ Check if the move is valid """
-        cell_from = self._board.cells[x_from][y_from]
-        cell_to = self._board.cells[x_to][y_to]
+        # inside board
+        if not (0 <= x_from <= 7 and 0 <= y_from <= 7 and 0 <= x_to <= 7 and 0 <= y_to <= 7):
+            return False
+        cell_from = self._board.get(x_from, y_from)
+        cell_to = self._board.get(x_to, y_to)
 
-        # only own piece, inside board, to a different cell, not occupied by another own piece
+        # only own piece, to a different cell, not occupied by another own piece
         if cell_from is None or cell_from.player != whos_turn or \
-           x_to > 7 or y_to > 7 or x_to < 0 or y_to < 0 or \
            x_to == x_from and y_to == y_from or \
            cell_to is not None and cell_to.player == whos_turn:
             return False
         # already moved, has to promote
         if self.is_waiting_for_promotion:
             return False
-        # shouldn't put their king under attack
-        if not is_virtual:
-            state_after_move = self.make_virtual_move(x_from, y_from, x_to, y_to)
-            if state_after_move.is_king_under_attack(whos_turn):
-                return False
 
         # check that this piece can make this move
-        if cell_from.piece == Piece.knight:
-            return abs(x_to - x_from) == 2 and abs(y_to - y_from) == 1 or \
-                   abs(x_to - x_from) == 1 and abs(y_to - y_from) == 2
-
-        if cell_from.piece == Piece.rook:
-            if x_to != x_from and y_to != y_from:
-                return False
-            return self._is_empty_path(x_from, y_from, x_to, y_to)
-
-        if cell_from.piece == Piece.bishop:
-            if abs(x_to - x_from) != abs(y_to - y_from):
-                return False
-            return self._is_empty_diagonal_path(x_from, y_from, x_to, y_to)
-
-        if cell_from.piece == Piece.queen:
-            if x_to == x_from or y_to == y_from:
-                return self._is_empty_path(x_from, y_from, x_to, y_to)
-            if abs(x_to - x_from) == abs(y_to - y_from):
-                return self._is_empty_diagonal_path(x_from, y_from, x_to, y_to)
-            return False
-
-        if cell_from.piece == Piece.pawn:
-            # only correct direction
-            if whos_turn == Player.white and y_to <= y_from or \
-               whos_turn == Player.black and y_to >= y_from:
-                return False
-
-            # move forward
-            if x_from == x_to:
-                # no need to check the player:
-                # wrong direction and moves to y = 8 or -1 are disallowed above
-                return cell_to is None and (
-                       abs(y_to - y_from) == 1 or \
-                       abs(y_to - y_from) == 2 and y_from in (1, 6)
-                )
-
-            # capture
-            if abs(x_from - x_to) > 1 or abs(y_from - y_to) > 1:
-                return False
-
-            #TODO: implement en passant
-            return cell_to is not None #or \
-            #       self._board.cells[x_to][y_from] is not None
-
-        if cell_from.piece == Piece.king:
+        square_from, square_to = square(x_from, y_from), square(x_to, y_to)
+        cell_to_bit = 1 << square_to
+        piece = cell_from.piece
+        if piece == Piece.knight:
+            can_reach = KNIGHT_TARGETS[square_from] & cell_to_bit
+        elif piece == Piece.king:
             #TODO: implement castling
-            return abs(x_to - x_from) <= 1 and abs(y_to - y_from) <= 1
+            can_reach = KING_TARGETS[square_from] & cell_to_bit
+        elif piece == Piece.pawn:
+            # move forward or capture
+            #TODO: implement en passant
+            is_white = whos_turn == Player.white
+            # the double step can't jump over a piece
+            can_reach = (WHITE_PAWN_PUSHES if is_white else BLACK_PAWN_PUSHES)[square_from] & cell_to_bit and \
+                        self._is_empty_between(square_from, square_to) \
+                if cell_to is None else \
+                (WHITE_PAWN_CAPTURES if is_white else BLACK_PAWN_CAPTURES)[square_from] & cell_to_bit
+        else:
+            piece_targets = ROOK_TARGETS[square_from] if piece == Piece.rook else \
+                            BISHOP_TARGETS[square_from] if piece == Piece.bishop else \
+                            ROOK_TARGETS[square_from] | BISHOP_TARGETS[square_from]
+            can_reach = piece_targets & cell_to_bit and self._is_empty_between(square_from, square_to)
+        if not can_reach:
+            return False
 
-        # incorrect input
-        return False
+        # shouldn't put their king under attack
+        return is_virtual or not self._is_leaving_king_under_attack(x_from, y_from, x_to, y_to)
 
     def _pass_turn(self) -> None:
         self._whos_turn = Player.black if self._whos_turn == Player.white \
@@ -269,15 +450,15 @@ class GameState:
         if self.is_waiting_for_promotion:
             return
 
-        moving_piece = self._board.cells[x_from][y_from]
+        moving_piece = self._board.get(x_from, y_from)
         if moving_piece is None:
             return
 
         #TODO: implement en passant (if moving_piece.piece == Piece.pawn, ...)
         #TODO: implement castling (if moving_piece.piece == Piece.king, ...)
 
-        self._board.cells[x_to][y_to] = moving_piece
-        self._board.cells[x_from][y_from] = None
+        self._board.move(x_from, y_from, x_to, y_to)
+        self.version += 1
 
         self.is_waiting_for_promotion = moving_piece.piece == Piece.pawn and \
             (y_to == 0 and moving_piece.player == Player.black or \
@@ -292,25 +473,139 @@ class GameState:
         virtual_state.make_move(x_from, y_from, x_to, y_to)
         return virtual_state
 
-    #TODO: optimize the approach to iterate possible moves
+    def push_move(self, x_from: int, y_from: int, x_to: int, y_to: int) -> None:
+        """
+        Make the move in place like make_move does, but remember how to take it back
+        (with pop_move), so that hypothetical moves don't need a copy of the state
+        """
+        moved = None if self.is_waiting_for_promotion else self._board.get(x_from, y_from)
+        captured = self._board.get(x_to, y_to) if moved is not None else None
+        self._undo_stack.append(MoveRecord(x_from, y_from, x_to, y_to, moved, captured,
+                                           self.is_waiting_for_promotion, self._whos_turn,
+                                           self.version))
+        self.make_move(x_from, y_from, x_to, y_to)
+
+    def pop_move(self) -> MoveRecord:
+        """ Take back the last move made by push_move """
+        record = self._undo_stack.pop()
+        if record.moved is not None:
+            self._board.move(record.x_to, record.y_to, record.x_from, record.y_from)
+            if record.captured is not None:
+                self._board.put(record.x_to, record.y_to, record.captured)
+        self.is_waiting_for_promotion = record.was_waiting_for_promotion
+        self._whos_turn = record.whos_turn
+        self.version = record.version
+        return record
+
+    def _is_leaving_king_under_attack(self, x_from: int, y_from: int, x_to: int, y_to: int) -> bool:
+        """ Check if the owner of the moved piece has their king under attack after the move """
+        moving_piece = self._board.get(x_from, y_from)
+        if moving_piece is None:
+            return False
+        self.push_move(x_from, y_from, x_to, y_to)
+        is_under_attack = self.is_king_under_attack(moving_piece.player)
+        self.pop_move()
+        return is_under_attack
+
+    def _get_piece_targets(self, x: int, y: int) -> int:
+        """
+        Bitboard of cells the piece in the given cell can move to
+        (without checking whether their king gets or stays under attack)
+        """
+        player_piece = self._board.get(x, y)
+        if player_piece is None:
+            return 0
+        player = player_piece.player
+        opponent = Player.black if player == Player.white else Player.white
+
+        #TODO: implement castling
+        if player_piece.piece != Piece.pawn:
+            targets = self._board.get_cell_attacks(x, y)
+        else:
+            #TODO: implement en passant
+            square_from = square(x, y)
+            occupied = self._board.get_occupied()
+            pushes = (WHITE_PAWN_PUSHES if player == Player.white else BLACK_PAWN_PUSHES)[square_from] & ~occupied
+            # the double step can't jump over a piece
+            for target in iterate_squares(pushes):
+                if BETWEEN[square_from][target] & occupied:
+                    pushes ^= 1 << target
+            targets = pushes | self._board.get_cell_attacks(x, y) & self._board.occupancy[opponent]
+
+        return targets & ~self._board.occupancy[player]
+
+    def generate_piece_moves(self, x: int, y: int) -> list[tuple[int, int]]:
+        """
+        Get all cells (x_to, y_to) where the piece in the given cell can move to,
+        so that the owner's king doesn't get or stay under attack
+        (no matter whose turn it is; nothing if a promotion is pending)
+        """
+        if not (0 <= x <= 7 and 0 <= y <= 7) or self.is_waiting_for_promotion:
+            return []
+        player_piece = self._board.get(x, y)
+        if player_piece is None:
+            return []
+
+        moves: list[tuple[int, int]] = []
+        for target in iterate_squares(self._get_piece_targets(x, y)):
+            x_to, y_to = coordinates(target)
+            if not self._is_leaving_king_under_attack(x, y, x_to, y_to):
+                moves.append((x_to, y_to))
+        return moves
+
+    def get_piece_moves(self, x: int, y: int) -> tuple[tuple[int, int], ...]:
+        """ Same as generate_piece_moves, but calculated once per position """
+        return self._get_derived(('piece_moves', x, y), lambda: tuple(self.generate_piece_moves(x, y)))
+
+    def get_legal_moves_by_piece(self, player: Player) -> dict[tuple[int, int], tuple[tuple[int, int], ...]]:
+        """ Cells where each of the player's pieces (by its cell) can move to, calculated once per position """
+        moves_by_piece = self._get_derived(('legal_moves_by_piece', player), lambda: _decode_moves_by_piece(
+            position_cache.get_or_calc(
+                self._get_position_key(),
+                ('legal_moves_by_piece', player),
+                lambda: _encode_moves_by_piece({(x, y): self.get_piece_moves(x, y)
+                                                for x, y in self.get_player_pieces_coordinates(player)}))))
+        # the derived result is kept, so a copy is returned
+        return dict(moves_by_piece)
+
+    def generate_legal_moves(self, player: Player) -> list[tuple[int, int, int, int]]:
+        """ Get all moves (x_from, y_from, x_to, y_to) that the player can make """
+        return [
+            (x_from, y_from, x_to, y_to)
+            for x_from, y_from in self.get_player_pieces_coordinates(player)
+            for x_to, y_to in self.generate_piece_moves(x_from, y_from)
+        ]
+
+    def _has_legal_moves(self, player: Player) -> bool:
+        return position_cache.get_or_calc(
+            self._get_position_key(),
+            ('has_legal_moves', player),
+            lambda: any(self.generate_piece_moves(x, y)
+                        for x, y in self.get_player_pieces_coordinates(player)))
+
     def is_checkmated(self, player: Player) -> bool:
         """ Returns whether the player is checkmated, assuming it's their turn """
-        if not self.is_king_under_attack(player):
+        # the opponent hasn't finished their move yet
+        if self.is_waiting_for_promotion:
             return False
+        return self.is_king_under_attack(player) and not self._has_legal_moves(player)
 
-        player_pieces_coordinates = self.get_player_pieces_coordinates(player)
-        for x_from, y_from in player_pieces_coordinates:
-            for x_to in range(8):
-                for y_to in range(8):
-                    if self.is_move_valid(player, x_from, y_from, x_to, y_to):
+    def is_stalemated(self, player: Player) -> bool:
+        """ Returns whether the player can't make any move while not being in check, assuming it's their turn """
+        if self.is_waiting_for_promotion:
+            return False
+        return not self.is_king_under_attack(player) and not self._has_legal_moves(player)
 
-                        # for each possible move,
-                        # check if it allows to get the king from under attack
-                        possible_state = self.make_virtual_move(x_from, y_from, x_to, y_to)
-                        if not possible_state.is_king_under_attack(player):
-                            return False
+    def get_winner(self) -> Player | None:
+        """ Returns the player who checkmated the other one (None if nobody did) """
+        return self._get_derived('winner', lambda:
+            Player.white if self.is_checkmated(Player.black) else
+            Player.black if self.is_checkmated(Player.white) else
+            None)
 
-        return True
+    def is_draw(self) -> bool:
+        """ Returns whether the player whose turn it is is stalemated """
+        return self._get_derived('is_draw', lambda: self.is_stalemated(self._whos_turn))
 
     def promote(self, player: Player, x: int, y: int, piece: Piece) -> bool:
         """
@@ -319,7 +614,7 @@ class GameState:
         """
         # not checking self.is_waiting_for_promotion since checking conditions for it
 
-        cell = self._board.cells[x][y]
+        cell = self._board.get(x, y)
 
         # should be their pawn
         if cell is None or cell.player != player or cell.piece is not Piece.pawn:
@@ -333,62 +628,36 @@ class GameState:
         if piece in { Piece.king, Piece.pawn }:
             return False
 
-        self._board.cells[x][y] = PlayerPiece(player, piece)
+        self._board.put(x, y, PlayerPiece(player, piece))
+        self.version += 1
         self.is_waiting_for_promotion = False
         self._pass_turn()
         return True
 
     def get_board_view(self, player: Player) -> BoardView:
         """ Returns the board view of the given player """
-        view: BoardView = [[None for _ in range(8)] for _ in range(8)]
-        class PieceOnBoard(TypedDict):
-            """ This is just to type player_pieces here """
-            piece: Piece
-            x: int
-            y: int
-        player_pieces: list[PieceOnBoard] = []
-
-        # copy pieces into the view and gather player_pieces
-        for x in range(8):
-            for y in range(8):
-                piece_in_cell = self._board.cells[x][y]
-                view[x][y] = piece_in_cell
-
-                if piece_in_cell is not None and piece_in_cell.player == player:
-                    player_pieces.append({ 'piece': piece_in_cell.piece, 'x': x, 'y': y })
-
-        # calc visibility mask
-        visibility_mask = [[False for _ in range(8)] for _ in range(8)]
-        for piece in player_pieces:
-            for x in range(8):
-                for y in range(8):
-                    if visibility_mask[x][y]:
-                        continue
-
-                    # the cell is visible if their piece occupies it or can move to it
-                    if piece['x'] == x and piece['y'] == y:
-                        visibility_mask[x][y] = True
-                        continue
-
-                    # a pawn should see ahead and lateral neighbors
-                    #TODO: add a feature toggle (maybe to session, and let users decide)
-                    if piece['piece'] == Piece.pawn and abs(piece['x'] - x) <= 1:
-                        is_lateral_neighbor = y - piece['y'] == 0
-                        is_ahead = player == Player.white and y - piece['y'] == 1 or \
-                                           player == Player.black and y - piece['y'] == -1
-                        if is_lateral_neighbor or is_ahead:
-                            visibility_mask[x][y] = True
-                            continue
-
-                    # checking "can move to it" after simpler checks
-                    if self.is_move_valid(player, piece['x'], piece['y'], x, y, is_virtual=True):
-                        visibility_mask[x][y] = True
-
-        # apply visibility mask
-        for x in range(8):
-            for y in range(8):
-                if not visibility_mask[x][y]:
-                    view[x][y] = 'is_dark'
-
+        # (imported here: codec imports this module)
+        from .codec import encode_board_view, decode_board_view
+        # the shared cache keeps views encoded (32 bytes instead of 64 cells)
+        view = self._get_derived(('board_view', player), lambda: decode_board_view(position_cache.get_or_calc(
+            self._get_position_key(),
+            ('board_view', player),
+            lambda: encode_board_view(self._calc_board_view(player)))))
+        # the derived view is kept, so a copy is returned
+        return [column[:] for column in view]
+    def _calc_board_view(self, player: Player) -> BoardView:
+        view: BoardView = self._board.cells
+        for square_index in iterate_squares(~self.get_visible_cells(player) & FULL):
+            x, y = coordinates(square_index)
+            view[x][y] = 'is_dark'
         return view
 
+    def get_visible_cells(self, player: Player) -> int:
+        """ Bitboard of cells that the player sees (see visibility.py) """
+        return calc_visible_cells(
+            self._board.occupancy[player],
+            self._board.bitboards[player][Piece.pawn],
+            self._board.get_attacked_cells(player),
+            ~self._board.get_occupied() & FULL,
+            player == Player.white,
+            not self.is_waiting_for_promotion)
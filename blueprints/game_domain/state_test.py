@@ -1,6 +1,12 @@
-from state import (
+from copy import deepcopy
+from dataclasses import FrozenInstanceError
+import pytest
+from ..serialization import to_json
+from .transposition import position_cache
+from .state import (
     GameState,
     Board,
+    PlayerPiece,
     Player,
     Piece,
 )
@@ -30,6 +36,20 @@ def test_init():
     assert bottom_center_piece.piece == Piece.king
     assert bottom_center_piece.player == Player.white
 
+def test_player_pieces_are_shared():
+    """ Pieces are immutable flyweights, shared by boards, views and copies """
+    white_king = PlayerPiece(Player.white, Piece.king)
+    assert PlayerPiece(Player.white, Piece.king) is white_king
+    assert PlayerPiece(Player.black, Piece.king) is not white_king
+    assert deepcopy(white_king) is white_king
+    with pytest.raises(FrozenInstanceError):
+        white_king.piece = Piece.queen  # type: ignore
+
+    game_state = GameState()
+    assert game_state.get_board().get(3, 0) is white_king
+    assert game_state.get_board_view(Player.white)[3][0] is white_king
+    assert to_json(white_king) == '{"player": "white", "piece": "king"}'
+
 def test_is_move_valid():
     """
     Check various valid and invalid moves
@@ -76,6 +96,104 @@ def test_is_move_valid():
     assert game_state.is_move_valid(Player.black, 3, 7, 2, 6) is False
     assert game_state.is_move_valid(Player.black, 3, 6, 2, 5) is False
 
+def test_is_king_under_attack():
+    """
+    A piece attacks the king even if it is pinned itself
+    (moving it would open their own king):
+
+    R r k
+
+    K
+    """
+    game_state = GameState(board_position=Board(positions=[
+        (Player.white, Piece.king, 4, 0),
+        (Player.white, Piece.rook, 0, 2),
+        (Player.black, Piece.rook, 4, 2),
+        (Player.black, Piece.king, 7, 2),
+    ]), whos_turn=Player.white)
+    assert game_state.is_king_under_attack(Player.white) is True
+    assert game_state.is_king_under_attack(Player.black) is False
+    assert game_state.is_cell_attacked(3, 0, Player.white) is True
+    assert game_state.is_cell_attacked(0, 7, Player.black) is False
+
+def test_attack_maps_are_updated():
+    """
+    After moves, captures and a promotion, attack maps are the same
+    as the ones of a board built from scratch with the same pieces
+    """
+    game_state = GameState()
+    for move in [(4, 1, 4, 3), (3, 6, 3, 4), (4, 3, 3, 4), (4, 7, 0, 3), (1, 0, 2, 2)]:
+        assert game_state.is_move_valid(game_state.get_whos_turn(), *move)
+        game_state.make_move(*move)
+    board = game_state.get_board()
+    board.put(0, 7, board.get(0, 1))
+    board.remove(0, 1)
+    game_state.promote(Player.white, 0, 7, Piece.queen)
+
+    rebuilt_board = Board(positions=[
+        (cell.player, cell.piece, x, y)
+        for x in range(8)
+        for y in range(8)
+        if (cell := board.cells[x][y]) is not None
+    ])
+    for player in Player:
+        assert board.get_attacked_cells(player) == rebuilt_board.get_attacked_cells(player)
+    for x in range(8):
+        for y in range(8):
+            assert board.get_cell_attacks(x, y) == rebuilt_board.get_cell_attacks(x, y)
+
+def test_push_and_pop_move():
+    """ pop_move restores everything that push_move changed, including a pending promotion """
+    game_state = GameState(board_position=Board(positions=[
+        (Player.white, Piece.king, 4, 0),
+        (Player.white, Piece.pawn, 1, 6),
+        (Player.black, Piece.king, 4, 7),
+        (Player.black, Piece.rook, 0, 7),
+    ]))
+    board = game_state.get_board()
+    cells_before = board.cells
+    attacked_before = [board.get_attacked_cells(player) for player in Player]
+
+    game_state.push_move(1, 6, 0, 7)
+    assert game_state.version == 1
+    assert game_state.is_waiting_for_promotion is True
+    assert board.get(0, 7) == PlayerPiece(Player.white, Piece.pawn)
+    # no moves while waiting for promotion, so nothing changes
+    game_state.push_move(4, 0, 4, 1)
+    assert board.get(4, 0) == PlayerPiece(Player.white, Piece.king)
+
+    game_state.pop_move()
+    record = game_state.pop_move()
+    assert record.captured == PlayerPiece(Player.black, Piece.rook)
+    assert game_state.is_waiting_for_promotion is False
+    assert game_state.get_whos_turn() == Player.white
+    assert game_state.version == 0
+    assert board.cells == cells_before
+    assert [board.get_attacked_cells(player) for player in Player] == attacked_before
+
+def test_get_position_hash():
+    """ The hash depends on the position only, not on the moves that led to it """
+    game_state = GameState()
+    start_hash = game_state.get_position_hash()
+
+    game_state.push_move(1, 0, 2, 2)
+    game_state.push_move(1, 7, 2, 5)
+    game_state.push_move(2, 2, 1, 0)
+    after_white_move_hash = game_state.get_position_hash()
+    game_state.push_move(2, 5, 1, 7)
+    assert game_state.get_position_hash() == start_hash
+    assert after_white_move_hash != start_hash
+
+    game_state.pop_move()
+    assert game_state.get_position_hash() == after_white_move_hash
+    for _ in range(3):
+        game_state.pop_move()
+    assert game_state.get_position_hash() == start_hash
+
+    assert GameState(Player.black).get_position_hash() != start_hash
+    game_state.is_waiting_for_promotion = True
+    assert game_state.get_position_hash() != start_hash
+
 def test_is_checkmated():
     """
     Check simple cases: on diagram below, white (upper case)
@@ -161,3 +279,176 @@ def test_get_board_view():
         for y in range(4, 8):
             assert board_view_white[x][y] == 'is_dark'
             assert board_view_black[x][y] != 'is_dark'
+
+def test_generate_moves():
+    """
+    Check the moves generated in the start position and
+    that they are the same as the valid ones among all the possible targets
+    """
+    game_state = GameState()
+    assert len(game_state.generate_legal_moves(Player.white)) == 20
+    assert sorted(game_state.generate_piece_moves(1, 0)) == [(0, 2), (2, 2)]
+    assert game_state.generate_piece_moves(0, 0) == []
+    assert game_state.generate_piece_moves(3, 3) == []
+
+    # a black bishop pinned by the white one can only move along the pin diagonal
+    game_state = GameState(board_position=Board(positions=[
+        (Player.black, Piece.king, 3, 5),
+        (Player.black, Piece.bishop, 2, 4),
+        (Player.white, Piece.king, 3, 0),
+        (Player.white, Piece.bishop, 0, 2),
+    ]), whos_turn=Player.black)
+    assert sorted(game_state.generate_piece_moves(2, 4)) == [(0, 2), (1, 3)]
+
+    for player in Player:
+        brute_force_moves = [
+            (x_from, y_from, x_to, y_to)
+            for x_from, y_from in game_state.get_player_pieces_coordinates(player)
+            for x_to in range(8)
+            for y_to in range(8)
+            if game_state.is_move_valid(player, x_from, y_from, x_to, y_to)
+        ]
+        assert sorted(game_state.generate_legal_moves(player)) == sorted(brute_force_moves)
+
+def test_pawn_double_step_doesnt_jump_over_a_piece():
+    game_state = GameState()
+    game_state.make_move(1, 0, 2, 2)
+    game_state.make_move(2, 6, 2, 5)
+    # the knight blocks the white pawn, the pawn blocks the black one
+    assert not game_state.is_move_valid(Player.white, 2, 1, 2, 3)
+    assert game_state.generate_piece_moves(2, 1) == []
+    game_state.make_move(0, 1, 0, 2)
+    assert not game_state.is_move_valid(Player.black, 2, 5, 2, 3)
+    assert game_state.is_move_valid(Player.black, 2, 5, 2, 4)
+
+    # the cell behind the blocker isn't visible through it
+    game_state = GameState(board_position=Board(positions=[
+        (Player.white, Piece.king, 3, 0),
+        (Player.white, Piece.pawn, 4, 1),
+        (Player.black, Piece.king, 3, 7),
+        (Player.black, Piece.rook, 4, 2),
+    ]))
+    assert game_state.generate_piece_moves(4, 1) == []
+    assert game_state.get_board_view(Player.white)[4][3] == 'is_dark'
+
+def test_legal_moves_are_calculated_once_per_position():
+    game_state = GameState()
+    moves_by_piece = game_state.get_legal_moves_by_piece(Player.white)
+    assert sorted((x_from, y_from, x_to, y_to)
+                  for (x_from, y_from), moves in moves_by_piece.items()
+                  for x_to, y_to in moves) == sorted(game_state.generate_legal_moves(Player.white))
+    assert len(moves_by_piece) == 16
+    assert moves_by_piece[(0, 0)] == ()
+    assert game_state.get_piece_moves(1, 0) is game_state.get_piece_moves(1, 0)
+
+    # a changed copy doesn't affect the cached result
+    moves_by_piece.clear()
+    assert len(game_state.get_legal_moves_by_piece(Player.white)) == 16
+
+    game_state.make_move(4, 1, 4, 3)
+    assert sorted(game_state.get_piece_moves(3, 0)) == [(4, 1)]
+    assert sorted(game_state.get_legal_moves_by_piece(Player.white)[(5, 0)]) == \
+        [(0, 5), (1, 4), (2, 3), (3, 2), (4, 1)]
+
+def test_is_stalemated():
+    """
+    White king in the corner can't move, but isn't under attack:
+
+    K
+      q
+
+          k
+    """
+    game_state = GameState(board_position=Board(positions=[
+        (Player.white, Piece.king, 0, 7),
+        (Player.black, Piece.queen, 2, 6),
+        (Player.black, Piece.king, 4, 4),
+    ]), whos_turn=Player.white)
+    assert game_state.is_stalemated(Player.white) is True
+    assert game_state.is_checkmated(Player.white) is False
+    assert game_state.is_stalemated(Player.black) is False
+
+    assert GameState().is_stalemated(Player.white) is False
+
+def test_get_board_view_while_waiting_for_promotion():
+    """
+    While a promotion is pending, pieces don't see where they can move to,
+    only pawns see their neighbors and the cells ahead
+    """
+    game_state = GameState(board_position=Board(positions=[
+        (Player.white, Piece.king, 4, 0),
+        (Player.white, Piece.pawn, 1, 7),
+        (Player.white, Piece.pawn, 6, 4),
+        (Player.black, Piece.king, 4, 7),
+    ]))
+    visible_cells = {
+        (x, y)
+        for x, column in enumerate(game_state.get_board_view(Player.white))
+        for y, cell in enumerate(column)
+        if cell != 'is_dark'
+    }
+    assert (4, 1) in visible_cells
+    assert (4, 7) not in visible_cells
+
+    game_state.is_waiting_for_promotion = True
+    visible_cells = {
+        (x, y)
+        for x, column in enumerate(game_state.get_board_view(Player.white))
+        for y, cell in enumerate(column)
+        if cell != 'is_dark'
+    }
+    assert visible_cells == {
+        (4, 0),
+        (1, 7), (0, 7), (2, 7),
+        (6, 4), (5, 4), (7, 4), (5, 5), (6, 5), (7, 5),
+    }
+
+def test_derived_results_are_calculated_once_per_position():
+    game_state = GameState()
+    calls: list[int] = []
+    def calc():
+        calls.append(game_state.version)
+        return len(calls)
+
+    assert game_state._get_derived('result', calc) == 1
+    assert game_state._get_derived('result', calc) == 1
+    game_state.make_move(5, 1, 5, 2)
+    assert game_state._get_derived('result', calc) == 2
+    # a direct change of the board changes the position, too
+    game_state.get_board().remove(0, 1)
+    assert game_state._get_derived('result', calc) == 3
+    assert calls == [0, 1, 1]
+
+def test_shared_results_are_kept_encoded():
+    game_state = GameState()
+    game_state.make_move(4, 1, 4, 3)
+    view = game_state.get_board_view(Player.black)
+    moves_by_piece = game_state.get_legal_moves_by_piece(Player.black)
+
+    # another game in the same position decodes the same results from the shared cache
+    other_state = GameState()
+    other_state.make_move(4, 1, 4, 3)
+    assert other_state.get_board_view(Player.black) == view
+    assert other_state.get_legal_moves_by_piece(Player.black) == moves_by_piece
+    results = position_cache._entries[game_state._get_position_key()]
+    assert isinstance(results[('board_view', Player.black)], bytes)
+    assert isinstance(results[('legal_moves_by_piece', Player.black)], bytes)
+
+def test_get_winner_and_is_draw():
+    """ Fool's mate """
+    game_state = GameState()
+    for move in [(2, 1, 2, 2), (3, 6, 3, 4), (1, 1, 1, 3)]:
+        game_state.make_move(*move)
+        assert game_state.get_winner() is None
+        assert game_state.is_draw() is False
+    game_state.make_move(4, 7, 0, 3)
+    assert game_state.get_winner() == Player.black
+    assert game_state.is_draw() is False
+
+    game_state = GameState(board_position=Board(positions=[
+        (Player.white, Piece.king, 0, 7),
+        (Player.black, Piece.queen, 2, 6),
+        (Player.black, Piece.king, 4, 4),
+    ]), whos_turn=Player.white)
+    assert game_state.get_winner() is None
+    assert game_state.is_draw() is True
@@ -0,0 +1,100 @@
+"""
+Lookup tables of moves and attacks for each piece and cell,
+built once on import from the shifts in bitboard.py.
+
+All the tables are indexed by the cell's bit index (see bitboard.square)
+and contain bitboards:
+
+- KNIGHT_TARGETS, KING_TARGETS, ROOK_TARGETS, BISHOP_TARGETS:
+  where the piece can go on an empty board;
+- RAYS[direction]: cells in the direction until the board edge;
+- BETWEEN[from][to]: cells strictly between two cells on the same line
+  (or diagonal), 0 for other pairs;
+- WHITE_/BLACK_PAWN_PUSHES and _CAPTURES: cells ahead of the pawn
+  (including the double step from the start row) and diagonally ahead.
+"""
+from .bitboard import (
+    iterate_squares,
+    north,
+    south,
+    east,
+    west,
+    north_east,
+    north_west,
+    south_east,
+    south_west,
+    knight_attacks,
+    king_attacks,
+    pawn_attacks,
+)
+
+# the first four directions go towards greater bit indices,
+# direction + 4 is the opposite one
+NORTH, EAST, NORTH_EAST, NORTH_WEST, SOUTH, WEST, SOUTH_WEST, SOUTH_EAST = range(8)
+STRAIGHT_DIRECTIONS = (NORTH, EAST, SOUTH, WEST)
+DIAGONAL_DIRECTIONS = (NORTH_EAST, NORTH_WEST, SOUTH_EAST, SOUTH_WEST)
+ALL_DIRECTIONS = STRAIGHT_DIRECTIONS + DIAGONAL_DIRECTIONS
+_SHIFTS = (north, east, north_east, north_west, south, west, south_west, south_east)
+
+def _build_ray(square_index: int, direction: int) -> int:
+    shift = _SHIFTS[direction]
+    ray = 0
+    cell = shift(1 << square_index)
+    while cell:
+        ray |= cell
+        cell = shift(cell)
+    return ray
+
+KNIGHT_TARGETS = [knight_attacks(1 << square_index) for square_index in range(64)]
+KING_TARGETS = [king_attacks(1 << square_index) for square_index in range(64)]
+RAYS = [[_build_ray(square_index, direction) for square_index in range(64)]
+        for direction in range(8)]
+ROOK_TARGETS = [
+    RAYS[NORTH][square_index] | RAYS[EAST][square_index] |
+    RAYS[SOUTH][square_index] | RAYS[WEST][square_index]
+    for square_index in range(64)
+]
+BISHOP_TARGETS = [
+    RAYS[NORTH_EAST][square_index] | RAYS[NORTH_WEST][square_index] |
+    RAYS[SOUTH_EAST][square_index] | RAYS[SOUTH_WEST][square_index]
+    for square_index in range(64)
+]
+
+def _build_between() -> list[list[int]]:
+    between = [[0] * 64 for _ in range(64)]
+    for square_from in range(64):
+        for direction in range(8):
+            opposite = (direction + 4) % 8
+            for square_to in iterate_squares(RAYS[direction][square_from]):
+                between[square_from][square_to] = \
+                    RAYS[direction][square_from] & RAYS[opposite][square_to]
+    return between
+
+BETWEEN = _build_between()
+
+WHITE_PAWN_CAPTURES = [pawn_attacks(1 << square_index, True) for square_index in range(64)]
+BLACK_PAWN_CAPTURES = [pawn_attacks(1 << square_index, False) for square_index in range(64)]
+WHITE_PAWN_PUSHES = [
+    north(1 << square_index) | (north(north(1 << square_index)) if square_index >> 3 == 1 else 0)
+    for square_index in range(64)
+]
+BLACK_PAWN_PUSHES = [
+    south(1 << square_index) | (south(south(1 << square_index)) if square_index >> 3 == 6 else 0)
+    for square_index in range(64)
+]
+
+def ray_attacks(square_index: int, occupied: int, directions: tuple[int, ...]) -> int:
+    """
+    Cells attacked by a sliding piece in the given cell along the given directions:
+    each ray is cut after the first occupied cell (which is included)
+    """
+    attacks = 0
+    for direction in directions:
+        ray = RAYS[direction][square_index]
+        blockers = ray & occupied
+        if blockers:
+            blocker = (blockers & -blockers).bit_length() - 1 if direction < SOUTH \
+                else blockers.bit_length() - 1
+            ray ^= RAYS[direction][blocker]
+        attacks |= ray
+    return attacks
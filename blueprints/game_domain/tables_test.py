@@ -0,0 +1,44 @@
+import random
+from .bitboard import (
+    bit,
+    square,
+    sliding_attacks,
+    STRAIGHT_SHIFTS,
+    DIAGONAL_SHIFTS,
+)
+from .tables import (
+    BETWEEN,
+    WHITE_PAWN_PUSHES,
+    BLACK_PAWN_PUSHES,
+    STRAIGHT_DIRECTIONS,
+    DIAGONAL_DIRECTIONS,
+    ray_attacks,
+)
+
+def test_between():
+    assert BETWEEN[square(0, 0)][square(0, 3)] == bit(0, 1) | bit(0, 2)
+    assert BETWEEN[square(0, 3)][square(0, 0)] == bit(0, 1) | bit(0, 2)
+    assert BETWEEN[square(2, 0)][square(4, 2)] == bit(3, 1)
+    assert BETWEEN[square(4, 2)][square(2, 0)] == bit(3, 1)
+    assert BETWEEN[square(5, 1)][square(2, 4)] == bit(4, 2) | bit(3, 3)
+    # neighbors and not aligned cells
+    assert BETWEEN[square(3, 3)][square(4, 4)] == 0
+    assert BETWEEN[square(0, 0)][square(1, 2)] == 0
+
+def test_pawn_pushes():
+    assert WHITE_PAWN_PUSHES[square(4, 1)] == bit(4, 2) | bit(4, 3)
+    assert WHITE_PAWN_PUSHES[square(4, 2)] == bit(4, 3)
+    assert WHITE_PAWN_PUSHES[square(4, 7)] == 0
+    assert BLACK_PAWN_PUSHES[square(4, 6)] == bit(4, 5) | bit(4, 4)
+    assert BLACK_PAWN_PUSHES[square(4, 0)] == 0
+
+def test_ray_attacks_are_same_as_sliding_attacks():
+    randomizer = random.Random(0)
+    for _ in range(200):
+        occupied = randomizer.getrandbits(64) & randomizer.getrandbits(64)
+        square_index = randomizer.randrange(64)
+        piece_bit = 1 << square_index
+        assert ray_attacks(square_index, occupied, STRAIGHT_DIRECTIONS) == \
+            sliding_attacks(piece_bit, occupied, STRAIGHT_SHIFTS)
+        assert ray_attacks(square_index, occupied, DIAGONAL_DIRECTIONS) == \
+            sliding_attacks(piece_bit, occupied, DIAGONAL_SHIFTS)
@@ -0,0 +1,68 @@
+"""
+Transposition cache: results derived from a position (like whether
+someone is checkmated, or a player's board view) are the same
+for all games that have this position, so they are calculated once
+and shared by all sessions of the process.
+
+Entries are keyed by (position hash, whose turn) and evicted
+in the least recently used order. Results are kept compact (views
+and moves are encoded into bytes, see GameState), about 1 KB per position.
+"""
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Hashable, TypeVar
+
+T = TypeVar('T')
+
+# about 20 MB
+DEFAULT_MAX_POSITIONS = 20_000
+
+class TranspositionCache:
+    """ A bounded LRU map from position keys to named derived results """
+    def __init__(self, max_positions: int = DEFAULT_MAX_POSITIONS):
+        self.max_positions = max_positions
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, dict[Hashable, Any]] = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_or_calc(self, position_key: Hashable, result_name: Hashable, calc: Callable[[], T]) -> T:
+        """ Get a stored result for the position, or calculate and store it """
+        with self._lock:
+            results = self._entries.get(position_key)
+            if results is not None:
+                self._entries.move_to_end(position_key)
+                if result_name in results:
+                    self.hits += 1
+                    return results[result_name]
+        self.misses += 1
+
+        # calculating outside the lock so that other threads are not blocked
+        value = calc()
+        with self._lock:
+            results = self._entries.get(position_key)
+            if results is None:
+                results = self._entries[position_key] = {}
+                if len(self._entries) > self.max_positions:
+                    self._entries.popitem(last=False)
+            results[result_name] = value
+        return value
+
+    def resize(self, max_positions: int) -> None:
+        """ Change the limit, evicting the least recently used positions above it """
+        with self._lock:
+            self.max_positions = max_positions
+            while len(self._entries) > max_positions:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """ Drop all the entries and reset the stats """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+position_cache = TranspositionCache()
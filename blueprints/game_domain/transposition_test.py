@@ -0,0 +1,32 @@
+from .transposition import TranspositionCache
+
+def test_get_or_calc():
+    cache = TranspositionCache()
+    calls: list[str] = []
+    def calc(value: str):
+        calls.append(value)
+        return value
+
+    assert cache.get_or_calc((1, 'white'), 'view', lambda: calc('a')) == 'a'
+    assert cache.get_or_calc((1, 'white'), 'view', lambda: calc('b')) == 'a'
+    assert cache.get_or_calc((1, 'white'), 'check', lambda: calc('c')) == 'c'
+    assert cache.get_or_calc((1, 'black'), 'view', lambda: calc('d')) == 'd'
+    assert calls == ['a', 'c', 'd']
+    assert cache.hits == 1
+    assert cache.misses == 3
+
+def test_evicts_least_recently_used():
+    cache = TranspositionCache(max_positions=2)
+    cache.get_or_calc(1, 'result', lambda: 1)
+    cache.get_or_calc(2, 'result', lambda: 2)
+    # use 1, so that 2 is evicted when 3 is added
+    cache.get_or_calc(1, 'result', lambda: None)
+    cache.get_or_calc(3, 'result', lambda: 3)
+    assert len(cache) == 2
+
+    assert cache.get_or_calc(1, 'result', lambda: None) == 1
+    assert cache.get_or_calc(2, 'result', lambda: None) is None
+
+    cache.resize(1)
+    assert len(cache) == 1
+    assert cache.get_or_calc(2, 'result', lambda: 'again') is None
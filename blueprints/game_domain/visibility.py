@@ -0,0 +1,40 @@
+"""
+Visibility engine: calculates which cells a player sees (see the "dark"
+part of the game in state.py) as a bitboard, for all their pieces at once.
+
+A player sees
+- the cells occupied by their pieces,
+- the cells where their pieces can move to (without checking whether
+  their king gets under attack), and
+- lateral neighbors and the cells ahead of their pawns.
+
+Any piece but a pawn can move to each cell it attacks, unless it's occupied
+by an own piece (visible anyway); pawn captures are among the cells ahead.
+So the "can move to" part is the player's attack map plus pawn pushes.
+"""
+from .bitboard import north, south, east, west
+
+WHITE_PAWNS_START_ROW = 0xFF << 8
+BLACK_PAWNS_START_ROW = 0xFF << 48
+
+def calc_visible_cells(own: int,
+                       pawns: int,
+                       attacked: int,
+                       empty: int,
+                       is_white: bool,
+                       can_move: bool = True) -> int:
+    """
+    Bitboard of cells visible to the player, given their pieces (own),
+    pawns, the cells they attack and the empty cells.
+    can_move is False when a promotion is pending: then pieces don't "see"
+    where they can move to
+    """
+    forward = north if is_white else south
+    sideways = east(pawns) | west(pawns)
+    visible = own | sideways | forward(pawns | sideways)
+    if not can_move:
+        return visible
+
+    # the double step from the start row, unless the cell in between is occupied
+    start_row_pawns = pawns & (WHITE_PAWNS_START_ROW if is_white else BLACK_PAWNS_START_ROW)
+    return visible | attacked | forward(forward(start_row_pawns) & empty) & empty
@@ -0,0 +1,17 @@
+"""
+Zobrist hashing keys: a position's hash is xor of the keys of each piece
+in each cell, plus the keys of whose turn it is and of a pending promotion.
+Xor is its own inverse, so the hash is updated in O(1) when a piece is
+placed or removed (see Board).
+
+The keys are generated with a fixed seed, so hashes are the same
+in all processes.
+"""
+import random
+
+_randomizer = random.Random(0xDA4C)
+
+# one list of keys per each cell, for each (player, piece) pair
+PIECE_KEYS = [[_randomizer.getrandbits(64) for _ in range(64)] for _ in range(12)]
+BLACKS_TURN_KEY = _randomizer.getrandbits(64)
+WAITING_FOR_PROMOTION_KEY = _randomizer.getrandbits(64)
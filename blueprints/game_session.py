@@ -21,8 +21,20 @@ and moving generation of player secrets there from __init__.
 """
 
 import uuid
+from enum import Enum
 from dataclasses import dataclass
-from .game_domain.state import GameState
+from typing import NamedTuple
+from .game_domain.state import GameState, Player
+
+# which of the session's secrets a secret is
+SecretRole = Enum('SecretRole', 'white black join')
+
+def secret_to_bytes(secret: str | None) -> bytes:
+    """ Secrets are UUIDs, so they are stored in 16 bytes (zeros for None) """
+    return uuid.UUID(secret).bytes if secret is not None else bytes(16)
+
+def secret_from_bytes(data: bytes) -> str:
+    return str(uuid.UUID(bytes=data))
 
 @dataclass
 class GameSession:
@@ -32,9 +44,33 @@ class GameSession:
     black_secret: str
     game_state: GameState
     def __init__(self):
-        self.white_secret = str(uuid.uuid4())
-        self.join_secret = str(uuid.uuid4())
-        self.black_secret = str(uuid.uuid4())
-        self.game_state = GameState()
+        self._init(str(uuid.uuid4()), str(uuid.uuid4()), str(uuid.uuid4()), GameState())
+
+    @classmethod
+    def restore(cls,
+                white_secret: str,
+                join_secret: str | None,
+                black_secret: str,
+                game_state: GameState) -> 'GameSession':
+        """ Recreates a session from stored parts """
+        session = cls.__new__(cls)
+        session._init(white_secret, join_secret, black_secret, game_state)
+        return session
+
+    def _init(self, white_secret: str, join_secret: str | None, black_secret: str, game_state: GameState):
+        self.white_secret = white_secret
+        self.join_secret = join_secret
+        self.black_secret = black_secret
+        self.game_state = game_state
+        # recent views sent to each player (encoded, see codec.encode_board_view), by state version
+        # (not a dataclass field: only needed to send changes of the view, see GameSessionsManager)
+        self.served_views: dict[Player, dict[int, bytes]] = { player: {} for player in Player }
 
 GameSession.__doc__ = str(GameSession.__doc__).format(module_docstring=__doc__)
+
+class FrozenSession(NamedTuple):
+    """ A session that is not used for a while: the state is encoded by codec.encode_state """
+    white_secret: str
+    join_secret: str | None
+    black_secret: str
+    encoded_state: bytes
@@ -3,10 +3,16 @@ Application layer of the game
 
 See secrets' description in GameSession.
 """
-from dataclasses import dataclass
-from .game_domain.state import Player, Piece, BoardView
-from .storage import IGameSessionStorage
-from .game_session import GameSession
+from base64 import b64encode
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from typing import Callable, Iterator
+from .game_domain.state import Player, Piece, BoardView, BoardViewCell
+from .game_domain.codec import encode_board_view, encode_board_view_cell, decode_board_view
+from .storage import IGameSessionStorage, StaleSessionError
+from .game_session import GameSession, SecretRole
+from .journal import MoveJournal
+from .notifications import UpdatesNotifier, Subscription
 
 @dataclass
 class PlayerViewAndStats:
@@ -18,14 +24,65 @@ class PlayerViewAndStats:
     is_our_king_under_attack: bool
     is_their_king_under_attack: bool
     winner: Player | None
+    is_draw: bool = False
+    version: int = 0
+
+@dataclass
+class PlayerViewChanges:
+    """
+    Same as PlayerViewAndStats, but instead of the whole view, only
+    the cells (x, y, new content) that changed since the given version
+    """
+    changed_cells: list[tuple[int, int, BoardViewCell]]
+    since_version: int
+    player: Player
+    whos_turn: Player
+    is_waiting_for_promotion: bool
+    is_our_king_under_attack: bool
+    is_their_king_under_attack: bool
+    winner: Player | None
+    is_draw: bool
+    version: int
+
+@dataclass
+class LegalMoves:
+    """
+    Cells where the player's pieces can move to: (x_from, y_from, [(x_to, y_to), ...])
+    for each piece that can move (none while it's not the player's turn), in the given version of the game
+    """
+    moves: list[tuple[int, int, tuple[tuple[int, int], ...]]]
+    version: int
+
+def to_compact(result: PlayerViewAndStats | PlayerViewChanges) -> PlayerViewAndStats | PlayerViewChanges:
+    """
+    For ?format=compact of /state: the view as base64 of 32 bytes (see codec.encode_board_view),
+    changed cells as (x, y, code of the cell)
+    """
+    if isinstance(result, PlayerViewAndStats):
+        return replace(result, player_view=b64encode(encode_board_view(result.player_view)).decode())
+    return replace(result, changed_cells=[(x, y, encode_board_view_cell(cell)) for x, y, cell in result.changed_cells])
+
+# views older than these are not remembered, so the whole view is sent instead of changes
+MAX_SERVED_VIEWS_PER_PLAYER = 4
 
 class GameSessionsManager:
     """
     Exposes application methods like creating a session,
     joining it and making a move, to the framework (API, WS or any other)
+
+    Methods can be called from several threads: a session is only read
+    and changed under its lock (see storage.locks), so moves in one game
+    are serialized while different games don't wait for each other.
     """
-    def __init__(self, storage: IGameSessionStorage):
+    def __init__(self,
+                 storage: IGameSessionStorage,
+                 journal: MoveJournal | None = None,
+                 notifier: UpdatesNotifier | None = None):
         self.storage = storage
+        # records what happens to sessions, if set (see journal.py)
+        self.journal = journal
+        # pushes updates to subscribed players (see subscribe_to_updates)
+        self.notifier = notifier if notifier else UpdatesNotifier()
 
     def create_session(self) -> tuple[str, BoardView]:
         """
@@ -35,14 +92,19 @@ class GameSessionsManager:
         Implies that the player with white pieces invites the other player.
         """
         session = self.storage.create_session()
-        return (session.white_secret, session.game_state.get_board_view(Player.white))
+        with self.storage.locks.hold(session.white_secret):
+            if self.journal:
+                self.journal.record_session(session)
+            result = (session.white_secret, self._serve_view(session, Player.white))
+        self._take_journal_snapshot_if_due()
+        return result
 
     def get_join_secret(self, white_secret: str) -> str | None:
         """ Finds a session by white_secret, returns join_secret or None if not found """
-        session = self.storage.get_session_by_secret(white_secret)
-        if session is None or session.white_secret != white_secret:
+        found = self.storage.get_session_and_role_by_secret(white_secret)
+        if found is None or found[1] != SecretRole.white:
             return None
-        return session.join_secret
+        return found[0].join_secret
 
     def join_session(self, join_secret: str):
         """
@@ -51,18 +113,90 @@ class GameSessionsManager:
         it also only allows to join via join_secret and not the black_secret.
         Returns (black_secret, black_board_view)
         """
-        session = self.storage.get_session_by_secret(join_secret)
-        if session is None:
-            return None
+        with self._lock_session(join_secret) as found:
+            if found is None:
+                return None
+            session, role = found
 
-        # Don't allow joining by player's secret: otherwise white could obtain it,
-        # pass to black as a join secret, and be able to see their view
-        if session.join_secret != join_secret:
-            return None
+            # Don't allow joining by player's secret: otherwise white could obtain it,
+            # pass to black as a join secret, and be able to see their view;
+            # the join secret could also be used by another request meanwhile
+            if role != SecretRole.join or session.join_secret != join_secret:
+                return None
 
-        # If black loses the response, they won't be able to join
-        session.join_secret = None
-        return (session.black_secret, session.game_state.get_board_view(Player.black))
+            # If black loses the response, they won't be able to join
+            if not self._save(session, self.storage.clear_join_secret):
+                # joined via another process meanwhile
+                return None
+            if self.journal:
+                self.journal.record_join(session)
+            result = (session.black_secret, self._serve_view(session, Player.black))
+        self._take_journal_snapshot_if_due()
+        return result
+
+    @contextmanager
+    def _lock_session(self, secret: str) -> Iterator[tuple[GameSession, SecretRole] | None]:
+        """
+        Finds the session by any secret and holds its lock. The session is looked up under the lock:
+        otherwise it could be frozen and restored (as another object) before the lock is taken.
+        """
+        white_secret = self.storage.get_white_secret(secret)
+        if white_secret is None:
+            yield None
+            return
+        with self.storage.locks.hold(white_secret):
+            yield self.storage.get_session_and_role_by_secret(secret)
+
+    @contextmanager
+    def _lock_session_and_player(self, secret: str) -> Iterator[tuple[GameSession, Player] | None]:
+        """ Finds the session by a player's secret (not join_secret) and holds its lock, tells whose secret it is """
+        # same as _lock_session (not nested: it's on the path of each request)
+        white_secret = self.storage.get_white_secret(secret)
+        if white_secret is None:
+            yield None
+            return
+        with self.storage.locks.hold(white_secret):
+            found = self.storage.get_session_and_role_by_secret(secret)
+            if found is None or found[1] == SecretRole.join:
+                yield None
+            else:
+                session, role = found
+                yield session, Player.black if role == SecretRole.black else Player.white
+
+    def _save(self, session: GameSession, save: Callable[[GameSession], None]) -> bool:
+        """
+        Saves the session changed in place (under its lock), False if it was changed elsewhere meanwhile.
+        If saving fails anyhow, the changed object is discarded, so that it isn't used as if it was saved.
+        """
+        try:
+            save(session)
+        except StaleSessionError:
+            self.storage.discard_session(session)
+            return False
+        except BaseException:
+            self.storage.discard_session(session)
+            raise
+        return True
+
+    def _take_journal_snapshot_if_due(self) -> None:
+        """ Called without holding a session's lock: the snapshot is taken in the background, locking a session at a time """
+        if self.journal and self.journal.is_snapshot_due:
+            self.journal.take_snapshot_if_due()
+
+    def _serve_view(self, session: GameSession, player: Player) -> BoardView:
+        """ Gets the player's view and remembers it to send only changes later """
+        view = session.game_state.get_board_view(player)
+        self._remember_served_view(session, player, view)
+        return view
+
+    def _remember_served_view(self, session: GameSession, player: Player, view: BoardView) -> None:
+        """ Views are kept encoded (32 bytes instead of 64 cells, see codec.encode_board_view) """
+        served_views = session.served_views[player]
+        if session.game_state.version in served_views:
+            return
+        served_views[session.game_state.version] = encode_board_view(view)
+        if len(served_views) > MAX_SERVED_VIEWS_PER_PLAYER:
+            del served_views[next(iter(served_views))]
 
     def get_player_view_and_stats(self, secret: str) -> PlayerViewAndStats | None:
         """
@@ -70,26 +204,175 @@ class GameSessionsManager:
         Can be used in polling, pushed via WS, or reused in methods like make_move.
         Returns None when the session is not found by secret.
         """
-        session = self.storage.get_session_by_secret(secret)
-        if session is None:
-            return None
-        if not secret in (session.black_secret, session.white_secret):
-            return None
-        us = Player.black if secret == session.black_secret else Player.white
-        them = Player.white if secret == session.black_secret else Player.black
-
-        winner = Player.white if session.game_state.is_checkmated(Player.black) else \
-                 Player.black if session.game_state.is_checkmated(Player.white) else \
-                 None
+        with self._lock_session_and_player(secret) as found:
+            if found is None:
+                return None
+            session, us = found
+            return self._get_view_and_stats(session, us)
 
+    def _get_view_and_stats(self, session: GameSession, us: Player) -> PlayerViewAndStats:
+        """ Everything derived from the position is cached in GameState, so polling is cheap """
+        them = Player.white if us == Player.black else Player.black
+        game_state = session.game_state
         return PlayerViewAndStats(
-            session.game_state.get_board_view(us),
+            self._serve_view(session, us),
             us,
-            session.game_state.get_whos_turn(),
-            session.game_state.is_waiting_for_promotion,
-            session.game_state.is_king_under_attack(us),
-            session.game_state.is_king_under_attack(them),
-            winner)
+            game_state.get_whos_turn(),
+            game_state.is_waiting_for_promotion,
+            game_state.is_king_under_attack(us),
+            game_state.is_king_under_attack(them),
+            game_state.get_winner(),
+            game_state.is_draw(),
+            game_state.version)
+
+    def get_player_view_changes(self,
+                                secret: str,
+                                since_version: int) -> PlayerViewChanges | PlayerViewAndStats | None:
+        """
+        Like get_player_view_and_stats, but gives only the cells of the view that changed
+        since the given version (one that the player got before); gives the whole
+        PlayerViewAndStats if that version is too old or unknown.
+        Returns None when the session is not found by secret.
+        """
+        with self._lock_session_and_player(secret) as found:
+            if found is None:
+                return None
+            session, us = found
+            encoded_previous_view = session.served_views[us].get(since_version)
+            view_and_stats = self._get_view_and_stats(session, us)
+        if encoded_previous_view is None:
+            return view_and_stats
+
+        previous_view = decode_board_view(encoded_previous_view)
+        view = view_and_stats.player_view
+        changed_cells: list[tuple[int, int, BoardViewCell]] = [
+            (x, y, view[x][y])
+            for x in range(8)
+            for y in range(8)
+            if view[x][y] != previous_view[x][y]
+        ]
+        return PlayerViewChanges(
+            changed_cells,
+            since_version,
+            view_and_stats.player,
+            view_and_stats.whos_turn,
+            view_and_stats.is_waiting_for_promotion,
+            view_and_stats.is_our_king_under_attack,
+            view_and_stats.is_their_king_under_attack,
+            view_and_stats.winner,
+            view_and_stats.is_draw,
+            view_and_stats.version)
+
+    def get_players_views_and_stats(self, secrets: list[str]) -> list[PlayerViewAndStats | None]:
+        """
+        Bulk version of get_player_view_and_stats for refreshing many games at once
+        (after a restart, for spectators or analytics): views and check flags
+        of all the games are calculated together by the batch engine.
+        Returns results in the order of secrets, None for those not found.
+        """
+        white_secrets = [self.storage.get_white_secret(secret) for secret in secrets]
+        results: list[PlayerViewAndStats | None] = [None] * len(secrets)
+        with self.storage.locks.hold_many(white_secret for white_secret in white_secrets if white_secret is not None):
+            # looked up under the locks, like in _lock_session
+            found: list[tuple[int, GameSession, Player]] = []
+            for index, secret in enumerate(secrets):
+                session_and_role = self.storage.get_session_and_role_by_secret(secret) \
+                    if white_secrets[index] is not None else None
+                if session_and_role is None or session_and_role[1] == SecretRole.join:
+                    continue
+                session, role = session_and_role
+                found.append((index, session, Player.black if role == SecretRole.black else Player.white))
+            if found:
+                self._fill_views_and_stats(found, results)
+        return results
+
+    def _fill_views_and_stats(self,
+                              found: list[tuple[int, GameSession, Player]],
+                              results: list[PlayerViewAndStats | None]) -> None:
+        """ Calculates views and stats of the found sessions by the batch engine, puts them to results """
+        # numpy is only needed for bulk operations, so it's imported on demand
+        from .game_domain.batch import encode_boards, evaluate_boards, to_board_views
+
+        game_states = [session.game_state for _, session, _ in found]
+        evaluation = evaluate_boards(*encode_boards(game_states))
+        views = { player: to_board_views(game_states, evaluation.visible[player]) for player in Player }
+        for position, (index, session, us) in enumerate(found):
+            them = Player.white if us == Player.black else Player.black
+            game_state = session.game_state
+            self._remember_served_view(session, us, views[us][position])
+            results[index] = PlayerViewAndStats(
+                views[us][position],
+                us,
+                game_state.get_whos_turn(),
+                game_state.is_waiting_for_promotion,
+                bool(evaluation.is_king_under_attack[us][position]),
+                bool(evaluation.is_king_under_attack[them][position]),
+                game_state.get_winner(),
+                game_state.is_draw(),
+                game_state.version)
+
+    def get_state_version(self, secret: str) -> int | None:
+        """ Version of the game's state (see GameState.version), e.g. to check if a player's view is outdated """
+        with self._lock_session_and_player(secret) as found:
+            return found[0].game_state.version if found is not None else None
+
+    def wait_for_version_change(self, secret: str, version: int, timeout: float = 0) -> int | None:
+        """
+        Waits until the game's version is not the given one, for up to timeout seconds,
+        returns the current version (or None when the session is not found by secret).
+        Only changes made by this process end the wait early: those made by others
+        (sharing the storage, like Redis) are seen when the stored version is checked again in the end.
+        """
+        if timeout <= 0:
+            return self.get_state_version(secret)
+        found = self.subscribe_to_version_change(secret, version)
+        if not isinstance(found, Subscription):
+            return found
+        try:
+            update = found.get(timeout)
+        finally:
+            found.close()
+        return update.version if update is not None else self.get_state_version(secret)
+
+    def subscribe_to_version_change(self,
+                                    secret: str,
+                                    version: int,
+                                    on_publish: Callable[[], None] | None = None) -> Subscription | int | None:
+        """
+        Subscribes the player to updates (see subscribe_to_updates) if the game's version
+        is the given one, returns the current version otherwise (or None when the session is not found)
+        """
+        with self._lock_session_and_player(secret) as found:
+            if found is None:
+                return None
+            session, us = found
+            if session.game_state.version != version:
+                return session.game_state.version
+            # subscribed under the lock, so a change can't be made in between
+            return self.notifier.subscribe(session.white_secret, us, on_publish)
+
+    def subscribe_to_updates(self, secret: str, on_publish: Callable[[], None] | None = None) -> Subscription | None:
+        """
+        Subscribes the player to PlayerViewAndStats of each change of their game
+        (the current one is the first); close the subscription when it's not needed.
+        on_publish is called (in the thread that made the change) after each update.
+        Returns None when the session is not found by secret.
+        """
+        with self._lock_session_and_player(secret) as found:
+            if found is None:
+                return None
+            session, us = found
+            subscription = self.notifier.subscribe(session.white_secret, us, on_publish)
+            subscription.publish(self._get_view_and_stats(session, us))
+        return subscription
+
+    def _notify(self, session: GameSession, changed_by: Player, changed_by_result: PlayerViewAndStats) -> None:
+        """ Publishes the change to subscribers of both sides (under the session's lock, so updates keep their order) """
+        for player in Player:
+            if self.notifier.has_subscribers(session.white_secret, player):
+                self.notifier.publish(session.white_secret,
+                                      player,
+                                      changed_by_result if player == changed_by else self._get_view_and_stats(session, player))
 
     def validate_move(self,
                       secret: str,
@@ -98,51 +381,79 @@ class GameSessionsManager:
                       x_to: int,
                       y_to: int) -> GameSession | None:
         """ Checks move validity: returns None when invalid, session otherwise """
-        session = self.storage.get_session_by_secret(secret)
-        if session is None:
-            return None
+        with self._lock_session_and_player(secret) as found:
+            if found is None:
+                return None
+            session, us = found
+            return session if self._is_move_valid(session, us, x_from, y_from, x_to, y_to) else None
 
+    def _is_move_valid(self, session: GameSession, us: Player, x_from: int, y_from: int, x_to: int, y_to: int) -> bool:
+        """ Checks move validity (under the session's lock) """
         whos_turn = session.game_state.get_whos_turn()
-        if whos_turn == Player.white and session.white_secret != secret or \
-           whos_turn == Player.black and session.black_secret != secret:
-            return None
+        if whos_turn != us:
+            return False
 
-        if session.game_state.is_move_valid(whos_turn, x_from, y_from, x_to, y_to):
-            return session
-        return None
-
-    def _make_move_get_session(self,
-                               secret: str,
-                               x_from: int,
-                               y_from: int,
-                               x_to: int,
-                               y_to: int) -> GameSession | None:
-        session = self.validate_move(secret, x_from, y_from, x_to, y_to)
-        if not session:
-            return None
+        if (x_from, y_from) not in session.game_state.get_player_pieces_coordinates(whos_turn):
+            return False
+        return (x_to, y_to) in session.game_state.get_piece_moves(x_from, y_from)
 
-        session.game_state.make_move(x_from, y_from, x_to, y_to)
-        return session
+    def get_legal_moves(self, secret: str, x: int | None = None, y: int | None = None) -> LegalMoves | None:
+        """
+        All moves the player can make (or only those of the piece at x, y) at once,
+        instead of checking each cell with validate_move; calculated once per position.
+        Returns None when the session is not found by secret.
+        """
+        with self._lock_session_and_player(secret) as found:
+            if found is None:
+                return None
+            session, us = found
+            game_state = session.game_state
+            if game_state.get_whos_turn() != us:
+                return LegalMoves([], game_state.version)
+            if x is not None and y is not None:
+                moves_by_piece = { (x, y): game_state.get_piece_moves(x, y) } \
+                    if (x, y) in game_state.get_player_pieces_coordinates(us) else {}
+            else:
+                moves_by_piece = game_state.get_legal_moves_by_piece(us)
+            return LegalMoves([(x_from, y_from, moves)
+                               for (x_from, y_from), moves in moves_by_piece.items()
+                               if moves],
+                              game_state.version)
 
     def make_move(self, secret: str, x_from: int, y_from: int, x_to: int, y_to: int):
         """ Validate the move, make if valid, return PlayerViewAndStats """
-        session = self._make_move_get_session(secret, x_from, y_from, x_to, y_to)
-        if not session:
-            return None
+        with self._lock_session_and_player(secret) as found:
+            if found is None:
+                return None
+            session, us = found
+            # validated and made under the same lock, so another request can't move in between
+            if not self._is_move_valid(session, us, x_from, y_from, x_to, y_to):
+                return None
 
-        #TODO (perf): instead of getting session by secret again, overload get_player_view_and_stats and
-        # pass the session (should return result for whos_turn)
-        return self.get_player_view_and_stats(secret)
+            session.game_state.make_move(x_from, y_from, x_to, y_to)
+            if not self._save(session, self.storage.save_session):
+                # the game was changed by another process meanwhile (it will be seen on the next poll)
+                return None
+            if self.journal:
+                self.journal.record_move(session, x_from, y_from, x_to, y_to)
+            result = self._get_view_and_stats(session, us)
+            self._notify(session, us, result)
+        self._take_journal_snapshot_if_due()
+        return result
 
     def promote(self, secret: str, x: int, y: int, piece: Piece):
         """ Try to promote, return PlayerViewAndStats on success or None on failure """
-        session = self.storage.get_session_by_secret(secret)
-        if session is None:
-            return None
-        if not secret in (session.black_secret, session.white_secret):
-            return None
-
-        player = Player.black if session.black_secret == secret else Player.white
-        success = session.game_state.promote(player, x, y, piece)
-
-        return self.get_player_view_and_stats(secret) if success else None
+        with self._lock_session_and_player(secret) as found:
+            if found is None:
+                return None
+            session, player = found
+            if not session.game_state.promote(player, x, y, piece):
+                return None
+            if not self._save(session, self.storage.save_session):
+                return None
+            if self.journal:
+                self.journal.record_promotion(session, x, y, piece)
+            result = self._get_view_and_stats(session, player)
+            self._notify(session, player, result)
+        self._take_journal_snapshot_if_due()
+        return result
@@ -1,7 +1,15 @@
-from .game_sessions_manager import GameSessionsManager
-from .storage import GameSessionsStorage
+import sys
+import threading
+from pathlib import Path
+from random import Random
+import pytest
+from .game_sessions_manager import GameSessionsManager, PlayerViewChanges, PlayerViewAndStats, LegalMoves, \
+    MAX_SERVED_VIEWS_PER_PLAYER
+from .storage import GameSessionsStorage, StorageLimits
+from .journal import MoveJournal
 from .serialization import to_json
 from .game_domain.state import Player, Piece
+from .game_domain.codec import encode_state, decode_state
 
 def test_create_session():
     session_manager = GameSessionsManager(GameSessionsStorage())
@@ -66,6 +74,66 @@ def test_get_player_view_and_stats():
     assert player_view_and_stats__white.is_our_king_under_attack is False
     assert player_view_and_stats__white.winner is None
 
+def test_get_players_views_and_stats():
+    pytest.importorskip('numpy')
+    session_manager = GameSessionsManager(GameSessionsStorage())
+    white_secret, _ = session_manager.create_session()
+    other_white_secret, _ = session_manager.create_session()
+    session_manager.make_move(other_white_secret, 4, 1, 4, 3)
+
+    secrets = [white_secret, 'some garbage', other_white_secret]
+    results = session_manager.get_players_views_and_stats(secrets)
+    assert results[1] is None
+    for secret, result in zip(secrets, results):
+        if result is None:
+            continue
+        assert to_json(result) == to_json(session_manager.get_player_view_and_stats(secret))
+
+def test_get_player_view_changes():
+    session_manager = GameSessionsManager(GameSessionsStorage())
+    white_secret, _ = session_manager.create_session()
+    assert session_manager.get_player_view_changes('some garbage', 0) is None
+
+    view_and_stats = session_manager.get_player_view_and_stats(white_secret)
+    assert view_and_stats is not None
+    version = view_and_stats.version
+    session_manager.make_move(white_secret, 4, 1, 4, 3)
+
+    changes = session_manager.get_player_view_changes(white_secret, version)
+    assert isinstance(changes, PlayerViewChanges)
+    assert changes.version == version + 1
+    view = [column.copy() for column in view_and_stats.player_view]
+    for x, y, cell in changes.changed_cells:
+        view[x][y] = cell
+    new_view_and_stats = session_manager.get_player_view_and_stats(white_secret)
+    assert new_view_and_stats is not None
+    assert to_json(view) == to_json(new_view_and_stats.player_view)
+    assert (4, 1, None) in changes.changed_cells
+    # as sent by /state?since=
+    assert '[4, 1, null]' in to_json(changes)
+
+    # nothing changed
+    changes = session_manager.get_player_view_changes(white_secret, version + 1)
+    assert isinstance(changes, PlayerViewChanges)
+    assert changes.changed_cells == []
+
+    # unknown version gives the whole view
+    assert isinstance(session_manager.get_player_view_changes(white_secret, 100), PlayerViewAndStats)
+
+    # only a few recent views are remembered, encoded
+    join_result = session_manager.join_session(session_manager.get_join_secret(white_secret) or '')
+    assert join_result is not None
+    black_secret = join_result[0]
+    for black_move, white_move in [((0, 6, 0, 5), (0, 1, 0, 2)), ((1, 6, 1, 5), (1, 1, 1, 2)),
+                                   ((2, 6, 2, 5), (2, 1, 2, 2))]:
+        assert session_manager.make_move(black_secret, *black_move) is not None
+        assert session_manager.make_move(white_secret, *white_move) is not None
+    session = session_manager.storage.get_session_by_secret(white_secret)
+    assert session is not None
+    served_views = session.served_views[Player.white]
+    assert len(served_views) == MAX_SERVED_VIEWS_PER_PLAYER
+    assert all(isinstance(view, bytes) and len(view) == 32 for view in served_views.values())
+
 def test_validate_move():
     session_manager = GameSessionsManager(GameSessionsStorage())
     white_secret, _ = session_manager.create_session()
@@ -95,6 +163,43 @@ def test_validate_move():
     # an example of a valid move
     assert session_manager.validate_move(white_secret, 0, 1, 0, 2) is not None
 
+def test_get_legal_moves():
+    session_manager = GameSessionsManager(GameSessionsStorage())
+    white_secret, _ = session_manager.create_session()
+    join_result = session_manager.join_session(session_manager.get_join_secret(white_secret) or '')
+    assert join_result is not None
+    black_secret = join_result[0]
+
+    assert session_manager.get_legal_moves('some garbage') is None
+    legal_moves = session_manager.get_legal_moves(white_secret)
+    assert legal_moves is not None
+    assert legal_moves.version == 0
+    # all the pawns and knights can move
+    assert sorted((x_from, y_from) for x_from, y_from, _ in legal_moves.moves) == \
+        sorted([(x, 1) for x in range(8)] + [(1, 0), (6, 0)])
+    # same as checking each cell
+    for x_from, y_from, moves in legal_moves.moves:
+        for x_to in range(8):
+            for y_to in range(8):
+                assert (session_manager.validate_move(white_secret, x_from, y_from, x_to, y_to) is not None) == \
+                    ((x_to, y_to) in moves)
+
+    one_piece_moves = session_manager.get_legal_moves(white_secret, 1, 0)
+    assert one_piece_moves is not None
+    assert [(x, y, sorted(moves)) for x, y, moves in one_piece_moves.moves] == [(1, 0, [(0, 2), (2, 2)])]
+    # a piece that can't move, an empty cell, an opponent's piece
+    for x, y in [(0, 0), (3, 3), (1, 6)]:
+        assert session_manager.get_legal_moves(white_secret, x, y) == LegalMoves([], 0)
+    # not their turn
+    assert session_manager.get_legal_moves(black_secret) == LegalMoves([], 0)
+
+    session_manager.make_move(white_secret, 1, 1, 1, 3)
+    legal_moves = session_manager.get_legal_moves(black_secret)
+    assert legal_moves is not None
+    assert legal_moves.version == 1
+    assert len(legal_moves.moves) == 10
+    assert to_json(legal_moves).startswith('{"moves": [[')
+
 def test_make_move():
     session_manager = GameSessionsManager(GameSessionsStorage())
     white_secret, _ = session_manager.create_session()
@@ -118,6 +223,21 @@ def test_make_move():
 
     assert move_result.player_view[x_from][y_from] is None
 
+def test_make_move_looks_up_session_once():
+    storage = GameSessionsStorage()
+    session_manager = GameSessionsManager(storage)
+    white_secret, _ = session_manager.create_session()
+
+    lookups: list[str] = []
+    get_session_and_role_by_secret = storage.get_session_and_role_by_secret
+    def counting_get_session_and_role_by_secret(secret: str):
+        lookups.append(secret)
+        return get_session_and_role_by_secret(secret)
+    storage.get_session_and_role_by_secret = counting_get_session_and_role_by_secret # type: ignore
+
+    assert session_manager.make_move(white_secret, 0, 1, 0, 2) is not None
+    assert lookups == [white_secret]
+
 def test_promote():
     session_manager = GameSessionsManager(GameSessionsStorage())
 
@@ -125,3 +245,153 @@ def test_promote():
 
     #TODO: implement using a mock (like from unittest.mock import Mock):
     # test that GameState.promote is called, with correct args and return value is passed correctly
+
+def run_in_threads(target, threads: int = 8):
+    """ Runs target(thread_number) in threads started at once, switching between them often """
+    barrier = threading.Barrier(threads)
+    def run(thread_number: int):
+        barrier.wait()
+        target(thread_number)
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        started = [threading.Thread(target=run, args=(number,)) for number in range(threads)]
+        for thread in started:
+            thread.start()
+        for thread in started:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+def test_concurrent_moves_in_one_game():
+    session_manager = GameSessionsManager(GameSessionsStorage())
+    for _ in range(20):
+        white_secret, _ = session_manager.create_session()
+        results = []
+        # both are valid in the start position, only one of them can be made
+        run_in_threads(lambda number: results.append(
+            session_manager.make_move(white_secret, 0, 1, 0, 2 + number % 2)))
+        assert sum(result is not None for result in results) == 1
+        view_and_stats = session_manager.get_player_view_and_stats(white_secret)
+        assert view_and_stats is not None and view_and_stats.version == 1
+
+def test_concurrent_joins():
+    session_manager = GameSessionsManager(GameSessionsStorage())
+    white_secret, _ = session_manager.create_session()
+    join_secret = session_manager.get_join_secret(white_secret)
+    assert join_secret is not None
+    results = []
+    run_in_threads(lambda _: results.append(session_manager.join_session(join_secret)))
+    assert sum(result is not None for result in results) == 1
+
+def test_concurrent_games_stress(tmp_path: Path):
+    # few hot sessions, so that they are frozen and restored while being played
+    storage = GameSessionsStorage(StorageLimits(max_hot_sessions=2))
+    journal = MoveJournal(str(tmp_path / 'journal'), str(tmp_path / 'snapshot'),
+                          lambda: storage.export_sessions(is_locking=True), snapshot_every=100)
+    session_manager = GameSessionsManager(storage, journal)
+    secrets: list[tuple[str, str]] = []
+    for _ in range(6):
+        white_secret, _ = session_manager.create_session()
+        join_secret = session_manager.get_join_secret(white_secret)
+        assert join_secret is not None
+        join_result = session_manager.join_session(join_secret)
+        assert join_result is not None
+        secrets.append((white_secret, join_result[0]))
+    changes_made = { white_secret: 0 for white_secret, _ in secrets }
+    changes_lock = threading.Lock()
+
+    def play(thread_number: int):
+        random = Random(thread_number)
+        for _ in range(150):
+            white_secret, black_secret = random.choice(secrets)
+            secret = random.choice([white_secret, black_secret])
+            view_and_stats = session_manager.get_player_view_and_stats(secret)
+            assert view_and_stats is not None
+            # generating moves changes the state temporarily, so it's done under the lock;
+            # the session may be changed by others afterwards, so the move may be invalid when made
+            with storage.locks.hold(white_secret):
+                session = storage.get_session_by_secret(secret)
+                assert session is not None
+                moves = session.game_state.generate_legal_moves(view_and_stats.player)
+            if not moves:
+                continue
+            x_from, y_from, x_to, y_to = random.choice(moves)
+            changes = 0
+            if session_manager.make_move(secret, x_from, y_from, x_to, y_to) is not None:
+                changes += 1
+                if session_manager.promote(secret, x_to, y_to, Piece.queen) is not None:
+                    changes += 1
+            with changes_lock:
+                changes_made[white_secret] += changes
+
+    run_in_threads(play)
+    journal.close()
+
+    assert storage.locks.stats.acquisitions > 0
+    recovered_storage = GameSessionsStorage()
+    recovered_storage.import_sessions(MoveJournal(journal.path, journal.snapshot_path).recover())
+    for white_secret, _ in secrets:
+        session = storage.get_session_by_secret(white_secret)
+        assert session is not None
+        assert session.game_state.version == changes_made[white_secret]
+        # incrementally updated attack maps, etc. are the same as those built from scratch
+        rebuilt_state = decode_state(encode_state(session.game_state))
+        for player in Player:
+            assert sorted(session.game_state.generate_legal_moves(player)) == \
+                sorted(rebuilt_state.generate_legal_moves(player))
+        recovered_session = recovered_storage.get_session_by_secret(white_secret)
+        assert recovered_session is not None
+        assert to_json(recovered_session.game_state) == to_json(session.game_state)
+
+def test_updates_are_pushed_to_both_players():
+    session_manager = GameSessionsManager(GameSessionsStorage())
+    white_secret, _ = session_manager.create_session()
+    join_secret = session_manager.get_join_secret(white_secret)
+    assert join_secret is not None
+    join_result = session_manager.join_session(join_secret)
+    assert join_result is not None
+    black_secret = join_result[0]
+    assert session_manager.subscribe_to_updates('some garbage') is None
+    assert session_manager.subscribe_to_updates(join_secret) is None
+
+    white_subscription = session_manager.subscribe_to_updates(white_secret)
+    black_subscription = session_manager.subscribe_to_updates(black_secret)
+    assert white_subscription is not None and black_subscription is not None
+    # the current state comes first
+    assert white_subscription.get(0).version == 0
+    assert black_subscription.get(0).player == Player.black
+
+    result = session_manager.make_move(white_secret, 4, 1, 4, 3)
+    assert white_subscription.get(0) is result
+    black_update = black_subscription.get(0)
+    assert to_json(black_update) == to_json(session_manager.get_player_view_and_stats(black_secret))
+    assert black_update.version == 1
+
+    # invalid moves change nothing
+    assert session_manager.make_move(white_secret, 4, 3, 4, 4) is None
+    assert white_subscription.get(0) is None and black_subscription.get(0) is None
+
+    white_subscription.close()
+    session_manager.make_move(black_secret, 4, 6, 4, 4)
+    assert black_subscription.get(0).version == 2
+    black_subscription.close()
+    assert session_manager.notifier.subscribers_count == 0
+
+def test_wait_for_version_change():
+    session_manager = GameSessionsManager(GameSessionsStorage())
+    white_secret, _ = session_manager.create_session()
+    assert session_manager.get_state_version(white_secret) == 0
+    assert session_manager.get_state_version('some garbage') is None
+    assert session_manager.wait_for_version_change('some garbage', 0, 1) is None
+
+    # no waiting when the version is already different or the timeout is 0
+    assert session_manager.wait_for_version_change(white_secret, 5, 60) == 0
+    assert session_manager.wait_for_version_change(white_secret, 0) == 0
+    assert session_manager.wait_for_version_change(white_secret, 0, 0.01) == 0
+
+    timer = threading.Timer(0.01, session_manager.make_move, (white_secret, 4, 1, 4, 3))
+    timer.start()
+    assert session_manager.wait_for_version_change(white_secret, 0, 60) == 1
+    timer.join()
+    assert session_manager.notifier.subscribers_count == 0
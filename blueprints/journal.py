@@ -0,0 +1,398 @@
+"""
+Append-only journal of what happens to sessions, with periodic snapshots,
+so that games can be recovered after a restart without rewriting
+whole boards on each move (and with the history of moves).
+
+The file starts with a magic and the position it starts at in the whole
+journal (records covered by a snapshot are dropped from the file, see below).
+Each record starts with a 6-byte header: the session number (given by
+the journal) and 2 bytes of kind (2 bits) and data (14 bits):
+
+- CREATE: a new session, followed by its 3 secrets (16 bytes each, as UUIDs);
+- MOVE: x_from, y_from, x_to, y_to (3 bits each);
+- PROMOTION: x, y (3 bits each) and Piece.value (3 bits);
+- JOIN: the join secret was used (cleared).
+
+A snapshot is a file with all the sessions (secrets, the state encoded
+by codec.encode_state and the journal size when the state was taken)
+and the journal sizes when it was started and finished; recovery loads
+the latest snapshot and replays the journal from its start, skipping
+the records a session's state already has (and those of sessions dropped
+before the snapshot was finished). So snapshots are taken in a background thread while
+games go on, a session at a time. They are written to a temporary file
+and then renamed, so that a crash never leaves a broken one.
+
+After a snapshot is written, the journal is rewritten from where the snapshot
+started (the records before it are covered), also to a temporary file renamed
+over it. Positions in snapshots are those in the whole journal, and the file
+says where it starts, so a crash before or after the rename leaves a pair that
+is recovered the same way.
+
+Run `python -m blueprints.journal [games]` for a recovery benchmark.
+"""
+
+import os
+import struct
+import sys
+import tempfile
+import threading
+from time import perf_counter
+from typing import BinaryIO, Callable, Iterable
+from .game_session import GameSession, secret_to_bytes, secret_from_bytes
+from .storage import FrozenSession
+from .game_domain.state import GameState, Player, Piece
+from .game_domain.codec import encode_state, unpack_state, pack_state, BLACK_CODES_OFFSET
+
+CREATE, MOVE, PROMOTION, JOIN = range(4)
+
+JOURNAL_MAGIC = b'DCJRNL01'
+JOURNAL_HEADER = struct.Struct('<8sQ')
+HEADER = struct.Struct('<IH')
+SECRETS = struct.Struct('<16s16s16s')
+SNAPSHOT_MAGIC = b'DCSNAP02'
+SNAPSHOT_HEADER = struct.Struct('<8sQQI')
+SNAPSHOT_SESSION = struct.Struct('<I16s16s16s?QB')
+
+def _pack_cells(*values: int) -> int:
+    """ Packs values of 3 bits each, the first one in the highest bits """
+    packed = 0
+    for value in values:
+        packed = packed << 3 | value
+    return packed
+
+class MoveJournal:
+    """
+    Writes records to the journal file; after each snapshot_every records,
+    a snapshot of the sessions given by snapshot_source is due (see take_snapshot_if_due);
+    snapshot_source should yield each session while holding its lock
+    (see GameSessionsStorage.export_sessions), so that it's matched with its records.
+
+    The file is flushed after each record (but not synced to the disk).
+    Call recover before writing anything, so that session numbers continue.
+    Records can be written from several threads (those of a session should be
+    written in the order of its changes, e.g. under its lock).
+    """
+    def __init__(self,
+                 path: str,
+                 snapshot_path: str,
+                 snapshot_source: Callable[[], Iterable[FrozenSession]] | None = None,
+                 snapshot_every: int = 10_000):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.snapshot_source = snapshot_source
+        self.snapshot_every = snapshot_every
+        self._numbers: dict[str, int] = {}
+        self._next_number = 0
+        self._records_since_snapshot = 0
+        self._lock = threading.Lock()
+        self._snapshot_thread: threading.Thread | None = None
+        self._file: BinaryIO = open(path, 'ab')
+        # the position the file starts at in the whole journal
+        self._start = 0
+        if self._file.tell() == 0:
+            self._file.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, 0))
+            self._file.flush()
+        else:
+            with open(path, 'rb') as journal_file:
+                magic, self._start = JOURNAL_HEADER.unpack(journal_file.read(JOURNAL_HEADER.size))
+            if magic != JOURNAL_MAGIC:
+                self._file.close()
+                raise ValueError(f'{path} is not a journal')
+
+    def close(self) -> None:
+        """ Closes the file (after the snapshot being taken, if any) """
+        with self._lock:
+            snapshot_thread = self._snapshot_thread
+        if snapshot_thread is not None:
+            snapshot_thread.join()
+        self._file.close()
+
+    def _get_position(self) -> int:
+        """ Where the next record goes in the whole journal """
+        return self._start + self._file.tell() - JOURNAL_HEADER.size
+
+    def _get_file_offset(self, position: int) -> int:
+        return position - self._start + JOURNAL_HEADER.size
+
+    def _write(self, white_secret: str, kind: int, data: int, payload: bytes = b'') -> None:
+        with self._lock:
+            self._file.write(HEADER.pack(self._get_number(white_secret), kind << 14 | data) + payload)
+            self._file.flush()
+            self._records_since_snapshot += 1
+
+    @property
+    def is_snapshot_due(self) -> bool:
+        return self.snapshot_source is not None and self._records_since_snapshot >= self.snapshot_every
+
+    def take_snapshot_if_due(self) -> None:
+        """
+        Starts taking a snapshot of the sessions given by snapshot_source in a background thread,
+        if it's due and none is being taken (so it's fine to call it on each change)
+        """
+        with self._lock:
+            if self.snapshot_source is None or not self.is_snapshot_due or self._snapshot_thread is not None:
+                return
+            # not due again while this one is being taken
+            self._records_since_snapshot = 0
+            self._snapshot_thread = threading.Thread(target=self._take_snapshot_in_background,
+                                                     args=(self.snapshot_source,),
+                                                     daemon=True)
+            self._snapshot_thread.start()
+
+    def _take_snapshot_in_background(self, snapshot_source: Callable[[], Iterable[FrozenSession]]) -> None:
+        try:
+            self.take_snapshot(snapshot_source())
+        finally:
+            with self._lock:
+                self._snapshot_thread = None
+
+    def _get_number(self, white_secret: str) -> int:
+        number = self._numbers.get(white_secret)
+        if number is None:
+            number = self._numbers[white_secret] = self._next_number
+            self._next_number += 1
+        return number
+
+    def record_session(self, session: GameSession) -> None:
+        """ Records a new session (should be done before anything else about it) """
+        self._write(session.white_secret, CREATE, 0, SECRETS.pack(
+            secret_to_bytes(session.white_secret),
+            secret_to_bytes(session.join_secret),
+            secret_to_bytes(session.black_secret)))
+
+    def record_join(self, session: GameSession) -> None:
+        self._write(session.white_secret, JOIN, 0)
+
+    def record_move(self, session: GameSession, x_from: int, y_from: int, x_to: int, y_to: int) -> None:
+        self._write(session.white_secret, MOVE, _pack_cells(x_from, y_from, x_to, y_to))
+
+    def record_promotion(self, session: GameSession, x: int, y: int, piece: Piece) -> None:
+        self._write(session.white_secret, PROMOTION, _pack_cells(x, y, piece.value))
+
+    def take_snapshot(self, sessions: Iterable[FrozenSession]) -> None:
+        """
+        Writes all the given sessions to the snapshot file (others are forgotten),
+        then drops the records it covers from the journal.
+        Records can be written meanwhile: a session's state is expected to have
+        its records written before it's yielded, not after (e.g. yield it under its lock).
+        """
+        with self._lock:
+            journal_size = self._get_position()
+            first_new_number = self._next_number
+            self._records_since_snapshot = 0
+        numbers: dict[str, int] = {}
+        chunks: list[bytes] = []
+        for session in sessions:
+            with self._lock:
+                session_journal_size = self._get_position()
+                number = numbers[session.white_secret] = self._get_number(session.white_secret)
+            chunks.append(SNAPSHOT_SESSION.pack(number,
+                                                secret_to_bytes(session.white_secret),
+                                                secret_to_bytes(session.join_secret),
+                                                secret_to_bytes(session.black_secret),
+                                                session.join_secret is not None,
+                                                session_journal_size,
+                                                len(session.encoded_state)))
+            chunks.append(session.encoded_state)
+        with self._lock:
+            snapshot_end = self._get_position()
+
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as snapshot_file:
+            snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, journal_size, snapshot_end, len(numbers)))
+            snapshot_file.write(b''.join(chunks))
+        os.replace(snapshot_file.name, self.snapshot_path)
+
+        with self._lock:
+            # sessions created meanwhile keep their numbers, even if they aren't in the snapshot
+            self._numbers = numbers | { white_secret: number
+                                        for white_secret, number in self._numbers.items()
+                                        if number >= first_new_number }
+            # only the records written while the snapshot was taken are copied
+            self._start_at(journal_size)
+
+    def _start_at(self, position: int) -> None:
+        """ Rewrites the file without the records before the position (call under the lock) """
+        with open(self.path, 'rb') as journal_file:
+            journal_file.seek(self._get_file_offset(position))
+            records = journal_file.read()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as journal_file:
+            journal_file.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, position) + records)
+        self._file.close()
+        os.replace(journal_file.name, self.path)
+        self._file = open(self.path, 'ab')
+        self._start = position
+
+    def recover(self) -> list[FrozenSession]:
+        """
+        Loads the latest snapshot and replays the journal after it.
+        Only sessions changed after the snapshot are decoded, others are returned as they are.
+        The journal is cut after the last complete record (one cut short by a crash, or anything
+        after a record of an unknown session, is dropped), so that new records follow it.
+        """
+        sessions: dict[int, FrozenSession] = {}
+        # where the replay of each session from the snapshot starts
+        sessions_journal_sizes: dict[int, int] = {}
+        journal_offset = snapshot_end = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as snapshot_file:
+                data = snapshot_file.read()
+            magic, journal_offset, snapshot_end, count = SNAPSHOT_HEADER.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError(f'{self.snapshot_path} is not a snapshot')
+            offset = SNAPSHOT_HEADER.size
+            for _ in range(count):
+                number, white, join, black, has_join, sessions_journal_sizes[number], state_size = \
+                    SNAPSHOT_SESSION.unpack_from(data, offset)
+                offset += SNAPSHOT_SESSION.size
+                sessions[number] = FrozenSession(secret_from_bytes(white),
+                                                 secret_from_bytes(join) if has_join else None,
+                                                 secret_from_bytes(black),
+                                                 data[offset:offset + state_size])
+                offset += state_size
+
+        if journal_offset < self._start:
+            raise ValueError(f'{self.path} starts after {self.snapshot_path} does')
+
+        # sessions changed after the snapshot, to be encoded back in the end
+        changed: dict[int, _ReplayedSession] = {}
+        with open(self.path, 'rb') as journal_file:
+            journal_file.seek(self._get_file_offset(journal_offset))
+            data = journal_file.read()
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            number, kind_and_data = HEADER.unpack_from(data, offset)
+            kind, record_data = kind_and_data >> 14, kind_and_data & 0x3FFF
+            record_size = HEADER.size + (SECRETS.size if kind == CREATE else 0)
+            # an incomplete record in the end (if the process was killed while writing it)
+            if offset + record_size > len(data):
+                break
+            # the session's state in the snapshot has it already
+            if journal_offset + offset < sessions_journal_sizes.get(number, 0):
+                offset += record_size
+                continue
+            if kind == CREATE:
+                white, join, black = SECRETS.unpack_from(data, offset + HEADER.size)
+                sessions.pop(number, None)
+                changed[number] = _ReplayedSession(FrozenSession(secret_from_bytes(white),
+                                                                 secret_from_bytes(join),
+                                                                 secret_from_bytes(black),
+                                                                 _NEW_GAME_STATE))
+                offset += record_size
+                continue
+
+            session = changed.get(number)
+            if session is None:
+                if number not in sessions:
+                    # of a session dropped while the snapshot was taken
+                    if journal_offset + offset < snapshot_end:
+                        offset += record_size
+                        continue
+                    # a corrupted record: nothing after it can be trusted
+                    break
+                session = changed[number] = _ReplayedSession(sessions.pop(number))
+            offset += record_size
+            if kind == MOVE:
+                session.move(record_data >> 9, record_data >> 6 & 7, record_data >> 3 & 7, record_data & 7)
+            elif kind == PROMOTION:
+                session.promote(record_data >> 6, record_data >> 3 & 7, record_data & 7)
+            else:
+                session.join_secret = None
+
+        if offset < len(data):
+            with self._lock:
+                self._file.truncate(self._get_file_offset(journal_offset + offset))
+
+        for number, session in changed.items():
+            sessions[number] = session.freeze()
+        self._numbers = { session.white_secret: number for number, session in sessions.items() }
+        self._next_number = max(sessions, default=-1) + 1
+        return list(sessions.values())
+
+_NEW_GAME_STATE = encode_state(GameState())
+
+class _ReplayedSession:
+    """
+    A session the journal is replayed on: moves and promotions are applied
+    to the cells' codes (see codec.unpack_state) the way GameState applies them,
+    without updating attack maps, etc. (they were validated when recorded)
+    """
+    def __init__(self, frozen_session: FrozenSession):
+        self.white_secret = frozen_session.white_secret
+        self.join_secret = frozen_session.join_secret
+        self.black_secret = frozen_session.black_secret
+        self.cells, self.is_blacks_turn, self.is_waiting_for_promotion, self.version = \
+            unpack_state(frozen_session.encoded_state)
+
+    def move(self, x_from: int, y_from: int, x_to: int, y_to: int) -> None:
+        code = self.cells[y_from << 3 | x_from]
+        if self.is_waiting_for_promotion or not code:
+            return
+        self.cells[y_to << 3 | x_to] = code
+        self.cells[y_from << 3 | x_from] = 0
+        self.version += 1
+        self.is_waiting_for_promotion = \
+            code == Piece.pawn.value and y_to == 7 or \
+            code == Piece.pawn.value + BLACK_CODES_OFFSET and y_to == 0
+        if not self.is_waiting_for_promotion:
+            self.is_blacks_turn = not self.is_blacks_turn
+
+    def promote(self, x: int, y: int, piece_value: int) -> None:
+        self.cells[y << 3 | x] = piece_value + (BLACK_CODES_OFFSET if self.is_blacks_turn else 0)
+        self.version += 1
+        self.is_waiting_for_promotion = False
+        self.is_blacks_turn = not self.is_blacks_turn
+
+    def freeze(self) -> FrozenSession:
+        return FrozenSession(self.white_secret,
+                             self.join_secret,
+                             self.black_secret,
+                             pack_state(self.cells, self.is_blacks_turn, self.is_waiting_for_promotion, self.version))
+
+def run_recovery_benchmark(games: int, moves_per_game: int = 40, directory: str | None = None) -> dict[str, float]:
+    """ Plays random games with a journal, recovers them with and without a snapshot """
+    from random import Random
+    from .storage import GameSessionsStorage
+    from .game_sessions_manager import GameSessionsManager
+
+    random = Random(0)
+    with tempfile.TemporaryDirectory(dir=directory) as temporary_directory:
+        storage = GameSessionsStorage()
+        journal = MoveJournal(os.path.join(temporary_directory, 'journal'),
+                              os.path.join(temporary_directory, 'snapshot'),
+                              storage.export_sessions,
+                              snapshot_every=sys.maxsize)
+        session_manager = GameSessionsManager(storage, journal)
+        secrets = [session_manager.create_session()[0] for _ in range(games)]
+        sessions = [storage.get_session_by_secret(secret) for secret in secrets]
+        for _ in range(moves_per_game):
+            for session in sessions:
+                assert session is not None
+                whos_turn = session.game_state.get_whos_turn()
+                secret = session.white_secret if whos_turn == Player.white else session.black_secret
+                moves = session.game_state.generate_legal_moves(whos_turn)
+                if not moves:
+                    continue
+                x_from, y_from, x_to, y_to = random.choice(moves)
+                session_manager.make_move(secret, x_from, y_from, x_to, y_to)
+                if session.game_state.is_waiting_for_promotion:
+                    session_manager.promote(secret, x_to, y_to, Piece.queen)
+        journal.close()
+
+        results: dict[str, float] = {}
+        started_at = perf_counter()
+        MoveJournal(journal.path, journal.snapshot_path).recover()
+        results['replay games/s'] = games / (perf_counter() - started_at)
+
+        journal = MoveJournal(journal.path, journal.snapshot_path)
+        journal.take_snapshot(storage.export_sessions())
+        journal.close()
+        started_at = perf_counter()
+        MoveJournal(journal.path, journal.snapshot_path).recover()
+        results['snapshot games/s'] = games / (perf_counter() - started_at)
+    return results
+
+if __name__ == '__main__':
+    for name, value in run_recovery_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 200).items():
+        print(f'{name:>18}: {value:12,.0f}')
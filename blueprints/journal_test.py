@@ -0,0 +1,185 @@
+import os
+import threading
+from pathlib import Path
+from random import Random
+from typing import Iterator
+from .journal import MoveJournal, HEADER, JOURNAL_HEADER, MOVE, run_recovery_benchmark
+from .storage import GameSessionsStorage
+from .game_session import FrozenSession
+from .game_sessions_manager import GameSessionsManager
+from .game_domain.state import Player, Piece
+from .game_domain.codec import encode_state, unpack_state
+from .serialization import to_json
+
+def play_random_moves(session_manager: GameSessionsManager, secrets: list[tuple[str, str]], moves: int, seed: int):
+    random = Random(seed)
+    for _ in range(moves):
+        for white_secret, black_secret in secrets:
+            session = session_manager.storage.get_session_by_secret(white_secret)
+            assert session is not None
+            whos_turn = session.game_state.get_whos_turn()
+            secret = white_secret if whos_turn == Player.white else black_secret
+            legal_moves = session.game_state.generate_legal_moves(whos_turn)
+            if not legal_moves:
+                continue
+            x_from, y_from, x_to, y_to = random.choice(legal_moves)
+            session_manager.make_move(secret, x_from, y_from, x_to, y_to)
+            if session.game_state.is_waiting_for_promotion:
+                session_manager.promote(secret, x_to, y_to, random.choice([Piece.queen, Piece.knight]))
+
+def create_games(session_manager: GameSessionsManager, games: int) -> list[tuple[str, str]]:
+    secrets = []
+    for _ in range(games):
+        white_secret, _ = session_manager.create_session()
+        join_secret = session_manager.get_join_secret(white_secret)
+        assert join_secret is not None
+        join_result = session_manager.join_session(join_secret)
+        assert join_result is not None
+        secrets.append((white_secret, join_result[0]))
+    return secrets
+
+def assert_recovered(storage: GameSessionsStorage, journal: MoveJournal):
+    recovered_storage = GameSessionsStorage()
+    recovered_storage.import_sessions(MoveJournal(journal.path, journal.snapshot_path).recover())
+    sessions = list(storage.export_sessions())
+    assert recovered_storage.stats.frozen_sessions == len(sessions)
+    for session in sessions:
+        recovered_session = recovered_storage.get_session_by_secret(session.white_secret)
+        assert recovered_session is not None
+        assert recovered_session.join_secret == session.join_secret
+        assert recovered_session.black_secret == session.black_secret
+        original_session = storage.get_session_by_secret(session.white_secret)
+        assert original_session is not None
+        assert to_json(recovered_session.game_state) == to_json(original_session.game_state)
+
+def test_recover_from_journal(tmp_path: Path):
+    storage = GameSessionsStorage()
+    journal = MoveJournal(str(tmp_path / 'journal'), str(tmp_path / 'snapshot'))
+    session_manager = GameSessionsManager(storage, journal)
+    secrets = create_games(session_manager, 5)
+    # a session nobody joined
+    session_manager.create_session()
+    play_random_moves(session_manager, secrets, 60, seed=1)
+    journal.close()
+
+    assert_recovered(storage, journal)
+
+def test_recover_from_snapshot_and_journal(tmp_path: Path):
+    storage = GameSessionsStorage()
+    journal = MoveJournal(str(tmp_path / 'journal'), str(tmp_path / 'snapshot'),
+                          lambda: storage.export_sessions(is_locking=True), snapshot_every=50)
+    session_manager = GameSessionsManager(storage, journal)
+    secrets = create_games(session_manager, 3)
+    play_random_moves(session_manager, secrets, 30, seed=2)
+    journal.close()
+    assert os.path.exists(journal.snapshot_path)
+
+    assert_recovered(storage, journal)
+
+    # writing continues after recovery
+    journal = MoveJournal(journal.path, journal.snapshot_path)
+    recovered_storage = GameSessionsStorage()
+    recovered_storage.import_sessions(journal.recover())
+    session_manager = GameSessionsManager(recovered_storage, journal)
+    secrets += create_games(session_manager, 1)
+    play_random_moves(session_manager, secrets, 10, seed=3)
+    journal.close()
+
+    assert_recovered(recovered_storage, journal)
+
+def test_snapshot_is_taken_while_games_go_on(tmp_path: Path):
+    storage = GameSessionsStorage()
+    secrets: list[tuple[str, str]] = []
+    is_exporting, can_continue = threading.Event(), threading.Event()
+
+    def export_sessions() -> Iterator[FrozenSession]:
+        # each session under its lock, pausing between the first and the second one
+        for index, (white_secret, _) in enumerate(secrets):
+            if index == 1:
+                is_exporting.set()
+                assert can_continue.wait(5)
+            with storage.locks.hold(white_secret):
+                session = storage.get_session_by_secret(white_secret)
+                assert session is not None
+                yield FrozenSession(session.white_secret, session.join_secret, session.black_secret,
+                                    encode_state(session.game_state))
+
+    journal = MoveJournal(str(tmp_path / 'journal'), str(tmp_path / 'snapshot'), export_sessions, snapshot_every=10)
+    session_manager = GameSessionsManager(storage, journal)
+    secrets += create_games(session_manager, 2)
+    play_random_moves(session_manager, secrets, 3, seed=4)
+    assert is_exporting.wait(5)
+
+    # moves of both games (one of them is in the snapshot already) and a new game don't wait for the snapshot
+    play_random_moves(session_manager, secrets, 5, seed=5)
+    create_games(session_manager, 1)
+    can_continue.set()
+    journal.close()
+    assert os.path.exists(journal.snapshot_path)
+
+    assert_recovered(storage, journal)
+
+def test_records_covered_by_snapshot_are_dropped(tmp_path: Path):
+    storage = GameSessionsStorage()
+    journal = MoveJournal(str(tmp_path / 'journal'), str(tmp_path / 'snapshot'))
+    session_manager = GameSessionsManager(storage, journal)
+    secrets = create_games(session_manager, 2)
+    play_random_moves(session_manager, secrets, 10, seed=6)
+
+    journal.take_snapshot(storage.export_sessions())
+    assert os.path.getsize(journal.path) == JOURNAL_HEADER.size
+    play_random_moves(session_manager, secrets, 5, seed=7)
+    assert_recovered(storage, journal)
+
+    # as if the process crashed after writing the next snapshot, but before rewriting the journal
+    with open(journal.path, 'rb') as journal_file:
+        records = journal_file.read()
+    assert len(records) > JOURNAL_HEADER.size
+    journal.take_snapshot(storage.export_sessions())
+    journal.close()
+    with open(journal.path, 'wb') as journal_file:
+        journal_file.write(records)
+    assert_recovered(storage, journal)
+
+def test_incomplete_record_is_ignored(tmp_path: Path):
+    storage = GameSessionsStorage()
+    journal = MoveJournal(str(tmp_path / 'journal'), str(tmp_path / 'snapshot'))
+    session_manager = GameSessionsManager(storage, journal)
+    create_games(session_manager, 1)
+    journal.close()
+    with open(journal.path, 'ab') as journal_file:
+        journal_file.write(HEADER.pack(1, 0) + b'\x00' * 10)
+
+    # records written after the restart follow the complete ones
+    journal = MoveJournal(journal.path, journal.snapshot_path)
+    storage = GameSessionsStorage()
+    storage.import_sessions(journal.recover())
+    assert len(list(storage.export_sessions())) == 1
+    session_manager = GameSessionsManager(storage, journal)
+    white_secret = session_manager.create_session()[0]
+    assert session_manager.make_move(white_secret, 1, 1, 1, 3) is not None
+    journal.close()
+
+    recovered = { session.white_secret: session for session in MoveJournal(journal.path, journal.snapshot_path).recover() }
+    assert len(recovered) == 2
+    assert unpack_state(recovered[white_secret].encoded_state)[3] == 1
+
+def test_record_of_unknown_session_stops_replay(tmp_path: Path):
+    storage = GameSessionsStorage()
+    journal = MoveJournal(str(tmp_path / 'journal'), str(tmp_path / 'snapshot'))
+    session_manager = GameSessionsManager(storage, journal)
+    create_games(session_manager, 1)
+    journal.close()
+    with open(journal.path, 'ab') as journal_file:
+        journal_file.write(HEADER.pack(7, MOVE << 14))
+    size = os.path.getsize(journal.path)
+
+    journal = MoveJournal(journal.path, journal.snapshot_path)
+    assert len(journal.recover()) == 1
+    journal.close()
+    assert os.path.getsize(journal.path) == size - HEADER.size
+
+def test_run_recovery_benchmark(tmp_path: Path):
+    results = run_recovery_benchmark(5, 5, str(tmp_path))
+    assert results['replay games/s'] > 0
+    assert results['snapshot games/s'] > 0
@@ -0,0 +1,88 @@
+"""
+Locks for sessions changed by several threads (Flask serves requests in threads).
+
+A lock per session would have to be created and removed along with
+sessions; instead, sessions are mapped to a fixed number of locks
+(stripes) by a hash of their white_secret: different games rarely
+share a stripe, so they rarely wait for each other, while everything
+done to one game is serialized.
+
+Each stripe counts how many times it was acquired and how many times
+it was already taken (contended), so that the number of stripes can be tuned.
+"""
+
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Iterable, Iterator
+
+DEFAULT_STRIPES = 64
+
+@dataclass
+class LockStats:
+    acquisitions: int = 0
+    contentions: int = 0
+    wait_time: float = 0.0
+
+class _Stripe:
+    """ A lock that counts its acquisitions (the counters are changed by the thread that acquired it) """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = LockStats()
+
+    def __enter__(self) -> None:
+        if self.lock.acquire(blocking=False):
+            self.stats.acquisitions += 1
+            return
+        started_at = perf_counter()
+        self.lock.acquire()
+        self.stats.acquisitions += 1
+        self.stats.contentions += 1
+        self.stats.wait_time += perf_counter() - started_at
+
+    def __exit__(self, *_) -> None:
+        self.lock.release()
+
+class StripedLock:
+    """ Locks by key (any hashable), mapped to a fixed number of stripes """
+    def __init__(self, stripes: int = DEFAULT_STRIPES):
+        self._stripes = [_Stripe() for _ in range(stripes)]
+
+    def _get_stripe_number(self, key) -> int:
+        return hash(key) % len(self._stripes)
+
+    def hold(self, key) -> _Stripe:
+        """ Holds the key's stripe, use as `with locks.hold(key):` (not reentrant) """
+        return self._stripes[self._get_stripe_number(key)]
+
+    def hold_many(self, keys: Iterable):
+        """ Holds the stripes of all the keys, taken in order so that threads doing this don't deadlock """
+        return self._hold_stripes(sorted({self._get_stripe_number(key) for key in keys}))
+
+    def hold_all(self):
+        """ Holds all the stripes, e.g. to take a consistent snapshot """
+        return self._hold_stripes(range(len(self._stripes)))
+
+    @contextmanager
+    def _hold_stripes(self, stripes: Iterable[int]) -> Iterator[None]:
+        held: list[_Stripe] = []
+        try:
+            for stripe in stripes:
+                self._stripes[stripe].__enter__()
+                held.append(self._stripes[stripe])
+            yield
+        finally:
+            for held_stripe in reversed(held):
+                held_stripe.__exit__()
+
+    def is_locked(self, key) -> bool:
+        """ Whether the key's stripe is held by some thread """
+        return self._stripes[self._get_stripe_number(key)].lock.locked()
+
+    @property
+    def stats(self) -> LockStats:
+        """ Sums of all the stripes' counters """
+        return LockStats(sum(stripe.stats.acquisitions for stripe in self._stripes),
+                         sum(stripe.stats.contentions for stripe in self._stripes),
+                         sum(stripe.stats.wait_time for stripe in self._stripes))
@@ -0,0 +1,45 @@
+import threading
+from .locking import StripedLock
+
+def test_hold():
+    locks = StripedLock(4)
+    with locks.hold('a'):
+        assert locks.is_locked('a')
+    assert not locks.is_locked('a')
+    assert locks.stats.acquisitions == 1
+    assert locks.stats.contentions == 0
+
+def test_hold_many_and_all():
+    locks = StripedLock(4)
+    with locks.hold_many(['a', 'b', 'a']):
+        assert locks.is_locked('a') and locks.is_locked('b')
+    with locks.hold_all():
+        assert all(locks.is_locked(key) for key in range(4))
+    assert not any(locks.is_locked(key) for key in range(4))
+
+def test_contention_is_counted():
+    locks = StripedLock(1)
+    is_held = threading.Event()
+    release = threading.Event()
+    def hold():
+        with locks.hold('a'):
+            is_held.set()
+            release.wait()
+    holder = threading.Thread(target=hold)
+    holder.start()
+    is_held.wait()
+
+    def wait():
+        with locks.hold('b'):
+            pass
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    # 'b' is mapped to the only stripe, so the waiter waits for the holder
+    waiter.join(0.05)
+    assert waiter.is_alive()
+    release.set()
+    holder.join()
+    waiter.join()
+    assert locks.stats.acquisitions == 2
+    assert locks.stats.contentions == 1
+    assert locks.stats.wait_time > 0
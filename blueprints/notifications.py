@@ -0,0 +1,99 @@
+"""
+Pushing game updates to players (e.g. via Server-Sent Events, see app.py)
+instead of them polling the state.
+
+A player subscribes by their secret and gets PlayerViewAndStats each time
+the game changes. Only the latest update is kept for a subscriber: it
+contains the whole view, so a slow client skips the intermediate ones
+instead of accumulating them.
+
+Subscribers are kept in the process, so with several worker processes
+(see redis_storage.py) only changes made by the subscriber's process are pushed;
+clients should still poll occasionally (or reconnect) in that case.
+"""
+
+import threading
+from typing import Any, Callable
+from .game_domain.state import Player
+from .serialization import to_json
+
+class Subscription:
+    """
+    Updates of one player's game, taken by get; on_publish is called after each update,
+    e.g. to wake an asyncio task (via call_soon_threadsafe) instead of blocking a thread in get
+    """
+    def __init__(self,
+                 notifier: 'UpdatesNotifier',
+                 key: tuple[str, Player],
+                 on_publish: Callable[[], None] | None = None):
+        self._notifier = notifier
+        self._key = key
+        self._on_publish = on_publish
+        self._condition = threading.Condition()
+        self._latest: Any = None
+        self.is_closed = False
+
+    def publish(self, update: Any) -> None:
+        """ Replaces the update not taken yet, if any """
+        with self._condition:
+            self._latest = update
+            self._condition.notify_all()
+        if self._on_publish is not None:
+            self._on_publish()
+
+    def get(self, timeout: float | None = None) -> Any:
+        """ Waits for an update, returns None if there's none in timeout seconds or if closed """
+        with self._condition:
+            self._condition.wait_for(lambda: self._latest is not None or self.is_closed, timeout)
+            update, self._latest = self._latest, None
+        return update
+
+    def close(self) -> None:
+        self._notifier._unsubscribe(self._key, self)
+        with self._condition:
+            self.is_closed = True
+            self._condition.notify_all()
+
+class UpdatesNotifier:
+    """ Subscriptions by the session (its white_secret) and player """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # dicts as ordered sets, so that closing one of many subscriptions is cheap
+        self._subscriptions: dict[tuple[str, Player], dict[Subscription, None]] = {}
+
+    def subscribe(self,
+                  white_secret: str,
+                  player: Player,
+                  on_publish: Callable[[], None] | None = None) -> Subscription:
+        key = (white_secret, player)
+        subscription = Subscription(self, key, on_publish)
+        with self._lock:
+            self._subscriptions.setdefault(key, {})[subscription] = None
+        return subscription
+
+    def _unsubscribe(self, key: tuple[str, Player], subscription: Subscription) -> None:
+        with self._lock:
+            subscriptions = self._subscriptions.get(key, {})
+            subscriptions.pop(subscription, None)
+            if not subscriptions:
+                self._subscriptions.pop(key, None)
+
+    def has_subscribers(self, white_secret: str, player: Player) -> bool:
+        """ To avoid calculating an update nobody waits for """
+        return (white_secret, player) in self._subscriptions
+
+    def publish(self, white_secret: str, player: Player, update: Any) -> None:
+        with self._lock:
+            subscriptions = list(self._subscriptions.get((white_secret, player), {}))
+        for subscription in subscriptions:
+            subscription.publish(update)
+
+    @property
+    def subscribers_count(self) -> int:
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+def to_server_sent_event(update: Any) -> str:
+    """ An event of the text/event-stream format with the update as JSON (and its version as the id, if any) """
+    version = getattr(update, 'version', None)
+    return (f'id: {version}\n' if version is not None else '') + f'data: {to_json(update)}\n\n'
@@ -0,0 +1,45 @@
+import threading
+from dataclasses import dataclass
+from .notifications import UpdatesNotifier, to_server_sent_event
+from .game_domain.state import Player
+
+def test_publish_and_get():
+    notifier = UpdatesNotifier()
+    subscription = notifier.subscribe('a', Player.white)
+    other_subscription = notifier.subscribe('a', Player.black)
+    assert notifier.has_subscribers('a', Player.white)
+    assert not notifier.has_subscribers('b', Player.white)
+
+    notifier.publish('a', Player.white, 1)
+    # only the latest update is kept
+    notifier.publish('a', Player.white, 2)
+    assert subscription.get(0) == 2
+    assert subscription.get(0) is None
+    assert other_subscription.get(0) is None
+
+def test_get_waits_for_update():
+    notifier = UpdatesNotifier()
+    subscription = notifier.subscribe('a', Player.white)
+    timer = threading.Timer(0.01, notifier.publish, ('a', Player.white, 1))
+    timer.start()
+    assert subscription.get(5) == 1
+    timer.join()
+
+def test_close():
+    notifier = UpdatesNotifier()
+    subscription = notifier.subscribe('a', Player.white)
+    timer = threading.Timer(0.01, subscription.close)
+    timer.start()
+    assert subscription.get(5) is None
+    timer.join()
+    assert subscription.is_closed
+    assert not notifier.has_subscribers('a', Player.white)
+    assert notifier.subscribers_count == 0
+
+@dataclass
+class Update:
+    version: int
+
+def test_to_server_sent_event():
+    assert to_server_sent_event({'a': 1}) == 'data: {"a": 1}\n\n'
+    assert to_server_sent_event(Update(3)) == 'id: 3\ndata: {"version": 3}\n\n'
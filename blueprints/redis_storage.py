@@ -0,0 +1,302 @@
+"""
+Storage of sessions in a Redis-protocol server, shared by several
+processes (e.g. gunicorn workers), so that a player can be served by any of them.
+
+A session is stored under each of its secrets (so that it's found by
+any of them in one request): the secrets (16 bytes each, see
+game_session.secret_to_bytes), whether the join secret is set and
+the state encoded by codec.encode_state. Writes of all the keys are
+pipelined in one transaction, which is only applied if the session wasn't
+changed by another process since it was read (WATCH), otherwise
+StaleSessionError is raised. Keys expire after ttl seconds without changes.
+
+Connections are pooled; the protocol is implemented here (a small subset),
+so no client library is needed. See resp_server.py for a stand-in server.
+"""
+
+import socket
+import struct
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+from .storage import IGameSessionStorage, StaleSessionError
+from .locking import StripedLock
+from .game_session import GameSession, SecretRole, secret_to_bytes, secret_from_bytes
+from .game_domain.codec import encode_state, decode_state
+
+SESSION_HEADER = struct.Struct('<16s16s16s?')
+
+class RespError(Exception):
+    """ An error reply of the server """
+
+def _encode_command(command: tuple) -> bytes:
+    parts = [b'*%d\r\n' % len(command)]
+    for argument in command:
+        if isinstance(argument, str):
+            argument = argument.encode()
+        elif isinstance(argument, int):
+            argument = b'%d' % argument
+        parts.append(b'$%d\r\n%s\r\n' % (len(argument), argument))
+    return b''.join(parts)
+
+class RespConnection:
+    """ A connection to a Redis-protocol server """
+    def __init__(self, host: str, port: int, timeout: float):
+        self._socket = socket.create_connection((host, port), timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._socket.makefile('rb')
+
+    def close(self) -> None:
+        self._reader.close()
+        self._socket.close()
+
+    def execute(self, *commands: tuple) -> list:
+        """
+        Sends the commands at once (pipelined), returns their replies:
+        bytes, int, str (simple strings), None, lists, or RespError (not raised)
+        """
+        self._socket.sendall(b''.join(_encode_command(command) for command in commands))
+        return [self._read_reply() for _ in commands]
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('connection closed by the server')
+        kind, data = line[:1], line[1:-2]
+        if kind == b'+':
+            return data.decode()
+        if kind == b'-':
+            return RespError(data.decode())
+        if kind == b':':
+            return int(data)
+        if kind == b'$':
+            size = int(data)
+            return None if size < 0 else self._reader.read(size + 2)[:-2]
+        if kind == b'*':
+            size = int(data)
+            return None if size < 0 else [self._read_reply() for _ in range(size)]
+        raise ConnectionError(f'unexpected reply {line!r}')
+
+class RespConnectionPool:
+    """ Keeps up to max_idle connections open to reuse them; a connection is used by one thread at a time """
+    def __init__(self, host: str, port: int, max_idle: int = 8, timeout: float = 5.0):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.connections_opened = 0
+        self._idle: list[RespConnection] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self) -> Iterator[RespConnection]:
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                self.connections_opened += 1
+        if connection is None:
+            connection = RespConnection(self.host, self.port, self.timeout)
+        try:
+            yield connection
+        except BaseException:
+            # the connection may be broken or in the middle of a reply
+            connection.close()
+            raise
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                connection = None
+        if connection is not None:
+            connection.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+@dataclass
+class RedisStorageStats:
+    round_trips: int = 0
+    conflicts: int = 0
+    reused_sessions: int = 0
+
+class RedisGameSessionsStorage(IGameSessionStorage):
+    """
+    Sessions in a Redis-protocol server at host:port, under keys starting with prefix.
+
+    Sessions are read from the server on each lookup (another process may
+    have changed them); the session object is reused while its stored
+    value doesn't change, so what's cached in it (views, see GameState._get_derived)
+    survives between requests. max_cached_sessions limits such objects.
+    """
+    def __init__(self,
+                 host: str = 'localhost',
+                 port: int = 6379,
+                 prefix: str = 'dark_chess:',
+                 ttl: int = 7 * 24 * 60 * 60,
+                 pool_size: int = 8,
+                 max_cached_sessions: int = 10_000):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.max_cached_sessions = max_cached_sessions
+        self.pool = RespConnectionPool(host, port, pool_size)
+        self.stats = RedisStorageStats()
+        self.locks = StripedLock()
+        self._lock = threading.Lock()
+        # by white_secret, from the least recently used: the stored value and the session made from it
+        self._cached_sessions: OrderedDict[str, tuple[bytes, GameSession]] = OrderedDict()
+        # secrets of the cached sessions to their white_secret
+        self._white_secrets: dict[str, str] = {}
+
+    def close(self) -> None:
+        self.pool.close()
+
+    def _key(self, secret: str) -> bytes:
+        return (self.prefix + secret).encode()
+
+    def _execute(self, *commands: tuple) -> list:
+        with self.pool.connection() as connection:
+            replies = connection.execute(*commands)
+        with self._lock:
+            self.stats.round_trips += 1
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def create_session(self):
+        """ Create a new session, store and return it """
+        session = GameSession()
+        value = _encode_session(session)
+        self._execute(*self._set_commands(session, value))
+        self._cache(session, value)
+        return session
+
+    def _set_commands(self, session: GameSession, value: bytes) -> list[tuple]:
+        return [('SET', self._key(secret), value, 'EX', self.ttl)
+                for secret in (session.white_secret, session.black_secret, session.join_secret)
+                if secret is not None]
+
+    def get_session_by_secret(self, secret: str):
+        """ Find session by any secret (join, white, black) """
+        found = self.get_session_and_role_by_secret(secret)
+        return found[0] if found is not None else None
+
+    def get_session_and_role_by_secret(self, secret: str):
+        """ Find session by any secret, tell which of its secrets it is """
+        value, = self._execute(('GET', self._key(secret)))
+        if value is None:
+            return None
+        white_secret, join_secret, black_secret, encoded_state = _decode_session(value)
+        role = SecretRole.white if secret == white_secret else \
+               SecretRole.black if secret == black_secret else \
+               SecretRole.join if secret == join_secret else None
+        if role is None:
+            return None
+
+        with self._lock:
+            cached = self._cached_sessions.get(white_secret)
+            if cached is not None and cached[0] == value:
+                self._cached_sessions.move_to_end(white_secret)
+                self.stats.reused_sessions += 1
+                return cached[1], role
+        session = GameSession.restore(white_secret, join_secret, black_secret, decode_state(encoded_state))
+        self._cache(session, value)
+        return session, role
+
+    def get_white_secret(self, secret: str):
+        """ Find the session's white_secret by any secret (known ones aren't requested again) """
+        with self._lock:
+            white_secret = self._white_secrets.get(secret)
+        if white_secret is not None:
+            return white_secret
+        found = self.get_session_and_role_by_secret(secret)
+        return found[0].white_secret if found is not None else None
+
+    def clear_join_secret(self, session: GameSession):
+        """ Remove the join secret of the session, so that it can't be used anymore """
+        join_secret = session.join_secret
+        session.join_secret = None
+        if join_secret is not None:
+            with self._lock:
+                self._white_secrets.pop(join_secret, None)
+            self._store(session, [self._key(join_secret)])
+
+    def save_session(self, session: GameSession):
+        """ Store the session, unless it was changed by another process (raises StaleSessionError then) """
+        self._store(session)
+
+    def _store(self, session: GameSession, deleted_keys: list[bytes] | None = None) -> None:
+        with self._lock:
+            cached = self._cached_sessions.get(session.white_secret)
+        white_key = self._key(session.white_secret)
+        value = _encode_session(session)
+        try:
+            with self.pool.connection() as connection:
+                _, stored_value = connection.execute(('WATCH', white_key), ('GET', white_key))
+                if cached is not None and cached[0] == stored_value:
+                    transaction = connection.execute(('MULTI',),
+                                                     *self._set_commands(session, value),
+                                                     *([('DEL', *deleted_keys)] if deleted_keys else []),
+                                                     ('EXEC',))[-1]
+                else:
+                    connection.execute(('UNWATCH',))
+                    transaction = None
+            with self._lock:
+                self.stats.round_trips += 2
+                if transaction is None:
+                    self.stats.conflicts += 1
+            if transaction is None:
+                raise StaleSessionError(f'session {session.white_secret} was changed by another process')
+            if isinstance(transaction, RespError):
+                raise transaction
+        except BaseException:
+            # the object has changes that weren't stored, the next lookup reads what is
+            self.discard_session(session)
+            raise
+        self._cache(session, value)
+
+    def discard_session(self, session: GameSession) -> None:
+        """ Drops the cached object of the session """
+        with self._lock:
+            if self._cached_sessions.get(session.white_secret, (None, None))[1] is session:
+                del self._cached_sessions[session.white_secret]
+
+    def _cache(self, session: GameSession, value: bytes) -> None:
+        with self._lock:
+            self._cached_sessions[session.white_secret] = (value, session)
+            self._cached_sessions.move_to_end(session.white_secret)
+            for secret in (session.white_secret, session.black_secret, session.join_secret):
+                if secret is not None:
+                    self._white_secrets[secret] = session.white_secret
+
+            excess = len(self._cached_sessions) - self.max_cached_sessions
+            keys_to_uncache = []
+            for key in self._cached_sessions:
+                if len(keys_to_uncache) >= excess:
+                    break
+                # a session being used isn't dropped, otherwise a stale copy could be read meanwhile
+                if not self.locks.is_locked(key):
+                    keys_to_uncache.append(key)
+            for key in keys_to_uncache:
+                _, uncached_session = self._cached_sessions.pop(key)
+                for secret in (uncached_session.white_secret,
+                               uncached_session.black_secret,
+                               uncached_session.join_secret):
+                    self._white_secrets.pop(secret, None) # type: ignore
+
+def _encode_session(session: GameSession) -> bytes:
+    return SESSION_HEADER.pack(secret_to_bytes(session.white_secret),
+                               secret_to_bytes(session.join_secret),
+                               secret_to_bytes(session.black_secret),
+                               session.join_secret is not None) + encode_state(session.game_state)
+
+def _decode_session(value: bytes) -> tuple[str, str | None, str, bytes]:
+    white, join, black, has_join = SESSION_HEADER.unpack_from(value)
+    return (secret_from_bytes(white),
+            secret_from_bytes(join) if has_join else None,
+            secret_from_bytes(black),
+            value[SESSION_HEADER.size:])
@@ -0,0 +1,135 @@
+import threading
+import pytest
+from .redis_storage import RedisGameSessionsStorage, RespConnectionPool, RespError
+from .resp_server import LocalRespServer
+from .storage import StaleSessionError
+from .game_sessions_manager import GameSessionsManager
+from .game_session import SecretRole
+from .serialization import to_json
+
+@pytest.fixture
+def server():
+    with LocalRespServer() as local_server:
+        yield local_server
+
+def make_storage(server: LocalRespServer, **kwargs) -> RedisGameSessionsStorage:
+    return RedisGameSessionsStorage(*server.address, **kwargs)
+
+def test_get_session_and_role_by_secret(server: LocalRespServer):
+    storage = make_storage(server)
+    session = storage.create_session()
+    assert session.join_secret is not None
+
+    assert storage.get_session_and_role_by_secret(session.white_secret) == (session, SecretRole.white)
+    assert storage.get_session_and_role_by_secret(session.black_secret) == (session, SecretRole.black)
+    assert storage.get_session_and_role_by_secret(session.join_secret) == (session, SecretRole.join)
+    assert storage.get_session_by_secret('some garbage') is None
+    assert storage.get_white_secret(session.black_secret) == session.white_secret
+    storage.close()
+
+def test_sessions_are_shared_by_processes(server: LocalRespServer):
+    # two storages stand for two worker processes
+    first_manager = GameSessionsManager(make_storage(server))
+    second_manager = GameSessionsManager(make_storage(server))
+    white_secret, _ = first_manager.create_session()
+    join_secret = second_manager.get_join_secret(white_secret)
+    assert join_secret is not None
+    join_result = second_manager.join_session(join_secret)
+    assert join_result is not None
+    black_secret = join_result[0]
+    assert first_manager.join_session(join_secret) is None
+
+    assert first_manager.make_move(white_secret, 4, 1, 4, 3) is not None
+    assert second_manager.make_move(black_secret, 4, 6, 4, 4) is not None
+    assert to_json(first_manager.get_player_view_and_stats(white_secret)) == \
+        to_json(second_manager.get_player_view_and_stats(white_secret))
+
+def test_stale_session_is_not_saved(server: LocalRespServer):
+    first_storage = make_storage(server)
+    second_storage = make_storage(server)
+    session = first_storage.create_session()
+    stale_session = second_storage.get_session_by_secret(session.white_secret)
+    assert stale_session is not None
+
+    session.game_state.make_move(0, 1, 0, 2)
+    first_storage.save_session(session)
+    stale_session.game_state.make_move(1, 1, 1, 2)
+    with pytest.raises(StaleSessionError):
+        second_storage.save_session(stale_session)
+    assert second_storage.stats.conflicts == 1
+
+    fresh_session = second_storage.get_session_by_secret(session.white_secret)
+    assert fresh_session is not None and fresh_session is not stale_session
+    assert to_json(fresh_session.game_state) == to_json(session.game_state)
+
+def test_session_objects_are_reused_while_unchanged(server: LocalRespServer):
+    storage = make_storage(server)
+    session = storage.create_session()
+    assert storage.get_session_by_secret(session.black_secret) is session
+    assert storage.stats.reused_sessions == 1
+
+    other_storage = make_storage(server)
+    other_session = other_storage.get_session_by_secret(session.white_secret)
+    assert other_session is not None
+    other_session.game_state.make_move(0, 1, 0, 2)
+    other_storage.save_session(other_session)
+    assert storage.get_session_by_secret(session.white_secret) is not session
+
+def test_writes_are_pipelined(server: LocalRespServer):
+    storage = make_storage(server)
+    session = storage.create_session()
+    assert storage.stats.round_trips == 1
+    storage.save_session(session)
+    assert storage.stats.round_trips == 3
+    assert storage.pool.connections_opened == 1
+
+def test_sessions_expire():
+    now = 0.0
+    with LocalRespServer(clock=lambda: now) as local_server:
+        storage = make_storage(local_server, ttl=10)
+        session = storage.create_session()
+        now = 5.0
+        assert storage.get_session_by_secret(session.white_secret) is not None
+        now = 10.0
+        assert storage.get_session_by_secret(session.white_secret) is None
+
+def test_server_transactions(server: LocalRespServer):
+    pool = RespConnectionPool(*server.address)
+    with pool.connection() as connection, pool.connection() as other_connection:
+        assert connection.execute(('SET', 'a', '1'), ('WATCH', 'a')) == ['OK', 'OK']
+        assert other_connection.execute(('SET', 'a', '2')) == ['OK']
+        assert connection.execute(('MULTI',), ('SET', 'a', '3'), ('EXEC',)) == ['OK', 'QUEUED', None]
+        assert connection.execute(('MULTI',), ('SET', 'a', '3'), ('GET', 'a'), ('EXEC',))[-1] == ['OK', b'3']
+        reply, = connection.execute(('NO-SUCH-COMMAND',))
+        assert isinstance(reply, RespError)
+    pool.close()
+
+def test_session_is_discarded_when_not_saved(server: LocalRespServer):
+    storage = make_storage(server)
+    session_manager = GameSessionsManager(storage)
+    white_secret, _ = session_manager.create_session()
+    pool_connection = storage.pool.connection
+
+    def broken_connection():
+        raise ConnectionError('the server is gone')
+
+    storage.pool.connection = broken_connection
+    with pytest.raises(ConnectionError):
+        session_manager.make_move(white_secret, 4, 1, 4, 3)
+    storage.pool.connection = pool_connection
+
+    # the move isn't seen by the next requests, as it wasn't stored
+    view_and_stats = session_manager.get_player_view_and_stats(white_secret)
+    assert view_and_stats is not None and view_and_stats.version == 0
+    assert session_manager.make_move(white_secret, 4, 1, 4, 3) is not None
+    storage.close()
+
+def test_wait_sees_changes_of_other_processes_in_the_end(server: LocalRespServer):
+    first_manager = GameSessionsManager(make_storage(server))
+    second_manager = GameSessionsManager(make_storage(server))
+    white_secret, _ = first_manager.create_session()
+    moving = threading.Timer(0.05, second_manager.make_move, (white_secret, 4, 1, 4, 3))
+    moving.start()
+    # not notified, but the stored version is checked when the wait ends
+    assert first_manager.wait_for_version_change(white_secret, 0, 0.2) == 1
+    moving.join()
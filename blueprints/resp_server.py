@@ -0,0 +1,236 @@
+"""
+A small pure-Python server speaking the Redis protocol (RESP), with
+the subset of commands redis_storage.py uses, for tests and local runs
+without Redis: strings with expiration, WATCH/MULTI/EXEC transactions.
+
+Run `python -m blueprints.resp_server [port]` to start it on localhost.
+"""
+
+import socket
+import socketserver
+import sys
+import threading
+import time
+from itertools import count
+from typing import Callable
+
+class _Client:
+    """ State of a connection: watched keys (with their versions) and queued commands of MULTI """
+    def __init__(self):
+        self.watched: dict[bytes, int] = {}
+        self.queued: list[list[bytes]] | None = None
+
+class _Error(Exception):
+    pass
+
+class LocalRespServer:
+    """
+    Serves on host:port (port 0 means any free one, see address) in a background thread;
+    commands are executed one at a time, like in Redis.
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._values: dict[bytes, bytes] = {}
+        self._expires_at: dict[bytes, float] = {}
+        # changed on each write of a key, for WATCH
+        self._versions: dict[bytes, int] = {}
+        self._next_version = count(1)
+        self.commands_executed = 0
+
+        server = self
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                server._serve(self.request)
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self._server.server_address[:2] # type: ignore
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'LocalRespServer':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def _serve(self, connection: socket.socket) -> None:
+        client = _Client()
+        buffer = b''
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                return
+            buffer += data
+            # pipelined commands are executed together, their replies are sent at once
+            replies: list[bytes] = []
+            offset = 0
+            while (parsed := _parse_command(buffer, offset)) is not None:
+                command, offset = parsed
+                with self._lock:
+                    replies.append(self._execute(client, command))
+            buffer = buffer[offset:]
+            if replies:
+                connection.sendall(b''.join(replies))
+
+    def _execute(self, client: _Client, command: list[bytes]) -> bytes:
+        self.commands_executed += 1
+        if not command:
+            return b'-ERR empty command\r\n'
+        name = command[0].upper()
+        if client.queued is not None and name not in (b'EXEC', b'DISCARD', b'MULTI', b'WATCH'):
+            client.queued.append(command)
+            return b'+QUEUED\r\n'
+        try:
+            if name == b'MULTI':
+                if client.queued is not None:
+                    raise _Error('MULTI calls can not be nested')
+                client.queued = []
+                return b'+OK\r\n'
+            if name == b'EXEC':
+                return self._exec(client)
+            if name == b'DISCARD':
+                if client.queued is None:
+                    raise _Error('DISCARD without MULTI')
+                client.queued = None
+                client.watched.clear()
+                return b'+OK\r\n'
+            return _encode_reply(self._run(client, command))
+        except _Error as error:
+            return f'-ERR {error}\r\n'.encode()
+
+    def _exec(self, client: _Client) -> bytes:
+        if client.queued is None:
+            raise _Error('EXEC without MULTI')
+        queued, client.queued = client.queued, None
+        is_aborted = any(self._get_version(key) != version for key, version in client.watched.items())
+        client.watched.clear()
+        if is_aborted:
+            return b'*-1\r\n'
+        replies = []
+        for command in queued:
+            try:
+                replies.append(_encode_reply(self._run(client, command)))
+            except _Error as error:
+                replies.append(f'-ERR {error}\r\n'.encode())
+        return b'*%d\r\n' % len(replies) + b''.join(replies)
+
+    def _get_version(self, key: bytes) -> int:
+        self._expire(key)
+        return self._versions.get(key, 0)
+
+    def _expire(self, key: bytes) -> None:
+        expires_at = self._expires_at.get(key)
+        if expires_at is not None and expires_at <= self._clock():
+            self._delete(key)
+
+    def _delete(self, key: bytes) -> bool:
+        if key not in self._values:
+            return False
+        del self._values[key]
+        self._expires_at.pop(key, None)
+        self._versions[key] = next(self._next_version)
+        return True
+
+    def _run(self, client: _Client, command: list[bytes]):
+        name, arguments = command[0].upper(), command[1:]
+        for key in arguments[:1] if name not in (b'DEL', b'EXISTS', b'MGET', b'WATCH') else arguments:
+            self._expire(key)
+
+        if name == b'PING':
+            return _Simple('PONG')
+        if name == b'GET':
+            return self._values.get(arguments[0])
+        if name == b'MGET':
+            return [self._values.get(key) for key in arguments]
+        if name == b'SET':
+            return self._set(arguments)
+        if name == b'DEL':
+            return sum(self._delete(key) for key in arguments)
+        if name == b'EXISTS':
+            return sum(key in self._values for key in arguments)
+        if name == b'EXPIRE':
+            if arguments[0] not in self._values:
+                return 0
+            self._expires_at[arguments[0]] = self._clock() + int(arguments[1])
+            return 1
+        if name == b'WATCH':
+            for key in arguments:
+                client.watched[key] = self._versions.get(key, 0)
+            return _Simple('OK')
+        if name == b'UNWATCH':
+            client.watched.clear()
+            return _Simple('OK')
+        if name == b'DBSIZE':
+            for key in list(self._expires_at):
+                self._expire(key)
+            return len(self._values)
+        if name == b'FLUSHALL':
+            for key in list(self._values):
+                self._delete(key)
+            return _Simple('OK')
+        raise _Error(f"unknown command '{name.decode(errors='replace')}'")
+
+    def _set(self, arguments: list[bytes]):
+        key, value, options = arguments[0], arguments[1], [option.upper() for option in arguments[2:]]
+        expires_at = None
+        if b'EX' in options:
+            expires_at = self._clock() + int(options[options.index(b'EX') + 1])
+        elif b'PX' in options:
+            expires_at = self._clock() + int(options[options.index(b'PX') + 1]) / 1000
+        if b'NX' in options and key in self._values or b'XX' in options and key not in self._values:
+            return None
+        self._values[key] = value
+        self._versions[key] = next(self._next_version)
+        if expires_at is None:
+            self._expires_at.pop(key, None)
+        else:
+            self._expires_at[key] = expires_at
+        return _Simple('OK')
+
+class _Simple(str):
+    """ A simple string reply (like +OK) """
+
+def _parse_command(buffer: bytes, offset: int) -> tuple[list[bytes], int] | None:
+    """ Parses a command at the offset, returns it and the offset after it, or None if it's incomplete """
+    line_end = buffer.find(b'\r\n', offset)
+    if line_end < 0:
+        return None
+    if buffer[offset:offset + 1] != b'*':
+        # an inline command, like one typed in telnet
+        return buffer[offset:line_end].split(), line_end + 2
+    arguments = []
+    position = line_end + 2
+    for _ in range(int(buffer[offset + 1:line_end])):
+        line_end = buffer.find(b'\r\n', position)
+        if line_end < 0:
+            return None
+        size = int(buffer[position + 1:line_end])
+        position = line_end + 2 + size + 2
+        if position > len(buffer):
+            return None
+        arguments.append(buffer[line_end + 2:position - 2])
+    return arguments, position
+
+def _encode_reply(reply) -> bytes:
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, _Simple):
+        return f'+{reply}\r\n'.encode()
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if isinstance(reply, bytes):
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+    return b'*%d\r\n' % len(reply) + b''.join(_encode_reply(item) for item in reply)
+
+if __name__ == '__main__':
+    with LocalRespServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 6379) as local_server:
+        print('serving on {}:{}'.format(*local_server.address))
+        threading.Event().wait()
@@ -1,11 +1,27 @@
 """
 Extended serialization supporting `to_json()` method and
 serializing simple dataclasses
+
+to_json gives the same text as json.dumps with ExtendedJSONEncoder (kept
+as the reference implementation, see the tests), but an encoding function
+is chosen for each type on its first use (for a dataclass, one joining
+the texts of its fields is generated), so each object is encoded by one call
+instead of going through `default` and its checks.
+
+Strings are escaped by the C implementation of the json module when it's
+available; faster libraries like orjson can't give the same text
+(they don't put spaces after separators and escape differently).
+
+Run `python -m blueprints.serialization [repeat]` for a benchmark.
 """
 import json
+import math
+import sys
 from dataclasses import is_dataclass
 from enum import Enum
-from typing import Any, Dict
+from json.encoder import encode_basestring_ascii
+from time import perf_counter
+from typing import Any, Callable, Dict
 
 # is it needed in later Python versions?
 class ExtendedJSONEncoder(json.JSONEncoder):
@@ -13,6 +29,10 @@ class ExtendedJSONEncoder(json.JSONEncoder):
     and serializing simple dataclasses """
     def default(self, o: Any):
 
+        # goes first so that dataclasses can provide a faster way
+        if hasattr(o, 'to_json'):
+            return o.to_json()
+
         if is_dataclass(o):
             data: Dict[str, Any] = {}
             for field in o.__dataclass_fields__.keys():
@@ -20,9 +40,6 @@ class ExtendedJSONEncoder(json.JSONEncoder):
                 data[str(field)] = self.serialize_unless_primitive(value)
             return data
 
-        if hasattr(o, 'to_json'):
-            return o.to_json()
-
         if hasattr(o, 'to_dict'):
             as_dict = o.to_dict()
             return self.serialize_unless_primitive(as_dict)
@@ -33,14 +50,15 @@ class ExtendedJSONEncoder(json.JSONEncoder):
                 data[key] = self.serialize_unless_primitive(value)
             return data
 
-        if isinstance(o, list):
+        # tuples too, like cells in PlayerViewChanges
+        if isinstance(o, (list, tuple)):
             return [self.serialize_unless_primitive(x) for x in o]
 
         return json.JSONEncoder.default(self, o)
 
     def serialize_unless_primitive(self, o: Any) -> Any:
         """ Only continues the transformation for non-primitives """
-        if isinstance(o, (bool, str)) or \
+        if isinstance(o, (bool, int, float, str)) or \
            o is None:
             return o
 
@@ -49,6 +67,142 @@ class ExtendedJSONEncoder(json.JSONEncoder):
 
         return self.default(o)
 
-def to_json(obj: Any):
+Encoder = Callable[[Any], str]
+
+# texts of instances of a class setting `is_json_remembered = True` (like PlayerPiece flyweights,
+# immutable and compared by identity) are remembered, up to this number per type
+MAX_REMEMBERED_TEXTS = 4096
+
+_encoders: dict[type, Encoder] = {}
+
+def to_json(obj: Any) -> str:
     """ Serializes `obj` to JSON """
-    return json.dumps(obj, cls=ExtendedJSONEncoder)
+    return _encode(obj)
+
+def _encode(o: Any) -> str:
+    encoder = _encoders.get(type(o))
+    if encoder is None:
+        encoder = _encoders[type(o)] = _make_encoder(type(o))
+    return encoder(o)
+
+def _make_encoder(cls: type) -> Encoder:
+    """ Same choice as json.dumps with ExtendedJSONEncoder makes for an object of the type """
+    if cls is type(None):
+        return lambda _: 'null'
+    if issubclass(cls, str):
+        return encode_basestring_ascii
+    if issubclass(cls, bool):
+        return lambda o: 'true' if o else 'false'
+    if issubclass(cls, int):
+        return int.__repr__
+    if issubclass(cls, float):
+        return _encode_float
+    if issubclass(cls, dict):
+        return _encode_dict
+    if issubclass(cls, (list, tuple)):
+        return _encode_list
+    if issubclass(cls, Enum):
+        return { member: encode_basestring_ascii(member.name) for member in cls }.__getitem__
+
+    encoder: Encoder
+    if hasattr(cls, 'to_json'):
+        encoder = lambda o: _encode(o.to_json())
+    elif is_dataclass(cls):
+        encoder = _generate_dataclass_encoder(cls)
+    elif hasattr(cls, 'to_dict'):
+        encoder = lambda o: _encode(o.to_dict())
+    else:
+        def encoder(o: Any) -> str:
+            raise TypeError(f'Object of type {cls.__name__} is not JSON serializable')
+        return encoder
+
+    if getattr(cls, 'is_json_remembered', False):
+        return _remembering(encoder)
+    return encoder
+
+def _generate_dataclass_encoder(cls: type) -> Encoder:
+    """ Generates a function like `lambda o: ''.join(('{"a": ', _encode(o.a), ', "b": ', _encode(o.b), '}'))` """
+    names = list(cls.__dataclass_fields__) # type: ignore
+    if not names:
+        return lambda _: '{}'
+    parts = []
+    for index, name in enumerate(names):
+        parts.append(repr(('{' if index == 0 else ', ') + encode_basestring_ascii(name) + ': '))
+        parts.append(f'_encode(o.{name})')
+    parts.append(repr('}'))
+    namespace: dict[str, Any] = {}
+    exec(f"def encode(o):\n    return ''.join(({', '.join(parts)}))", { '_encode': _encode }, namespace)
+    encoder = namespace['encode']
+    encoder.__qualname__ = encoder.__name__ = f'encode_{cls.__name__}'
+    return encoder
+
+def _remembering(encoder: Encoder) -> Encoder:
+    texts: dict[Any, str] = {}
+    def encode(o: Any) -> str:
+        text = texts.get(o)
+        if text is None:
+            text = encoder(o)
+            if len(texts) < MAX_REMEMBERED_TEXTS:
+                texts[o] = text
+        return text
+    return encode
+
+def _encode_float(o: float) -> str:
+    if o != o:
+        return 'NaN'
+    if o == math.inf:
+        return 'Infinity'
+    if o == -math.inf:
+        return '-Infinity'
+    return float.__repr__(o)
+
+def _encode_list(o: list | tuple) -> str:
+    encoders = _encoders
+    # _encode inlined, it's called for each of 64 cells of a view
+    return '[' + ', '.join([(encoders.get(type(item)) or _encode)(item) for item in o]) + ']'
+
+def _encode_dict(o: dict) -> str:
+    return '{' + ', '.join([_encode_key(key) + ': ' + _encode(value) for key, value in o.items()]) + '}'
+
+def _encode_key(key: Any) -> str:
+    if isinstance(key, str):
+        return encode_basestring_ascii(key)
+    if key is True or key is False or key is None:
+        return f'"{_encode(key)}"'
+    if isinstance(key, int):
+        return f'"{int.__repr__(key)}"'
+    if isinstance(key, float):
+        return f'"{_encode_float(key)}"'
+    raise TypeError(f'keys must be str, int, float, bool or None, not {type(key).__name__}')
+
+def run_benchmark(obj: Any, repeat: int) -> tuple[float, float]:
+    """ Seconds per encoding of obj by json.dumps with ExtendedJSONEncoder and by to_json """
+    started_at = perf_counter()
+    for _ in range(repeat):
+        json.dumps(obj, cls=ExtendedJSONEncoder)
+    reference_seconds = (perf_counter() - started_at) / repeat
+    started_at = perf_counter()
+    for _ in range(repeat):
+        to_json(obj)
+    return reference_seconds, (perf_counter() - started_at) / repeat
+
+if __name__ == '__main__':
+    from .game_session import GameSession
+    from .game_sessions_manager import GameSessionsManager, PlayerViewAndStats
+    from .storage import GameSessionsStorage
+
+    session_manager = GameSessionsManager(GameSessionsStorage())
+    white_secret, _ = session_manager.create_session()
+    for move in [(4, 1, 4, 3), (4, 6, 4, 4), (6, 0, 5, 2), (1, 7, 2, 5)]:
+        session_manager.make_move(white_secret, *move)
+    view_and_stats = session_manager.get_player_view_and_stats(white_secret)
+    assert isinstance(view_and_stats, PlayerViewAndStats)
+    session = GameSession()
+    for name, obj in [('PlayerViewAndStats', view_and_stats),
+                      ('BoardView', view_and_stats.player_view),
+                      ('GameState', session.game_state),
+                      ('GameSession', session)]:
+        assert to_json(obj) == json.dumps(obj, cls=ExtendedJSONEncoder)
+        reference_seconds, seconds = run_benchmark(obj, int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
+        print(f'{name:>18}  ExtendedJSONEncoder {reference_seconds * 1e6:7.1f} us  '
+              f'to_json {seconds * 1e6:7.1f} us  {reference_seconds / seconds:5.1f}x')
@@ -1,7 +1,11 @@
-from .serialization import to_json
+import json
+from dataclasses import dataclass
+from enum import Enum, IntEnum
+import pytest
+from .serialization import to_json, ExtendedJSONEncoder
 from .game_session import GameSession
-from .game_sessions_manager import PlayerViewAndStats
-from .game_domain.state import Player
+from .game_sessions_manager import PlayerViewAndStats, PlayerViewChanges, LegalMoves
+from .game_domain.state import Player, Piece, PlayerPiece
 
 def test_serializes_game_session():
     session = GameSession()
@@ -22,3 +26,80 @@ def test_serializes_player_view_and_stats():
 
     assert isinstance(player_view_and_stats_json, str)
     assert player_view_and_stats_json != '{}'
+
+def test_serializes_player_view_changes():
+    player_view_changes = PlayerViewChanges(
+        [(4, 3, PlayerPiece(Player.white, Piece.pawn)), (4, 1, None)],
+        0, Player.black, Player.black, False, False, False, None, False, 1)
+
+    assert '"changed_cells": [[4, 3, {"player": "white", "piece": "pawn"}], [4, 1, null]]' \
+        in to_json(player_view_changes)
+
+@dataclass(frozen=True, eq=False)
+class Flyweight:
+    name: str
+
+    is_json_remembered = True
+
+@dataclass(frozen=True, eq=False)
+class FrozenWithList:
+    items: list
+
+class WithToDict:
+    def to_dict(self):
+        return { 'tuple': (1, 2.5), 'nested': [Player.white, None] }
+
+@dataclass
+class Everything:
+    strings: list[str]
+    numbers: tuple
+    keys: dict
+    enums: list
+    flyweight: Flyweight
+    with_to_dict: WithToDict
+    nothing: list
+
+class Color(str, Enum):
+    red = 'r'
+
+class Size(IntEnum):
+    small = 1
+
+def test_same_text_as_reference_encoder():
+    session = GameSession()
+    for move in [(4, 1, 4, 3), (3, 6, 3, 4), (4, 3, 3, 4)]:
+        session.game_state.make_move(*move)
+    objects = [
+        session,
+        session.game_state,
+        session.game_state.get_board_view(Player.black),
+        PlayerViewAndStats(session.game_state.get_board_view(Player.white),
+                           Player.white, Player.black, False, False, False, None, False, 3),
+        PlayerViewChanges([(4, 3, PlayerPiece(Player.white, Piece.pawn)), (4, 1, None)],
+                          0, Player.black, Player.black, False, False, False, Player.white, False, 1),
+        LegalMoves([(1, 0, ((0, 2), (2, 2)))], 0),
+        { 'white_secret': 'a', 'board_view__white': session.game_state.get_board_view(Player.white) },
+        Everything(['', 'quote " and \\ slash /', 'кириллица ♞', '\x00\x1f\x7f\n\t'],
+                   (0, -1, 10**30, 0.1, 1e300, -0.0, float('nan'), float('inf'), float('-inf'), True, False),
+                   { 'a': 1, 2: 'b', 3.5: None, True: [], None: {}, Color.red: Size.small },
+                   [Player.black, Piece.queen, Color.red, Size.small],
+                   Flyweight('x'),
+                   WithToDict(),
+                   []),
+        [[], {}, (), ''],
+    ]
+    for obj in objects:
+        assert to_json(obj) == json.dumps(obj, cls=ExtendedJSONEncoder)
+    # remembered texts are reused
+    flyweight = Flyweight('y')
+    assert to_json([flyweight, flyweight]) == '[{"name": "y"}, {"name": "y"}]'
+    # others are encoded each time, even if frozen
+    frozen_with_list = FrozenWithList([])
+    assert to_json(frozen_with_list) == '{"items": []}'
+    frozen_with_list.items.append(1)
+    assert to_json(frozen_with_list) == '{"items": [1]}'
+
+def test_not_serializable():
+    for obj in [object(), { (1, 2): 3 }]:
+        with pytest.raises(TypeError):
+            to_json(obj)
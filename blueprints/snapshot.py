@@ -0,0 +1,104 @@
+"""
+A file with all the sessions that is memory-mapped on start, so that
+a restart (e.g. after a deploy) doesn't lose them and doesn't take time
+proportional to their number: a session is read from the file only when
+it's looked up by a secret.
+
+The file consists of
+- a header: magic, number of sessions, number of index entries;
+- session records of a fixed size: the secrets (16 bytes each, see
+  game_session.secret_to_bytes), whether join secret is set, and the state
+  encoded by codec.encode_state (padded to a fixed size);
+- index entries: (secret, session record number, SecretRole.value),
+  sorted by secret, so that a session is found by a binary search.
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+from typing import Iterable, Iterator
+from .game_session import FrozenSession, SecretRole, secret_to_bytes, secret_from_bytes
+
+MAGIC = b'DCMMAP01'
+HEADER = struct.Struct('<8sII')
+MAX_STATE_SIZE = 42
+RECORD = struct.Struct(f'<16s16s16s?B{MAX_STATE_SIZE}s')
+INDEX_ENTRY = struct.Struct('<16sIB')
+
+def write_snapshot(path: str, sessions: Iterable[FrozenSession]) -> int:
+    """ Writes the sessions to the file (replaces it at once, when written), returns their number """
+    records: list[bytes] = []
+    index: list[tuple[bytes, int, int]] = []
+    for number, session in enumerate(sessions):
+        if len(session.encoded_state) > MAX_STATE_SIZE:
+            raise ValueError(f'an encoded state is expected to be up to {MAX_STATE_SIZE} bytes')
+        white, join, black = (secret_to_bytes(session.white_secret),
+                              secret_to_bytes(session.join_secret),
+                              secret_to_bytes(session.black_secret))
+        records.append(RECORD.pack(white, join, black, session.join_secret is not None,
+                                   len(session.encoded_state), session.encoded_state))
+        index.append((white, number, SecretRole.white.value))
+        index.append((black, number, SecretRole.black.value))
+        if session.join_secret is not None:
+            index.append((join, number, SecretRole.join.value))
+    index.sort()
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, len(records), len(index)))
+        snapshot_file.write(b''.join(records))
+        snapshot_file.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in index))
+    os.replace(snapshot_file.name, path)
+    return len(records)
+
+class MappedSnapshot:
+    """ A snapshot file mapped to memory, sessions are read from it on demand """
+    def __init__(self, path: str):
+        with open(path, 'rb') as snapshot_file:
+            self._buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._sessions_count, self._index_size = HEADER.unpack_from(self._buffer)
+        if magic != MAGIC:
+            self._buffer.close()
+            raise ValueError(f'{path} is not a sessions snapshot')
+        self._index_offset = HEADER.size + self._sessions_count * RECORD.size
+
+    def __len__(self) -> int:
+        return self._sessions_count
+
+    def close(self) -> None:
+        self._buffer.close()
+
+    def _get_session(self, number: int) -> FrozenSession:
+        white, join, black, has_join, state_size, state = \
+            RECORD.unpack_from(self._buffer, HEADER.size + number * RECORD.size)
+        return FrozenSession(secret_from_bytes(white),
+                             secret_from_bytes(join) if has_join else None,
+                             secret_from_bytes(black),
+                             state[:state_size])
+
+    def find(self, secret: str) -> tuple[FrozenSession, SecretRole] | None:
+        """ Finds the session by any of its secrets (a binary search in the index) """
+        try:
+            key = secret_to_bytes(secret)
+        except ValueError:
+            return None
+        low, high = 0, self._index_size
+        while low < high:
+            middle = (low + high) // 2
+            offset = self._index_offset + middle * INDEX_ENTRY.size
+            if self._buffer[offset:offset + 16] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self._index_size:
+            return None
+        entry_secret, number, role_value = \
+            INDEX_ENTRY.unpack_from(self._buffer, self._index_offset + low * INDEX_ENTRY.size)
+        if entry_secret != key:
+            return None
+        return self._get_session(number), SecretRole(role_value)
+
+    def __iter__(self) -> Iterator[FrozenSession]:
+        for number in range(self._sessions_count):
+            yield self._get_session(number)
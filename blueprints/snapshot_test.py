@@ -0,0 +1,112 @@
+from pathlib import Path
+import pytest
+from .snapshot import MappedSnapshot, write_snapshot
+from .storage import GameSessionsStorage, StorageLimits
+from .game_session import SecretRole
+from .serialization import to_json
+
+def create_sessions(storage: GameSessionsStorage, count: int):
+    sessions = [storage.create_session() for _ in range(count)]
+    for session in sessions[::2]:
+        session.game_state.make_move(0, 1, 0, 2)
+        storage.clear_join_secret(session)
+    return sessions
+
+def test_write_and_find(tmp_path: Path):
+    storage = GameSessionsStorage()
+    sessions = create_sessions(storage, 5)
+    path = str(tmp_path / 'snapshot')
+    assert storage.dump_snapshot(path) == 5
+
+    snapshot = MappedSnapshot(path)
+    assert len(snapshot) == 5
+    assert {session.white_secret for session in snapshot} == {session.white_secret for session in sessions}
+    for session in sessions:
+        found = snapshot.find(session.black_secret)
+        assert found is not None
+        assert found[0].white_secret == session.white_secret
+        assert found[0].join_secret == session.join_secret
+        assert found[1] == SecretRole.black
+    assert snapshot.find(sessions[0].white_secret.replace('-', '')[::-1]) is None
+    assert snapshot.find('some garbage') is None
+    snapshot.close()
+
+def test_sessions_are_taken_on_lookup(tmp_path: Path):
+    storage = GameSessionsStorage()
+    sessions = create_sessions(storage, 4)
+    path = str(tmp_path / 'snapshot')
+    storage.dump_snapshot(path)
+
+    restarted_storage = GameSessionsStorage(snapshot=MappedSnapshot(path))
+    assert restarted_storage.stats.frozen_sessions == 0
+    for session in sessions:
+        for secret, role in ((session.white_secret, SecretRole.white),
+                             (session.black_secret, SecretRole.black),
+                             (session.join_secret, SecretRole.join)):
+            if secret is None:
+                continue
+            found = restarted_storage.get_session_and_role_by_secret(secret)
+            assert found is not None and found[1] == role
+            assert to_json(found[0].game_state) == to_json(session.game_state)
+    assert restarted_storage.stats.frozen_sessions + restarted_storage.stats.hot_sessions == 4
+
+def test_taken_sessions_are_not_resurrected(tmp_path: Path):
+    storage = GameSessionsStorage()
+    session = storage.create_session()
+    path = str(tmp_path / 'snapshot')
+    storage.dump_snapshot(path)
+
+    now = 0.0
+    restarted_storage = GameSessionsStorage(StorageLimits(idle_timeout=10), clock=lambda: now,
+                                            snapshot=MappedSnapshot(path))
+    assert restarted_storage.get_session_by_secret(session.white_secret) is not None
+    now = 20.0
+    assert restarted_storage.get_session_by_secret(session.white_secret) is None
+    assert list(restarted_storage.export_sessions()) == []
+
+def test_dump_includes_sessions_not_taken(tmp_path: Path):
+    storage = GameSessionsStorage()
+    sessions = create_sessions(storage, 3)
+    path = str(tmp_path / 'snapshot')
+    storage.dump_snapshot(path)
+
+    restarted_storage = GameSessionsStorage(snapshot=MappedSnapshot(path))
+    taken_session = restarted_storage.get_session_by_secret(sessions[0].white_secret)
+    assert taken_session is not None
+    taken_session.game_state.make_move(1, 1, 1, 2)
+    restarted_storage.save_session(taken_session)
+    new_session = restarted_storage.create_session()
+    assert restarted_storage.dump_snapshot(str(tmp_path / 'snapshot2')) == 4
+
+    snapshot = MappedSnapshot(str(tmp_path / 'snapshot2'))
+    again_restarted_storage = GameSessionsStorage(snapshot=snapshot)
+    for session in [taken_session, *sessions[1:], new_session]:
+        found = again_restarted_storage.get_session_by_secret(session.white_secret)
+        assert found is not None
+        assert to_json(found.game_state) == to_json(session.game_state)
+
+def test_not_a_snapshot(tmp_path: Path):
+    path = tmp_path / 'snapshot'
+    path.write_bytes(b'\x00' * 64)
+    with pytest.raises(ValueError):
+        MappedSnapshot(str(path))
+
+def test_empty_snapshot(tmp_path: Path):
+    path = str(tmp_path / 'snapshot')
+    assert write_snapshot(path, []) == 0
+    snapshot = MappedSnapshot(path)
+    assert len(snapshot) == 0 and snapshot.find('00000000-0000-0000-0000-000000000000') is None
+
+def test_dump_over_the_mapped_snapshot(tmp_path: Path):
+    storage = GameSessionsStorage()
+    sessions = create_sessions(storage, 3)
+    path = str(tmp_path / 'snapshot')
+    storage.dump_snapshot(path)
+
+    restarted_storage = GameSessionsStorage(snapshot=MappedSnapshot(path))
+    assert restarted_storage.get_session_by_secret(sessions[0].white_secret) is not None
+    # the mapping is closed before the file is replaced, sessions not taken stay available
+    assert restarted_storage.dump_snapshot(path) == 3
+    assert restarted_storage.get_session_by_secret(sessions[1].black_secret) is not None
+    assert len(list(restarted_storage.export_sessions())) == 3
+    assert {session.white_secret for session in MappedSnapshot(path)} == {session.white_secret for session in sessions}
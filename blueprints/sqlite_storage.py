@@ -0,0 +1,269 @@
+"""
+Storage of sessions in SQLite, so that games survive restarts.
+
+Each session is a row with its secrets (indexed) and the state encoded
+by codec.encode_state. Sessions that are used are kept in memory
+(the manager changes them in place), changes are written behind:
+saved sessions are queued and written in one transaction per
+durability window, so a move doesn't wait for the disk.
+"""
+
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from .storage import IGameSessionStorage
+from .locking import StripedLock
+from .game_session import GameSession, SecretRole
+from .game_domain.codec import encode_state, decode_state
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    white_secret TEXT PRIMARY KEY,
+    join_secret TEXT UNIQUE,
+    black_secret TEXT NOT NULL UNIQUE,
+    state BLOB NOT NULL
+)
+'''
+
+Row = tuple[str, str | None, str, bytes]
+
+# the writer thread waits this long after a failed transaction, doubling it up to the maximum
+WRITE_RETRY_DELAY = 0.1
+MAX_WRITE_RETRY_DELAY = 10.0
+
+logger = logging.getLogger(__name__)
+
+# names of ':memory:' databases, shared by the connections of a storage
+_memory_database_numbers = itertools.count()
+
+@dataclass
+class SqliteStorageStats:
+    transactions: int = 0
+    rows_written: int = 0
+    failed_transactions: int = 0
+
+class SqliteGameSessionsStorage(IGameSessionStorage):
+    """
+    Sessions in an SQLite database (':memory:' for a temporary one).
+
+    durability_window (in seconds) is how long a change may stay unwritten;
+    0 means each change is written right away. Call close (or flush)
+    before exiting so that the queued changes aren't lost.
+    max_cached_sessions limits the sessions kept in memory
+    (those with unwritten changes or being used, see locks, are kept anyway).
+    """
+    def __init__(self,
+                 path: str = ':memory:',
+                 durability_window: float = 0.05,
+                 max_cached_sessions: int = 10_000):
+        self.durability_window = durability_window
+        self.max_cached_sessions = max_cached_sessions
+        self.stats = SqliteStorageStats()
+        self.locks = StripedLock()
+
+        # lookups use one connection under the lock, writes use another one under the write lock,
+        # so a transaction being written doesn't hold up lookups and saves
+        is_memory = path == ':memory:'
+        if is_memory:
+            path = f'file:dark_chess_sessions_{next(_memory_database_numbers)}?mode=memory&cache=shared'
+        self._connection = self._connect(path, is_memory)
+        if is_memory:
+            # (otherwise a lookup fails while a transaction is being written)
+            self._connection.execute('PRAGMA read_uncommitted=1')
+        self._connection.execute(SCHEMA)
+        self._write_connection = self._connect(path, is_memory)
+        self._lock = threading.Lock()
+        # held for a whole write, so that writes (and flush) follow each other in order
+        self._write_lock = threading.Lock()
+
+        # sessions in memory by white_secret, from the least recently used ones
+        self._cached_sessions: OrderedDict[str, GameSession] = OrderedDict()
+        self._sessions_by_secret: dict[str, tuple[GameSession, SecretRole]] = {}
+        # rows to write, by white_secret (a later change of a session replaces the earlier one)
+        self._pending_rows: dict[str, Row] = {}
+        # rows taken from the pending ones and not committed yet (their sessions must stay cached)
+        self._writing_rows: dict[str, Row] = {}
+
+        self._is_closed = False
+        self._has_pending_rows = threading.Condition(self._lock)
+        self._writer: threading.Thread | None = None
+        if durability_window > 0:
+            self._writer = threading.Thread(target=self._write_behind, daemon=True)
+            self._writer.start()
+
+    def create_session(self):
+        """ Create a new session, store and return it """
+        session = GameSession()
+        with self._lock:
+            self._cache(session)
+        self.save_session(session)
+        return session
+
+    def get_session_by_secret(self, secret: str):
+        """ Find session by any secret (join, white, black) """
+        found = self.get_session_and_role_by_secret(secret)
+        return found[0] if found is not None else None
+
+    def get_session_and_role_by_secret(self, secret: str):
+        """ Find session by any secret, tell which of its secrets it is """
+        with self._lock:
+            found = self._sessions_by_secret.get(secret)
+            if found is None:
+                row = self._connection.execute(
+                    'SELECT white_secret, join_secret, black_secret, state FROM sessions '
+                    'WHERE white_secret = ? OR black_secret = ? OR join_secret = ?',
+                    (secret, secret, secret)).fetchone()
+                if row is None:
+                    return None
+                session = GameSession.restore(row[0], row[1], row[2], decode_state(row[3]))
+                self._cache(session)
+                found = self._sessions_by_secret[secret]
+            session, role = found
+            self._cached_sessions.move_to_end(session.white_secret)
+            # in case join_secret was changed on the session directly, not via clear_join_secret
+            if role == SecretRole.join and session.join_secret != secret:
+                del self._sessions_by_secret[secret]
+                return None
+        return found
+
+    def get_white_secret(self, secret: str):
+        """ Find the session's white_secret by any secret (the session is loaded, so it's cached for the next lookup) """
+        found = self.get_session_and_role_by_secret(secret)
+        return found[0].white_secret if found is not None else None
+
+    def clear_join_secret(self, session: GameSession):
+        """ Remove the join secret of the session, so that it can't be used anymore """
+        with self._lock:
+            if session.join_secret is not None:
+                self._sessions_by_secret.pop(session.join_secret, None)
+        session.join_secret = None
+        self.save_session(session)
+
+    def save_session(self, session: GameSession):
+        """ Queue the session to be written (the state is encoded right away) """
+        row = (session.white_secret, session.join_secret, session.black_secret, encode_state(session.game_state))
+        with self._lock:
+            self._pending_rows[session.white_secret] = row
+            if self._writer is not None:
+                self._has_pending_rows.notify()
+        if self._writer is None:
+            self._write_pending_rows()
+
+    def discard_session(self, session: GameSession) -> None:
+        """ Drops the cached object and its queued row (e.g. when writing it failed), the next lookup reads what's written """
+        with self._lock:
+            if self._cached_sessions.get(session.white_secret) is not session:
+                return
+            self._pending_rows.pop(session.white_secret, None)
+            self._uncache(session.white_secret)
+
+    def flush(self) -> None:
+        """ Write all the queued changes now """
+        self._write_pending_rows()
+
+    def close(self) -> None:
+        """ Write the queued changes, stop the writer and close the database """
+        with self._lock:
+            self._is_closed = True
+            self._has_pending_rows.notify()
+        if self._writer is not None:
+            self._writer.join()
+        self._write_pending_rows()
+        with self._lock:
+            self._connection.close()
+        self._write_connection.close()
+
+    @staticmethod
+    def _connect(path: str, is_memory: bool) -> sqlite3.Connection:
+        connection = sqlite3.connect(path, uri=is_memory, check_same_thread=False, isolation_level=None)
+        if not is_memory:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _cache(self, session: GameSession) -> None:
+        """ Keeps the session in memory (under the lock) """
+        self._cached_sessions[session.white_secret] = session
+        self._sessions_by_secret[session.white_secret] = (session, SecretRole.white)
+        self._sessions_by_secret[session.black_secret] = (session, SecretRole.black)
+        if session.join_secret is not None:
+            self._sessions_by_secret[session.join_secret] = (session, SecretRole.join)
+
+        excess = len(self._cached_sessions) - self.max_cached_sessions
+        if excess <= 0:
+            return
+        keys_to_uncache = []
+        for key in self._cached_sessions:
+            if len(keys_to_uncache) == excess:
+                break
+            if key not in self._pending_rows and key not in self._writing_rows and not self.locks.is_locked(key):
+                keys_to_uncache.append(key)
+        for key in keys_to_uncache:
+            self._uncache(key)
+
+    def _uncache(self, key: str) -> None:
+        """ (under the lock) """
+        uncached_session = self._cached_sessions.pop(key)
+        for secret in (uncached_session.white_secret,
+                       uncached_session.black_secret,
+                       uncached_session.join_secret):
+            if secret is not None and self._sessions_by_secret.get(secret, (None,))[0] is uncached_session:
+                del self._sessions_by_secret[secret]
+
+    def _write_pending_rows(self) -> None:
+        """ Writes the queued rows in one transaction (not under the lock: the rows are swapped out under it) """
+        with self._write_lock:
+            with self._lock:
+                if not self._pending_rows:
+                    return
+                self._writing_rows, self._pending_rows = self._pending_rows, {}
+            rows = list(self._writing_rows.values())
+            try:
+                with self._write_connection:
+                    self._write_connection.execute('BEGIN')
+                    self._write_connection.executemany(
+                        'INSERT OR REPLACE INTO sessions (white_secret, join_secret, black_secret, state) '
+                        'VALUES (?, ?, ?, ?)', rows)
+            except BaseException:
+                with self._lock:
+                    # to be written with the next transaction, unless changed meanwhile
+                    self._pending_rows = self._writing_rows | self._pending_rows
+                self.stats.failed_transactions += 1
+                raise
+            finally:
+                with self._lock:
+                    self._writing_rows = {}
+            self.stats.transactions += 1
+            self.stats.rows_written += len(rows)
+
+    def _write_behind(self) -> None:
+        """
+        The writer thread: waits for changes, lets them gather for durability_window, writes them;
+        after a failure, the rows stay queued and writing is retried after a growing delay
+        """
+        retry_delay = WRITE_RETRY_DELAY
+        while True:
+            with self._lock:
+                while not self._pending_rows and not self._is_closed:
+                    self._has_pending_rows.wait()
+                if self._is_closed:
+                    return
+                # more changes are notified meanwhile, but only closing ends the wait
+                write_at = time.monotonic() + self.durability_window
+                while not self._is_closed and time.monotonic() < write_at:
+                    self._has_pending_rows.wait(write_at - time.monotonic())
+            try:
+                self._write_pending_rows()
+            except Exception:
+                logger.exception('writing sessions failed, retrying in %s s', retry_delay)
+                retry_at = time.monotonic() + retry_delay
+                with self._lock:
+                    while not self._is_closed and time.monotonic() < retry_at:
+                        self._has_pending_rows.wait(retry_at - time.monotonic())
+                retry_delay = min(retry_delay * 2, MAX_WRITE_RETRY_DELAY)
+            else:
+                retry_delay = WRITE_RETRY_DELAY
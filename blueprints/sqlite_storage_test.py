@@ -0,0 +1,159 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+import pytest
+from . import sqlite_storage
+from .sqlite_storage import SqliteGameSessionsStorage
+from .game_sessions_manager import GameSessionsManager
+from .game_session import SecretRole
+from .serialization import to_json
+
+def test_get_session_and_role_by_secret():
+    storage = SqliteGameSessionsStorage(durability_window=0)
+    session = storage.create_session()
+    assert session.join_secret is not None
+
+    assert storage.get_session_and_role_by_secret(session.white_secret) == (session, SecretRole.white)
+    assert storage.get_session_and_role_by_secret(session.black_secret) == (session, SecretRole.black)
+    assert storage.get_session_and_role_by_secret(session.join_secret) == (session, SecretRole.join)
+    assert storage.get_session_by_secret('some garbage') is None
+    storage.close()
+
+def test_sessions_survive_restart(tmp_path: Path):
+    path = str(tmp_path / 'sessions.db')
+    storage = SqliteGameSessionsStorage(path)
+    session_manager = GameSessionsManager(storage)
+    white_secret, _ = session_manager.create_session()
+    join_secret = session_manager.get_join_secret(white_secret)
+    assert join_secret is not None
+    join_result = session_manager.join_session(join_secret)
+    assert join_result is not None
+    black_secret = join_result[0]
+    session_manager.make_move(white_secret, 4, 1, 4, 3)
+    view_and_stats = session_manager.get_player_view_and_stats(black_secret)
+    storage.close()
+
+    storage = SqliteGameSessionsStorage(path)
+    session_manager = GameSessionsManager(storage)
+    assert session_manager.get_join_secret(white_secret) is None
+    assert storage.get_session_by_secret(join_secret) is None
+    assert to_json(session_manager.get_player_view_and_stats(black_secret)) == to_json(view_and_stats)
+    assert session_manager.make_move(black_secret, 4, 6, 4, 4) is not None
+    storage.close()
+
+def test_changes_are_written_in_batches():
+    storage = SqliteGameSessionsStorage(durability_window=60)
+    sessions = [storage.create_session() for _ in range(3)]
+    for session in sessions:
+        session.game_state.make_move(0, 1, 0, 2)
+        storage.save_session(session)
+    assert storage.stats.transactions == 0
+
+    storage.flush()
+    assert storage.stats.transactions == 1
+    assert storage.stats.rows_written == 3
+    storage.close()
+
+def test_uncached_sessions_are_loaded(tmp_path: Path):
+    storage = SqliteGameSessionsStorage(str(tmp_path / 'sessions.db'), durability_window=0, max_cached_sessions=1)
+    session = storage.create_session()
+    session.game_state.make_move(0, 1, 0, 2)
+    storage.save_session(session)
+    storage.create_session()
+
+    loaded_session = storage.get_session_by_secret(session.black_secret)
+    assert loaded_session is not None and loaded_session is not session
+    assert to_json(loaded_session.game_state) == to_json(session.game_state)
+    storage.close()
+
+def test_sessions_are_saved_and_found_while_a_transaction_is_written():
+    storage = SqliteGameSessionsStorage(durability_window=60)
+    session = storage.create_session()
+    is_writing, can_finish = threading.Event(), threading.Event()
+
+    class SlowConnection:
+        def __init__(self, connection: sqlite3.Connection):
+            self.connection = connection
+        def __enter__(self):
+            return self.connection.__enter__()
+        def __exit__(self, *exc_info):
+            return self.connection.__exit__(*exc_info)
+        def execute(self, *args):
+            return self.connection.execute(*args)
+        def executemany(self, *args):
+            is_writing.set()
+            can_finish.wait(5)
+            return self.connection.executemany(*args)
+        def close(self):
+            self.connection.close()
+
+    storage._write_connection = SlowConnection(storage._write_connection)
+    flushing = threading.Thread(target=storage.flush)
+    flushing.start()
+    assert is_writing.wait(5)
+
+    other_session = storage.create_session()
+    session.game_state.make_move(0, 1, 0, 2)
+    storage.save_session(session)
+    assert storage.get_session_by_secret(other_session.black_secret) is other_session
+    assert flushing.is_alive()
+
+    can_finish.set()
+    flushing.join()
+    storage.flush()
+    assert storage.stats.transactions == 2
+    assert storage.stats.rows_written == 3
+    storage.close()
+
+class FailingConnection:
+    """ Fails the given number of transactions, then works as the connection """
+    def __init__(self, connection: sqlite3.Connection, failures: int):
+        self.connection = connection
+        self.failures = failures
+    def __enter__(self):
+        return self.connection.__enter__()
+    def __exit__(self, *exc_info):
+        return self.connection.__exit__(*exc_info)
+    def execute(self, *args):
+        return self.connection.execute(*args)
+    def executemany(self, *args):
+        if self.failures > 0:
+            self.failures -= 1
+            raise sqlite3.OperationalError('disk I/O error')
+        return self.connection.executemany(*args)
+    def close(self):
+        self.connection.close()
+
+def test_writer_retries_after_a_failure(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(sqlite_storage, 'WRITE_RETRY_DELAY', 0.01)
+    storage = SqliteGameSessionsStorage(durability_window=0.01)
+    storage._write_connection = FailingConnection(storage._write_connection, 2)
+    session = storage.create_session()
+    deadline = time.monotonic() + 5
+    while storage.stats.rows_written == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert storage.stats.failed_transactions == 2
+    assert storage.stats.rows_written == 1
+    assert storage._writer is not None and storage._writer.is_alive()
+
+    session.game_state.make_move(0, 1, 0, 2)
+    storage.save_session(session)
+    storage.close()
+    assert storage.stats.rows_written == 2
+
+def test_discarded_session_is_read_again(tmp_path: Path):
+    storage = SqliteGameSessionsStorage(str(tmp_path / 'sessions.db'), durability_window=0)
+    session_manager = GameSessionsManager(storage)
+    white_secret, _ = session_manager.create_session()
+    storage._write_connection = FailingConnection(storage._write_connection, 1)
+    with pytest.raises(sqlite3.OperationalError):
+        session_manager.make_move(white_secret, 4, 1, 4, 3)
+
+    # the failed move is neither seen nor written later
+    view_and_stats = session_manager.get_player_view_and_stats(white_secret)
+    assert view_and_stats is not None and view_and_stats.version == 0
+    storage.flush()
+    assert storage.stats.rows_written == 1
+    assert session_manager.make_move(white_secret, 4, 1, 4, 3) is not None
+    storage.close()
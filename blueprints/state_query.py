@@ -0,0 +1,79 @@
+"""
+Parameters of the /state route, shared by app.py and asgi_app.py:
+
+- ?since=<version>: only the cells changed since that version are sent (if it's remembered);
+- If-None-Match (the ETag got before): 304 is answered while the version is the same;
+- ?wait=<seconds>: the request is held until the version changes (or the time passes;
+  with DARK_CHESS_REDIS, a move made by another worker is only seen when the time passes);
+  ?since is used as the known version for waiting when there's no If-None-Match;
+- ?format=compact: the view is sent as base64 of 32 bytes, changed cells with codes
+  of their content (see game_sessions_manager.to_compact).
+"""
+
+import math
+from dataclasses import dataclass
+from typing import Mapping
+from .game_sessions_manager import PlayerViewAndStats, PlayerViewChanges, to_compact
+
+# the longest ?wait= of /state, in seconds
+MAX_STATE_WAIT = 30
+
+# a comment is sent to /events when there are no updates, so that proxies don't close the connection
+EVENTS_KEEP_ALIVE_INTERVAL = 15
+
+SESSION_NOT_FOUND = { 'problem': 'session not found by secret' }
+INVALID_WAIT = { 'problem': 'wait should be a number of seconds' }
+
+def _parse_version(value: str | None) -> int | None:
+    return int(value) if value is not None and value.isascii() and value.isdigit() else None
+
+@dataclass
+class StateQuery:
+    since_version: int | None
+    etag_version: int | None
+    # seconds, from 0 to MAX_STATE_WAIT
+    wait: float
+    is_compact: bool
+
+    @staticmethod
+    def parse(query: Mapping[str, str], if_none_match: str) -> 'StateQuery':
+        """ Raises ValueError when ?wait isn't a finite number (a missing or malformed one is 0) """
+        try:
+            wait = float(query.get('wait', 0))
+        except ValueError:
+            wait = 0
+        if not math.isfinite(wait):
+            raise ValueError(INVALID_WAIT['problem'])
+
+        etag_version = None
+        for etag in if_none_match.split(','):
+            etag_version = _parse_version(etag.strip().removeprefix('W/').strip('"'))
+            if etag_version is not None:
+                break
+
+        return StateQuery(_parse_version(query.get('since')),
+                          etag_version,
+                          min(max(wait, 0), MAX_STATE_WAIT),
+                          query.get('format') == 'compact')
+
+    @property
+    def known_version(self) -> int | None:
+        """ The version to wait for a change of (see is_waiting) """
+        return self.etag_version if self.etag_version is not None else self.since_version
+
+    @property
+    def is_waiting(self) -> bool:
+        """ Whether the version is waited to change (or checked, for If-None-Match) before answering """
+        return self.known_version is not None and (self.etag_version is not None or self.wait > 0)
+
+    def is_not_modified(self, version: int) -> bool:
+        """ Whether 304 is answered for the current version """
+        return version == self.etag_version
+
+    def format(self, result: PlayerViewAndStats | PlayerViewChanges) -> PlayerViewAndStats | PlayerViewChanges:
+        return to_compact(result) if self.is_compact else result
+
+    @staticmethod
+    def get_headers(version: int) -> dict[str, str]:
+        """ Of a 200 response """
+        return { 'ETag': f'"{version}"', 'Cache-Control': 'no-cache' }
@@ -0,0 +1,22 @@
+import pytest
+from .state_query import StateQuery, MAX_STATE_WAIT
+
+def test_parse():
+    query = StateQuery.parse({ 'since': '3', 'wait': '100', 'format': 'compact' }, 'W/"x", "5"')
+    assert query == StateQuery(3, 5, MAX_STATE_WAIT, True)
+    assert query.known_version == 5
+    assert query.is_waiting
+    assert query.is_not_modified(5) and not query.is_not_modified(6)
+
+    query = StateQuery.parse({ 'since': '-1', 'wait': '-2' }, '')
+    assert query == StateQuery(None, None, 0, False)
+    assert not query.is_waiting
+    # since alone is only waited on with ?wait
+    assert not StateQuery.parse({ 'since': '2' }, '').is_waiting
+    assert StateQuery.parse({ 'since': '2', 'wait': '1.5' }, '').is_waiting
+    assert StateQuery.parse({ 'wait': 'soon' }, '').wait == 0
+
+@pytest.mark.parametrize('wait', ['nan', 'inf', '-inf'])
+def test_non_finite_wait_is_refused(wait: str):
+    with pytest.raises(ValueError):
+        StateQuery.parse({ 'wait': wait }, '')
@@ -2,13 +2,28 @@
 Simple in-memory storage of sessions.
 """
 
+import threading
+import time
 from abc import ABC, abstractmethod
-from .game_session import GameSession
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator
+from .game_session import GameSession, FrozenSession, SecretRole
+from .snapshot import MappedSnapshot, write_snapshot
+from .locking import StripedLock
+from .game_domain.codec import encode_state, decode_state
+
+class StaleSessionError(Exception):
+    """ The session was changed elsewhere (e.g. by another process) after it was got, so it can't be saved """
 
 class IGameSessionStorage(ABC):
     """
     An abstract class (interface) to allow dependency injections and mocking
     """
+    # sessions are read and changed under their white_secret's lock;
+    # a storage doesn't drop a session object (e.g. to freeze it) while its lock is held
+    locks: StripedLock
+
     @abstractmethod
     def create_session(self) -> GameSession:
         """ Create a new session, store and return it """
@@ -17,23 +32,324 @@ class IGameSessionStorage(ABC):
     def get_session_by_secret(self, secret: str) -> GameSession | None:
         """ Find session by any secret (join, white, black) """
 
+    @abstractmethod
+    def get_session_and_role_by_secret(self, secret: str) -> tuple[GameSession, SecretRole] | None:
+        """ Find session by any secret, tell which of its secrets it is """
+
+    @abstractmethod
+    def get_white_secret(self, secret: str) -> str | None:
+        """ Find the session's white_secret (to lock it, see locks) by any secret, a cheap lookup """
+
+    @abstractmethod
+    def clear_join_secret(self, session: GameSession) -> None:
+        """ Remove the join secret of the session, so that it can't be used anymore (may raise StaleSessionError) """
+
+    @abstractmethod
+    def save_session(self, session: GameSession) -> None:
+        """ Store the changes of the session made after it was got: a move, a promotion (may raise StaleSessionError) """
+
+    def discard_session(self, session: GameSession) -> None:
+        """
+        Forget the session object if it's kept between lookups, e.g. when its changes couldn't be saved,
+        so that the next lookup reads what's stored (nothing to do when the objects are what's stored)
+        """
+
+@dataclass
+class StorageLimits:
+    """
+    When sessions are frozen (kept as a compact record, see FrozenSession)
+    or removed; None means no limit. Times are in seconds since the last access.
+    """
+    idle_timeout: float | None = None
+    freeze_after: float | None = None
+    freeze_finished_after: float | None = None
+    max_hot_sessions: int | None = None
+    max_sessions: int | None = None
+
+@dataclass
+class StorageStats:
+    hot_sessions: int = 0
+    frozen_sessions: int = 0
+    evicted: int = 0
+    frozen: int = 0
+    rehydrated: int = 0
+
 class GameSessionsStorage(IGameSessionStorage):
     """
     Simple in-memory storage of sessions.
+    Sessions are indexed by each of their secrets.
+
+    Sessions not accessed for a while (or finished ones) are frozen, and
+    turned back into GameSession on access; unused ones are evicted,
+    see StorageLimits. Both are done on each call before the access
+    (so the returned session stays hot until the next call), starting from
+    the least recently used sessions, so memory stays bounded.
+
+    Can be started from a snapshot (see snapshot.py and dump_snapshot):
+    sessions are taken from it when looked up for the first time.
+
+    Thread-safe: the indices are changed under an internal lock, which is
+    only held for the lookups, not while sessions are used (see locks).
     """
-    def __init__(self):
-        self.sessions: list[GameSession] = []
+    def __init__(self,
+                 limits: StorageLimits | None = None,
+                 clock: Callable[[], float] = time.monotonic,
+                 snapshot: MappedSnapshot | None = None):
+        self.limits = limits if limits else StorageLimits()
+        self.locks = StripedLock()
+        self._lock = threading.RLock()
+        self._snapshot = snapshot
+        # white secrets of sessions taken from the snapshot (those in it are outdated)
+        self._taken_from_snapshot: set[str] = set()
+        self._stats = StorageStats()
+        self._clock = clock
+        # sessions by white_secret, from the least recently used ones
+        self._hot_sessions: OrderedDict[str, GameSession] = OrderedDict()
+        self._frozen_sessions: OrderedDict[str, FrozenSession] = OrderedDict()
+        self._finished_sessions: OrderedDict[str, None] = OrderedDict()
+        self._last_access: dict[str, float] = {}
+        # any secret to (white_secret, role)
+        self._sessions_by_secret: dict[str, tuple[str, SecretRole]] = {}
 
     def create_session(self):
         """ Create a new session, store and return it """
         session = GameSession()
-        self.sessions.append(session)
+        with self._lock:
+            self._apply_limits()
+            self._hot_sessions[session.white_secret] = session
+            self._last_access[session.white_secret] = self._clock()
+            self._index_session(session)
         return session
 
+    def export_sessions(self, is_locking: bool = False) -> Iterator[FrozenSession]:
+        """
+        All the sessions as frozen ones (hot ones are encoded, but stay hot), e.g. for snapshots.
+        Hold locks.hold_all() while iterating if sessions may be changed meanwhile,
+        or let each session be exported and yielded under its lock (is_locking),
+        so that sessions are changed meanwhile, but each is taken between its changes.
+        """
+        if is_locking:
+            yield from self._export_sessions_one_by_one()
+            return
+        with self._lock:
+            hot_sessions = list(self._hot_sessions.values())
+            frozen_sessions = list(self._frozen_sessions.values())
+            taken_from_snapshot = set(self._taken_from_snapshot)
+        for session in hot_sessions:
+            yield FrozenSession(session.white_secret,
+                                session.join_secret,
+                                session.black_secret,
+                                encode_state(session.game_state))
+        yield from frozen_sessions
+        if self._snapshot is not None:
+            for frozen_session in self._snapshot:
+                if frozen_session.white_secret not in taken_from_snapshot:
+                    yield frozen_session
+
+    def _export_sessions_one_by_one(self) -> Iterator[FrozenSession]:
+        with self._lock:
+            keys = [*self._hot_sessions, *self._frozen_sessions]
+            if self._snapshot is not None:
+                keys += [frozen_session.white_secret for frozen_session in self._snapshot
+                         if frozen_session.white_secret not in self._taken_from_snapshot]
+        for key in keys:
+            with self.locks.hold(key):
+                with self._lock:
+                    # it may have been frozen, rehydrated or taken from the snapshot meanwhile
+                    session: GameSession | FrozenSession | None = \
+                        self._hot_sessions.get(key) or self._frozen_sessions.get(key)
+                    if session is None and self._snapshot is not None and key not in self._taken_from_snapshot:
+                        found = self._snapshot.find(key)
+                        session = found[0] if found is not None else None
+                if isinstance(session, GameSession):
+                    session = FrozenSession(session.white_secret,
+                                            session.join_secret,
+                                            session.black_secret,
+                                            encode_state(session.game_state))
+                if session is not None:
+                    yield session
+
+    def import_sessions(self, frozen_sessions: Iterable[FrozenSession]) -> None:
+        """ Adds the sessions (e.g. recovered ones) as frozen, they are rehydrated on access """
+        with self._lock:
+            now = self._clock()
+            for frozen_session in frozen_sessions:
+                self._frozen_sessions[frozen_session.white_secret] = frozen_session
+                self._last_access[frozen_session.white_secret] = now
+                self._index_session(frozen_session)
+
+    def _index_session(self, session: GameSession | FrozenSession) -> None:
+        self._sessions_by_secret[session.white_secret] = (session.white_secret, SecretRole.white)
+        self._sessions_by_secret[session.black_secret] = (session.white_secret, SecretRole.black)
+        if session.join_secret is not None:
+            self._sessions_by_secret[session.join_secret] = (session.white_secret, SecretRole.join)
+
     def get_session_by_secret(self, secret: str):
         """ Find session by any secret (join, white, black) """
-        for session in self.sessions:
-            if secret in { session.white_secret, session.join_secret, session.black_secret }:
-                return session
-        return None
+        found = self.get_session_and_role_by_secret(secret)
+        return found[0] if found is not None else None
+
+    def get_session_and_role_by_secret(self, secret: str):
+        """ Find session by any secret, tell which of its secrets it is """
+        with self._lock:
+            self._apply_limits()
+            found = self._sessions_by_secret.get(secret)
+            if found is None:
+                found = self._take_from_snapshot(secret)
+            if found is None:
+                return None
+            key, role = found
+            session = self._access(key)
+            # in case join_secret was changed on the session directly, not via clear_join_secret
+            if role == SecretRole.join and session.join_secret != secret:
+                del self._sessions_by_secret[secret]
+                return None
+        return session, role
+
+    def get_white_secret(self, secret: str):
+        """ Find the session's white_secret by any secret (without restoring a frozen session) """
+        with self._lock:
+            found = self._sessions_by_secret.get(secret)
+            if found is None:
+                found = self._take_from_snapshot(secret)
+        return found[0] if found is not None else None
+
+    def _take_from_snapshot(self, secret: str) -> tuple[str, SecretRole] | None:
+        if self._snapshot is None:
+            return None
+        found = self._snapshot.find(secret)
+        if found is None or found[0].white_secret in self._taken_from_snapshot:
+            return None
+        frozen_session, role = found
+        self._taken_from_snapshot.add(frozen_session.white_secret)
+        self.import_sessions([frozen_session])
+        return frozen_session.white_secret, role
+
+    def dump_snapshot(self, path: str) -> int:
+        """
+        Writes all the sessions to a snapshot file (see snapshot.py), returns their number.
+        The mapped snapshot is closed first (a mapped file can't be replaced on Windows),
+        sessions not taken from it yet are kept in memory as frozen ones from now on.
+        """
+        with self.locks.hold_all():
+            sessions = list(self.export_sessions())
+            with self._lock:
+                if self._snapshot is not None:
+                    self.import_sessions(frozen_session for frozen_session in self._snapshot
+                                         if frozen_session.white_secret not in self._taken_from_snapshot)
+                    self._snapshot.close()
+                    self._snapshot = None
+                    self._taken_from_snapshot.clear()
+            return write_snapshot(path, sessions)
+
+    def clear_join_secret(self, session: GameSession):
+        """ Remove the join secret of the session, so that it can't be used anymore """
+        with self._lock:
+            if session.join_secret is not None:
+                self._sessions_by_secret.pop(session.join_secret, None)
+            session.join_secret = None
+
+    def save_session(self, session: GameSession):
+        """ Sessions are changed in place, only finished games are noted to be frozen sooner """
+        with self._lock:
+            self._note_if_finished(session)
+
+    def _note_if_finished(self, session: GameSession) -> None:
+        game_state = session.game_state
+        if session.white_secret in self._hot_sessions and \
+           (game_state.get_winner() is not None or game_state.is_draw()):
+            self._finished_sessions[session.white_secret] = None
+
+    @property
+    def stats(self) -> StorageStats:
+        """ Numbers of sessions kept and of what's done to them (a copy) """
+        with self._lock:
+            return StorageStats(len(self._hot_sessions),
+                                len(self._frozen_sessions),
+                                self._stats.evicted,
+                                self._stats.frozen,
+                                self._stats.rehydrated)
+
+    def _access(self, key: str) -> GameSession:
+        """ Gets the session by white_secret, makes it hot and the most recently used """
+        self._last_access[key] = self._clock()
+        session = self._hot_sessions.get(key)
+        if session is not None:
+            self._hot_sessions.move_to_end(key)
+            if key in self._finished_sessions:
+                self._finished_sessions.move_to_end(key)
+            return session
+
+        frozen_session = self._frozen_sessions.pop(key)
+        session = GameSession.restore(frozen_session.white_secret,
+                                      frozen_session.join_secret,
+                                      frozen_session.black_secret,
+                                      decode_state(frozen_session.encoded_state))
+        self._hot_sessions[key] = session
+        self._stats.rehydrated += 1
+        self._note_if_finished(session)
+        return session
+
+    def _freeze(self, key: str) -> None:
+        session = self._hot_sessions.pop(key)
+        self._finished_sessions.pop(key, None)
+        self._frozen_sessions[key] = FrozenSession(session.white_secret,
+                                                   session.join_secret,
+                                                   session.black_secret,
+                                                   encode_state(session.game_state))
+        self._stats.frozen += 1
+
+    def _evict(self, key: str) -> None:
+        session = self._hot_sessions.pop(key, None)
+        self._finished_sessions.pop(key, None)
+        frozen_session = self._frozen_sessions.pop(key, None)
+        secrets_owner = session if session is not None else frozen_session
+        assert secrets_owner is not None
+        for secret in (secrets_owner.white_secret, secrets_owner.join_secret, secrets_owner.black_secret):
+            if secret is not None:
+                self._sessions_by_secret.pop(secret, None)
+        del self._last_access[key]
+        self._stats.evicted += 1
+
+    def _oldest(self, sessions: OrderedDict) -> str | None:
+        return next(iter(sessions), None)
+
+    def _is_idle_for(self, key: str | None, timeout: float | None, now: float) -> bool:
+        return key is not None and timeout is not None and now - self._last_access[key] >= timeout
+
+    def _oldest_unlocked_hot(self, sessions: OrderedDict) -> str | None:
+        """ The oldest hot session if it's not being used (otherwise it's left until the next call) """
+        key = self._oldest(sessions)
+        return key if key is not None and not self.locks.is_locked(key) else None
+
+    def _apply_limits(self) -> None:
+        """
+        Freezes and evicts sessions according to the limits, starting from the least recently used
+        (under the lock)
+        """
+        limits = self.limits
+        now = self._clock()
+
+        # idle ones are evicted: hot ones are ordered by the last access, so only the oldest are checked;
+        # frozen ones are ordered by the time they were frozen, which is close to that
+        while self._is_idle_for(self._oldest(self._frozen_sessions), limits.idle_timeout, now):
+            self._evict(self._oldest(self._frozen_sessions)) # type: ignore
+        while self._is_idle_for(self._oldest_unlocked_hot(self._hot_sessions), limits.idle_timeout, now):
+            self._evict(self._oldest(self._hot_sessions)) # type: ignore
+
+        while self._is_idle_for(self._oldest_unlocked_hot(self._finished_sessions),
+                                limits.freeze_finished_after, now):
+            self._freeze(self._oldest(self._finished_sessions)) # type: ignore
+        while self._oldest_unlocked_hot(self._hot_sessions) is not None and \
+              (self._is_idle_for(self._oldest(self._hot_sessions), limits.freeze_after, now) or
+               limits.max_hot_sessions is not None and len(self._hot_sessions) > limits.max_hot_sessions):
+            self._freeze(self._oldest(self._hot_sessions)) # type: ignore
+
+        while limits.max_sessions is not None and \
+              len(self._hot_sessions) + len(self._frozen_sessions) > limits.max_sessions:
+            # frozen ones are less recently used than the hot ones (mostly)
+            key = self._oldest(self._frozen_sessions) or self._oldest_unlocked_hot(self._hot_sessions)
+            if key is None:
+                break
+            self._evict(key)
 
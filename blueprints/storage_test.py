@@ -0,0 +1,111 @@
+from .storage import GameSessionsStorage, StorageLimits, StorageStats
+from .game_session import SecretRole
+from .game_domain.state import Player
+from .serialization import to_json
+
+def test_get_session_and_role_by_secret():
+    storage = GameSessionsStorage()
+    session = storage.create_session()
+    other_session = storage.create_session()
+    assert session.join_secret is not None
+
+    assert storage.get_session_and_role_by_secret(session.white_secret) == (session, SecretRole.white)
+    assert storage.get_session_and_role_by_secret(session.black_secret) == (session, SecretRole.black)
+    assert storage.get_session_and_role_by_secret(session.join_secret) == (session, SecretRole.join)
+    assert storage.get_session_by_secret(other_session.white_secret) is other_session
+    assert storage.get_session_and_role_by_secret('some garbage') is None
+    assert storage.get_session_by_secret('some garbage') is None
+
+def test_clear_join_secret():
+    storage = GameSessionsStorage()
+    session = storage.create_session()
+    join_secret = session.join_secret
+    assert join_secret is not None
+
+    storage.clear_join_secret(session)
+    assert session.join_secret is None
+    assert storage.get_session_by_secret(join_secret) is None
+    assert storage.get_session_by_secret(session.white_secret) is session
+
+    # changed directly on the session
+    other_session = storage.create_session()
+    other_join_secret = other_session.join_secret
+    assert other_join_secret is not None
+    other_session.join_secret = None
+    assert storage.get_session_by_secret(other_join_secret) is None
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+def test_idle_sessions_are_evicted():
+    clock = FakeClock()
+    storage = GameSessionsStorage(StorageLimits(idle_timeout=100), clock)
+    session = storage.create_session()
+    other_session = storage.create_session()
+
+    clock.now = 60
+    assert storage.get_session_by_secret(session.black_secret) is session
+    clock.now = 120
+    assert storage.get_session_by_secret(other_session.white_secret) is None
+    assert storage.get_session_by_secret(session.white_secret) is session
+    assert storage.stats.evicted == 1
+    assert storage.stats.hot_sessions == 1
+
+def test_idle_sessions_are_frozen():
+    clock = FakeClock()
+    storage = GameSessionsStorage(StorageLimits(freeze_after=100), clock)
+    session = storage.create_session()
+    session.game_state.make_move(4, 1, 4, 3)
+    storage.save_session(session)
+
+    clock.now = 100
+    storage.create_session()
+    assert storage.stats.frozen_sessions == 1
+    assert storage.stats.hot_sessions == 1
+
+    rehydrated = storage.get_session_by_secret(session.white_secret)
+    assert rehydrated is not None and rehydrated is not session
+    assert rehydrated.join_secret == session.join_secret
+    assert to_json(rehydrated.game_state) == to_json(session.game_state)
+    assert storage.stats == StorageStats(hot_sessions=2, frozen_sessions=0, evicted=0, frozen=1, rehydrated=1)
+
+    # the join secret works after rehydration, and clearing it, too
+    join_secret = rehydrated.join_secret
+    assert join_secret is not None
+    assert storage.get_session_and_role_by_secret(join_secret) == (rehydrated, SecretRole.join)
+    storage.clear_join_secret(rehydrated)
+    assert storage.get_session_by_secret(join_secret) is None
+
+def test_finished_sessions_are_frozen_sooner():
+    clock = FakeClock()
+    storage = GameSessionsStorage(StorageLimits(freeze_after=1000, freeze_finished_after=10), clock)
+    session = storage.create_session()
+    storage.create_session()
+    # fool's mate
+    for move in [(2, 1, 2, 2), (3, 6, 3, 4), (1, 1, 1, 3), (4, 7, 0, 3)]:
+        session.game_state.make_move(*move)
+    storage.save_session(session)
+
+    clock.now = 10
+    storage.create_session()
+    assert storage.stats.frozen_sessions == 1
+    rehydrated = storage.get_session_by_secret(session.black_secret)
+    assert rehydrated is not None
+    assert rehydrated.game_state.get_winner() == Player.black
+
+def test_count_limits():
+    clock = FakeClock()
+    storage = GameSessionsStorage(StorageLimits(max_hot_sessions=2, max_sessions=3), clock)
+    sessions = []
+    for _ in range(5):
+        clock.now += 1
+        sessions.append(storage.create_session())
+    storage.get_session_by_secret(sessions[-1].white_secret)
+
+    assert storage.stats.hot_sessions + storage.stats.frozen_sessions == 3
+    assert storage.stats.hot_sessions == 2
+    assert storage.get_session_by_secret(sessions[0].white_secret) is None
+    assert storage.get_session_by_secret(sessions[4].white_secret) is sessions[4]